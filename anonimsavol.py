@@ -1,30 +1,668 @@
 import os
+from abc import ABC, abstractmethod
 import sqlite3
 import base64
 import json
 import re
-from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, MessageEntity, Poll, User
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+import io
+import time
+import asyncio
+import functools
+import hashlib
+import signal
+import sys
+import threading
+import traceback
+import multiprocessing
+import contextlib
+import contextvars
+import csv
+from array import array
+import gzip
+import tempfile
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, MessageEntity, Poll, User, InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo
+from telegram.ext import Application, BaseRateLimiter, ChatMemberHandler, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, ExtBot, TypeHandler, filters
+from telegram.request import BaseRequest, HTTPXRequest
 import telegram.error
 import html
 import urllib.parse
 
-BOT_USERNAME = "AnonimXabarliBot"  # Masalan: AnonimSavolBot
+BOT_USERNAME = os.getenv('BOT_USERNAME', 'AnonimXabarliBot')  # Masalan: AnonimSavolBot
 BOT_TOKEN = os.getenv('BOT_TOKEN')  # Eski hardcoded ni o'rniga
-ADMIN_ID = int(os.getenv('ADMIN_ID'))  # Eski hardcoded ni o'rniga
+ADMIN_ID = int(os.getenv('ADMIN_ID', '0'))  # Eski hardcoded ni o'rniga
+BOTS_FILE = os.getenv('BOTS_FILE')  # O'rnatilsa, bitta jarayonda bir nechta bot (JSON ro'yxat)
+PROCESS_START = time.perf_counter()
+DB_PATH = os.getenv('DB_PATH', 'bot.db')
+STORAGE = os.getenv('STORAGE', 'sqlite')  # sqlite yoki memory
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # 0 - HTTP endpoint o'chirilgan
+SLOW_QUERY_MS = os.getenv('SLOW_QUERY_MS')  # O'rnatilsa, so'rov profileri yoqiladi
+QUERY_TOP_N = int(os.getenv('QUERY_TOP_N', '10'))
+
+# Metrikalar: handler, SQL va Bot API vaqtlari
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+handler_latency = {}  # handler nomi -> Histogram
+sql_latency = {}  # SQL turi (masalan "SELECT users") -> Histogram
+loop_lag = {}  # "event_loop" -> Histogram (rejalashtirish kechikishi)
+api_calls = {}  # (method, outcome) -> soni
+queue_depths = {}  # navbat nomi -> hajmini qaytaruvchi funksiya
+http_routes = {}  # path -> (headers, body) olib (status, content_type, body) qaytaruvchi funksiya
+
+def observe_latency(registry: dict, label: str, seconds: float):
+    histogram = registry.get(label)
+    if histogram is None:
+        histogram = registry[label] = Histogram()
+    histogram.observe(seconds)
+
+def register_queue_depth(name: str, getter):
+    queue_depths[name] = getter
+
+SQL_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', re.IGNORECASE)
+
+@functools.lru_cache(maxsize=512)
+def sql_label(sql: str) -> str:
+    words = sql.split(None, 1)
+    verb = words[0].upper() if words else ''
+    match = SQL_TABLE_RE.search(sql)
+    return f"{verb} {match.group(1)}" if match else verb
+
+# So'rov profileri (SLOW_QUERY_MS o'rnatilganda)
+slow_query_threshold = float(SLOW_QUERY_MS) / 1000 if SLOW_QUERY_MS else None
+query_stats = {}  # normallashtirilgan SQL -> [soni, umumiy vaqt, eng uzun vaqt]
+query_plans = {}  # normallashtirilgan SQL -> EXPLAIN QUERY PLAN matni
+QUERY_STATS_SIZE = int(os.getenv('QUERY_STATS_SIZE', '500'))  # shundan ortig'ida eng arzon so'rov chiqariladi
+PLACEHOLDER_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+EXPLAINABLE_VERBS = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+def normalize_sql(sql: str) -> str:
+    # IN (?, ?, ...) ro'yxatlari uzunligidan qat'i nazar bitta kalit beradi
+    return PLACEHOLDER_LIST_RE.sub("(?, ...)", " ".join(sql.split()))
+
+def explain_query(connection, sql: str, parameters) -> str:
+    try:
+        rows = sqlite3.Cursor(connection).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite3.Error as e:
+        return f"(EXPLAIN xato: {e})"
+    return "\n".join(row[-1] for row in rows)
+
+def profile_query(connection, sql: str, parameters, seconds: float):
+    key = normalize_sql(sql)
+    stats = query_stats.get(key)
+    if stats is None:
+        if len(query_stats) >= QUERY_STATS_SIZE:
+            cheapest = min(query_stats, key=lambda item: query_stats[item][1])
+            del query_stats[cheapest]
+            query_plans.pop(cheapest, None)
+        stats = query_stats[key] = [0, 0.0, 0.0]
+    stats[0] += 1
+    stats[1] += seconds
+    stats[2] = max(stats[2], seconds)
+    if seconds >= slow_query_threshold and parameters is not None:
+        if key not in query_plans and key.split(None, 1)[0].upper() in EXPLAINABLE_VERBS:
+            query_plans[key] = explain_query(connection, sql, parameters)
+        print(f"Sekin so'rov ({seconds * 1000:.1f} ms): {key}\n{query_plans.get(key, '')}")
+
+def top_queries(limit=QUERY_TOP_N):
+    return sorted(query_stats.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start_time = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - start_time
+            observe_latency(sql_latency, sql_label(sql), elapsed)
+            if slow_query_threshold is not None:
+                profile_query(self.connection, sql, parameters, elapsed)
+
+    def executemany(self, sql, seq_of_parameters):
+        start_time = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            elapsed = time.perf_counter() - start_time
+            observe_latency(sql_latency, sql_label(sql), elapsed)
+            if slow_query_threshold is not None:
+                profile_query(self.connection, sql, None, elapsed)
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class MetricsBot(ExtBot):
+    # Har bir Bot API chaqiruvi shu yerdan o'tadi
+    async def _do_post(self, endpoint, data, *args, **kwargs):
+        outcome = 'ok'
+        try:
+            return await super()._do_post(endpoint, data, *args, **kwargs)
+        except telegram.error.TelegramError as e:
+            outcome = type(e).__name__
+            raise
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            if endpoint != 'getUpdates':
+                key = (endpoint, outcome)
+                api_calls[key] = api_calls.get(key, 0) + 1
+
+# Bot API governor: barcha chiqish so'rovlari global va chat limitlariga
+# bo'ysunadi; interaktiv javoblar broadcast kabi ommaviy yuborishlardan oldin o'tadi.
+INTERACTIVE_LANE = "interactive"
+BULK_LANE = "bulk"
+api_priority = contextvars.ContextVar("api_priority", default=INTERACTIVE_LANE)
+API_GLOBAL_RATE = float(os.getenv('API_GLOBAL_RATE', '30'))  # xabar/soniya
+API_BULK_RESERVE = float(os.getenv('API_BULK_RESERVE', '5'))  # interaktiv uchun saqlanadigan tokenlar
+API_MAX_RETRIES = int(os.getenv('API_MAX_RETRIES', '3'))
+PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST = 1.0, 3.0  # xabar/soniya
+GROUP_CHAT_RATE, GROUP_CHAT_BURST = 20 / 60, 3.0
+PACED_ENDPOINT_PREFIXES = ("send", "forward", "copy")
+
+@contextlib.contextmanager
+def api_lane(priority: str):
+    token = api_priority.set(priority)
+    try:
+        yield
+    finally:
+        api_priority.reset(token)
+
+class ApiGovernor(BaseRateLimiter):
+    def __init__(self, global_rate=API_GLOBAL_RATE, bulk_reserve=API_BULK_RESERVE, max_retries=API_MAX_RETRIES):
+        self.global_rate = global_rate
+        self.bulk_reserve = bulk_reserve
+        self.max_retries = max_retries
+        self.tokens = global_rate
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.chat_buckets = {}  # chat_id -> [tokens, updated]
+        self.waiting = {INTERACTIVE_LANE: 0, BULK_LANE: 0}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _refill(self, now: float):
+        self.tokens = min(self.global_rate, self.tokens + (now - self.updated) * self.global_rate)
+        self.updated = now
+
+    def _chat_bucket(self, chat_id, now: float):
+        rate, burst = (GROUP_CHAT_RATE, GROUP_CHAT_BURST) if str(chat_id).startswith(("-", "@")) else (PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST)
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 50000:
+                # To'lgan (eskirgan) bucketlarni tashlab yuborish
+                self.chat_buckets = {key: b for key, b in self.chat_buckets.items() if now - b[1] < burst / rate}
+            bucket = self.chat_buckets[chat_id] = [burst, now]
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        return bucket, rate
+
+    async def _acquire(self, priority: str, chat_id):
+        self.waiting[priority] += 1
+        try:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                needed = 1.0
+                if priority == BULK_LANE:
+                    # Ommaviy yuborish interaktiv navbat bo'sh bo'lganda va zaxira qolganda ishlaydi
+                    needed += self.bulk_reserve
+                    if self.waiting[INTERACTIVE_LANE]:
+                        await asyncio.sleep(1 / self.global_rate)
+                        continue
+                wait = (needed - self.tokens) / self.global_rate if self.tokens < needed else 0.0
+                if chat_id is not None:
+                    bucket, rate = self._chat_bucket(chat_id, now)
+                    if bucket[0] < 1:
+                        wait = max(wait, (1 - bucket[0]) / rate)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                self.tokens -= 1
+                if chat_id is not None:
+                    bucket[0] -= 1
+                return
+        finally:
+            self.waiting[priority] -= 1
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args or api_priority.get()
+        paced = endpoint.startswith(PACED_ENDPOINT_PREFIXES)
+        for attempt in range(self.max_retries + 1):
+            if paced:
+                await self._acquire(priority, data.get("chat_id"))
+            try:
+                return await callback(*args, **kwargs)
+            except telegram.error.RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                # Flood control: barcha yo'laklar to'xtaydi
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                print(f"Flood control: {endpoint} {retry_after} s kutiladi")
+                if not paced:
+                    await asyncio.sleep(retry_after)
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_histograms(lines: list, name: str, label_name: str, registry: dict):
+    lines.append(f"# TYPE {name} histogram")
+    for label, histogram in sorted(registry.items()):
+        label = escape_label(label)
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label_name}="{label}",le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{label_name}="{label}",le="+Inf"}} {histogram.count}')
+        lines.append(f'{name}_sum{{{label_name}="{label}"}} {histogram.sum:.6f}')
+        lines.append(f'{name}_count{{{label_name}="{label}"}} {histogram.count}')
+
+def render_metrics() -> str:
+    lines = []
+    render_histograms(lines, "bot_handler_latency_seconds", "handler", handler_latency)
+    render_histograms(lines, "bot_sql_duration_seconds", "statement", sql_latency)
+    render_histograms(lines, "bot_event_loop_lag_seconds", "loop", loop_lag)
+    lines.append("# TYPE bot_event_loop_stalls_total counter")
+    lines.append(f"bot_event_loop_stalls_total {loop_watchdog['stalls']}")
+    lines.append("# TYPE bot_api_calls_total counter")
+    for (method, outcome), count in sorted(api_calls.items()):
+        lines.append(f'bot_api_calls_total{{method="{escape_label(method)}",outcome="{escape_label(outcome)}"}} {count}')
+    lines.append("# TYPE bot_queue_depth gauge")
+    for bot_tenant in running_tenants():
+        # Bir nechta bot: har bir navbat o'z boti kontekstida o'qiladi va tenant yorlig'ini oladi
+        label = "" if bot_tenant is default_tenant else f'tenant="{escape_label(bot_tenant.name)}",'
+        with use_tenant(bot_tenant):
+            getters = {**queue_depths, **dict(tenant_queue_depths.items())}
+            for name, getter in sorted(getters.items()):
+                try:
+                    depth = getter()
+                except Exception:
+                    continue
+                lines.append(f'bot_queue_depth{{{label}queue="{escape_label(name)}"}} {depth}')
+    return "\n".join(lines) + "\n"
+
+http_routes["/metrics"] = lambda headers, body: (200, "text/plain; version=0.0.4", render_metrics())
+
+# Kichik HTTP server (Prometheus, webhook va boshqa endpointlar uchun)
+HTTP_STATUS_TEXT = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large", 503: "Service Unavailable"}
+HTTP_MAX_BODY = 1024 * 1024
+
+async def handle_http_request(reader, writer, routes=http_routes):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        headers = {}
+        while True:
+            header = await asyncio.wait_for(reader.readline(), timeout=5)
+            if header in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = header.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        parts = request_line.decode('latin-1').split()
+        path = parts[1].split('?', 1)[0] if len(parts) > 1 else '/'
+        route = routes.get(path)
+        content_length = int(headers.get('content-length') or 0)
+        if content_length > HTTP_MAX_BODY:
+            status, content_type, body = 413, "text/plain", "too large\n"
+        elif route:
+            request_body = await asyncio.wait_for(reader.readexactly(content_length), timeout=10) if content_length else b''
+            status, content_type, body = route(headers, request_body)
+        else:
+            status, content_type, body = 404, "text/plain", "not found\n"
+        payload = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_STATUS_TEXT.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode()
+            + payload
+        )
+        await writer.drain()
+    except Exception as e:
+        print(f"HTTP so'rovida xato: {e}")
+    finally:
+        writer.close()
+
+http_server = None
+
+async def start_http_server():
+    global http_server
+    if METRICS_PORT and http_server is None:
+        http_server = await asyncio.start_server(handle_http_request, METRICS_HOST, METRICS_PORT)
+        print(f"Metrikalar http://{METRICS_HOST}:{METRICS_PORT}/metrics da")
+
+async def stop_http_server():
+    global http_server
+    if http_server is not None:
+        http_server.close()
+        await http_server.wait_closed()
+        http_server = None
+
+# Event loop kuzatuvi: monitor korutinasi har LOOP_LAG_INTERVAL da uyg'onib
+# kechikishni o'lchaydi va heartbeat yangilaydi. Alohida watchdog oqimi
+# heartbeat LOOP_STALL_THRESHOLD dan eski bo'lsa, loop oqimining joriy stekini
+# (ya'ni loopni bloklayotgan kodni) yozib qo'yadi.
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.25'))  # soniya
+LOOP_STALL_THRESHOLD = float(os.getenv('LOOP_STALL_THRESHOLD', '1.0'))  # soniya
+HEALTH_MAX_PENDING = int(os.getenv('HEALTH_MAX_PENDING', '1000'))  # ready uchun navbatdagi update lar chegarasi
+loop_watchdog = {"heartbeat": time.monotonic(), "lag": 0.0, "max_lag": 0.0, "stalls": 0,
+                 "last_stall": None, "thread": None, "stop": threading.Event()}
+
+async def loop_lag_monitor():
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        now = time.monotonic()
+        lag = now - started - LOOP_LAG_INTERVAL
+        loop_watchdog.update(heartbeat=now, lag=lag, max_lag=max(loop_watchdog["max_lag"], lag))
+        observe_latency(loop_lag, "event_loop", lag)
+
+def watchdog_thread(loop_thread_id: int):
+    reported = None
+    while not loop_watchdog["stop"].wait(LOOP_LAG_INTERVAL):
+        heartbeat = loop_watchdog["heartbeat"]
+        stalled = time.monotonic() - heartbeat
+        if stalled < LOOP_STALL_THRESHOLD or reported == heartbeat:
+            continue
+        # Bitta to'xtash uchun bir marta
+        reported = heartbeat
+        frame = sys._current_frames().get(loop_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame else ""
+        loop_watchdog["stalls"] += 1
+        loop_watchdog["last_stall"] = {"at": utc_timestamp(), "stalled": round(stalled, 3), "stack": stack}
+        print(f"Event loop {stalled:.2f} s bloklandi:\n{stack}")
+
+def start_loop_watchdog() -> bool:
+    # Bir nechta bot bitta loopda: watchdog faqat birinchi marta ishga tushadi
+    if loop_watchdog["thread"] is not None:
+        return False
+    loop_watchdog["stop"].clear()
+    loop_watchdog["heartbeat"] = time.monotonic()
+    loop_watchdog["thread"] = threading.Thread(target=watchdog_thread, args=(threading.get_ident(),),
+                                               name="loop-watchdog", daemon=True)
+    loop_watchdog["thread"].start()
+    return True
+
+def stop_loop_watchdog():
+    if loop_watchdog["thread"] is not None:
+        loop_watchdog["stop"].set()
+        loop_watchdog["thread"].join()
+        loop_watchdog["thread"] = None
+
+# Jarayon uchun umumiy xizmatlar (HTTP server, loop watchdog): har bir foydalanuvchi
+# (bot yoki multi_bot_main) bir marta oladi, oxirgisi bo'shatganda to'xtaydi
+shared_services = {"users": 0, "tasks": []}
+
+async def start_shared_services():
+    shared_services["users"] += 1
+    if shared_services["users"] > 1:
+        return
+    await start_http_server()
+    start_loop_watchdog()
+    shared_services["tasks"].append(asyncio.create_task(loop_lag_monitor()))
+
+async def stop_shared_services():
+    shared_services["users"] -= 1
+    if shared_services["users"] > 0:
+        return
+    for task in shared_services["tasks"]:
+        task.cancel()
+    await asyncio.gather(*shared_services["tasks"], return_exceptions=True)
+    shared_services["tasks"].clear()
+    await stop_http_server()
+    stop_loop_watchdog()
+
+def tenant_health() -> dict:
+    pending = tenant_queue_depths.get("updates")
+    try:
+        db_ok = storage.ping()
+    except Exception:
+        db_ok = False
+    return {"pending_updates": pending() if pending else None, "db": db_ok}
+
+def health_report() -> dict:
+    tenants = {}
+    for bot_tenant in running_tenants():
+        with use_tenant(bot_tenant):
+            tenants[bot_tenant.name] = tenant_health()
+    report = {
+        "loop_lag": round(loop_watchdog["lag"], 4),
+        "loop_lag_max": round(loop_watchdog["max_lag"], 4),
+        "heartbeat_age": round(time.monotonic() - loop_watchdog["heartbeat"], 3),
+        "loop_stalls": loop_watchdog["stalls"],
+        "pending_updates": max((item["pending_updates"] or 0 for item in tenants.values()), default=0),
+        "db": all(item["db"] for item in tenants.values()),
+        "tenants": tenants,
+    }
+    if loop_watchdog["last_stall"]:
+        report["last_stall"] = {key: value for key, value in loop_watchdog["last_stall"].items() if key != "stack"}
+    return report
+
+def health_response(ready: bool):
+    report = health_report()
+    healthy = report["heartbeat_age"] < LOOP_STALL_THRESHOLD + LOOP_LAG_INTERVAL
+    if ready:
+        healthy = healthy and report["db"] and (report["pending_updates"] or 0) < HEALTH_MAX_PENDING
+    report["status"] = "ok" if healthy else "fail"
+    return (200 if healthy else 503), "application/json", json.dumps(report) + "\n"
+
+http_routes["/health/live"] = lambda headers, body: health_response(ready=False)
+http_routes["/health/ready"] = lambda headers, body: health_response(ready=True)
+
+# Statistik profiler (/profile): ikki manba bir vaqtda namuna oladi.
+#   cpu   - alohida oqim loop oqimining haqiqiy stekini o'qiydi (handlerlar, sqlite3)
+#   await - loop ichidagi korutina har bir task ning await zanjirini yozadi (Bot API kutish)
+# Natija flamegraph.pl / speedscope uchun collapsed-stack ko'rinishida.
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.01'))  # soniya
+PROFILE_MAX_SECONDS = 300
+PROFILE_TOP_N = int(os.getenv('PROFILE_TOP_N', '20'))
+profiler_state = {"running": False}
+# Bo'sh kutish (fon sikllari, navbatlar) va getUpdates long-poll namunaga kirmaydi
+IDLE_AWAIT_FUNCTIONS = ("sleep", "wait", "get")
+
+def frame_label(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+def thread_stack(frame) -> list:
+    stack = []
+    while frame is not None:
+        stack.append(frame.f_code)
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def task_stack(task) -> list:
+    stack = []
+    awaitable = task.get_coro()
+    while awaitable is not None:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "gi_frame", None)
+        if frame is None:
+            break
+        stack.append(frame.f_code)
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "gi_yieldfrom", None)
+    return stack
+
+def is_idle_await(stack: list) -> bool:
+    leaf = stack[-1]
+    if os.path.basename(os.path.dirname(leaf.co_filename)) == "asyncio" and leaf.co_name in IDLE_AWAIT_FUNCTIONS:
+        return True
+    return any(code.co_name == "get_updates" for code in stack)
+
+def record_sample(samples: dict, kind: str, stack: list, weight=1, leaf=None):
+    labels = [kind] + [frame_label(code) for code in stack] + ([leaf] if leaf else [])
+    key = ";".join(labels)
+    samples[key] = samples.get(key, 0) + weight
+
+def cpu_sampler(loop_thread_id: int, samples: dict, stop: threading.Event):
+    sqlite_codes = (TimedCursor.execute.__code__, TimedCursor.executemany.__code__)
+    while not stop.wait(PROFILE_INTERVAL):
+        frame = sys._current_frames().get(loop_thread_id)
+        if frame is None:
+            continue
+        stack = thread_stack(frame)
+        if os.path.basename(stack[-1].co_filename) == "selectors.py":
+            continue  # loop bo'sh: selector da kutmoqda
+        # C darajadagi sqlite3 chaqiruvi Python stekida ko'rinmaydi: alohida barg sifatida
+        record_sample(samples, "cpu", stack, leaf="sqlite3" if stack[-1] in sqlite_codes else None)
+
+async def await_sampler(samples: dict, seconds: float):
+    deadline = time.monotonic() + seconds
+    previous = time.monotonic()
+    while (now := time.monotonic()) < deadline:
+        # Loop band bo'lgan vaqt ham hisobga kirishi uchun namuna o'tgan vaqt bilan tortiladi
+        weight = max(1, round((now - previous) / PROFILE_INTERVAL))
+        previous = now
+        current = asyncio.current_task()
+        for task in asyncio.all_tasks():
+            if task is current:
+                continue
+            stack = task_stack(task)
+            if stack and not is_idle_await(stack):
+                record_sample(samples, "await", stack, weight)
+        await asyncio.sleep(PROFILE_INTERVAL)
+
+async def run_profiler(seconds: float) -> dict:
+    if profiler_state["running"]:
+        raise RuntimeError("Profiler allaqachon ishlamoqda")
+    profiler_state["running"] = True
+    # Har bir oqim o'z lug'atiga yozadi; oxirida birlashtiriladi (kalitlar "cpu;"/"await;" bilan farqlanadi)
+    samples, cpu_samples = {}, {}
+    stop = threading.Event()
+    sampler = threading.Thread(target=cpu_sampler, args=(threading.get_ident(), cpu_samples, stop), name="profiler", daemon=True)
+    try:
+        sampler.start()
+        await await_sampler(samples, seconds)
+    finally:
+        stop.set()
+        await asyncio.to_thread(sampler.join)
+        profiler_state["running"] = False
+    samples.update(cpu_samples)
+    return samples
+
+def format_profile_top(samples: dict, seconds: float, limit=PROFILE_TOP_N) -> str:
+    lines = [f"Profil: {seconds:g} s, har {PROFILE_INTERVAL * 1000:g} ms", "ustunlar: jami% (ichidagilar bilan), o'zi%, funksiya"]
+    for kind, title in (("cpu", "CPU (loop oqimi)"), ("await", "Kutish (await)")):
+        stacks = [(key.split(";")[1:], count) for key, count in samples.items() if key.startswith(kind + ";")]
+        total = sum(count for _, count in stacks)
+        lines += ["", f"{title}: {total} namuna"]
+        if not total:
+            continue
+        inclusive, own = {}, {}
+        for frames, count in stacks:
+            for label in set(frames):
+                inclusive[label] = inclusive.get(label, 0) + count
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+        for label, count in sorted(inclusive.items(), key=lambda item: item[1], reverse=True)[:limit]:
+            lines.append(f"{count * 100 / total:5.1f}% {own.get(label, 0) * 100 / total:5.1f}%  {label}")
+    return "\n".join(lines)
+
+# Callback prefikslari (dinamik qismi metrikaga kirmaydi)
+CALLBACK_PREFIXES = ("lang_", "block_", "unblock_", "report_media_", "inbox_media_", "inbox_older_", "inbox_newer_")
+
+def handler_label(update: Update) -> str:
+    if update.callback_query and update.callback_query.data:
+        data = update.callback_query.data
+        for prefix in CALLBACK_PREFIXES:
+            if data.startswith(prefix):
+                return f"callback:{prefix}"
+        return f"callback:{data}"
+    return "message"
+
+def instrumented(callback, label=None):
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        start_time = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            observe_latency(handler_latency, label or handler_label(update), time.perf_counter() - start_time)
+    return wrapper
+
+# Umumiy holat o'zgarishlari (ban, sozlamalar va h.k.). Sharded rejimda
+# o'zgarish boshqa worker jarayonlariga ham yuboriladi.
+state_listeners = {}  # tur -> [callback(key)]
+state_outbox = None  # sharded rejimda dispatcherga boruvchi navbat
+worker_shard = None  # sharded rejimda joriy worker raqami
+
+def on_state_change(kind: str, callback):
+    state_listeners.setdefault(kind, []).append(callback)
+
+def apply_state_change(kind: str, key=None):
+    for callback in state_listeners.get(kind, []):
+        callback(key)
+
+def publish_state_change(kind: str, key=None):
+    # Faqat boshqa workerlarga yuboradi
+    if state_outbox is not None:
+        state_outbox.put((worker_shard, kind, key))
+
+def notify_state_change(kind: str, key=None):
+    apply_state_change(kind, key)
+    publish_state_change(kind, key)
+
+class LRUCache:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
 
 # SQLite bazasiga ulanish
-def get_db_connection():
-    conn = sqlite3.connect("bot.db")
+def get_db_connection(path=DB_PATH):
+    conn = sqlite3.connect(path, factory=TimedConnection)
     conn.row_factory = sqlite3.Row
     return conn
 
-# Jadvalarni yaratish va migration
-def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+# Sxema migratsiyalari: PRAGMA user_version bo'yicha tartiblangan qadamlar.
+# Har bir qadam idempotent, faqat sxema orqada qolganda ishlaydi.
+def migration_initial_schema(cursor):
     # Users table
     cursor.execute('''CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY)''')
     
@@ -88,29 +726,1212 @@ def init_db():
     
     # Dastlabki qiymatni o'rnatish, agar mavjud bo'lmasa
     cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('notify_blocks', 'on')")
-    
-    conn.commit()
-    conn.close()
 
-init_db()
+def migration_deliveries(cursor):
+    # Yetkazilgan anonim xabar/javoblar: (chat_id, telegram message_id) -> yuboruvchi
+    cursor.execute('''CREATE TABLE IF NOT EXISTS deliveries (
+        chat_id INTEGER, delivered_message_id INTEGER, sender_id INTEGER, message_id TEXT,
+        PRIMARY KEY (chat_id, delivered_message_id)
+    ) WITHOUT ROWID''')
+
+def migration_messages_fts(cursor):
+    # messages.text va caption bo'yicha FTS5 indeks (external content), triggerlar orqali sinxron.
+    # content_rowid keyinroq migration_messages_integer_key da barqaror 'id' ustuniga o'tkaziladi.
+    cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text, caption, content='messages', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+    )''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, text, caption) VALUES (new.rowid, new.text, new.caption);
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text, caption) VALUES ('delete', old.rowid, old.text, old.caption);
+    END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text, caption ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text, caption) VALUES ('delete', old.rowid, old.text, old.caption);
+        INSERT INTO messages_fts (rowid, text, caption) VALUES (new.rowid, new.text, new.caption);
+    END''')
+    # Mavjud xabarlarni indekslash
+    cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+def migration_users_last_seen(cursor):
+    # Oxirgi faollik vaqti va broadcast segmentlari uchun indekslar
+    cursor.execute("PRAGMA table_info(users)")
+    if 'last_seen' not in [col[1] for col in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE users ADD COLUMN last_seen DATETIME")
+    cursor.execute("CREATE INDEX IF NOT EXISTS users_last_seen_idx ON users (last_seen)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS users_language_seen_idx ON users (language, last_seen)")
+
+def migration_users_inactive(cursor):
+    # Botni bloklagan (Forbidden) foydalanuvchilar broadcastlardan chiqariladi
+    cursor.execute("PRAGMA table_info(users)")
+    if 'inactive' not in [col[1] for col in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE users ADD COLUMN inactive INTEGER DEFAULT 0")
+
+def migration_outbox(cursor):
+    # Anonim xabarlar yetkazish navbati; next_attempt NULL - yetkazib bo'lmadi (dead)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, message_id TEXT UNIQUE, chat_id INTEGER, sender_id INTEGER,
+        payload TEXT, attempts INTEGER DEFAULT 0, next_attempt REAL, last_error TEXT,
+        created DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS outbox_due_idx ON outbox (next_attempt)")
+
+def migration_messages_receiver_index(cursor):
+    # Indeks kaliti (receiver_id, rowid): inbox sahifasi va count_messages uchun diapazon skani
+    cursor.execute("CREATE INDEX IF NOT EXISTS messages_receiver_idx ON messages (receiver_id)")
+
+def migration_channel_members(cursor):
+    # channel: kanal kaliti ("-100..." yoki "@username", kichik harfda) - sozlamadagi ID bilan bir xil ko'rinishda
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS channel_members (
+            channel TEXT,
+            user_id INTEGER,
+            status TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (user_id, channel)
+        ) WITHOUT ROWID
+    ''')
+
+def migration_messages_integer_key(cursor):
+    # FTS5 external content yashirin rowid ga tayansa, VACUUM uni qayta raqamlaydi va indeks boshqa
+    # xabarlarga ishora qilib qoladi. Jadval aniq INTEGER PRIMARY KEY bilan qayta quriladi:
+    # id = eski rowid, shuning uchun row_key qiymatlari (sahifa kursorlari) o'zgarmaydi.
+    for trigger in ("messages_fts_insert", "messages_fts_delete", "messages_fts_update"):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.execute("DROP TABLE IF EXISTS messages_fts")
+    cursor.execute('''CREATE TABLE messages_new (
+        id INTEGER PRIMARY KEY, message_id TEXT UNIQUE, sender_id INTEGER, receiver_id INTEGER, text TEXT,
+        media_type TEXT, file_id TEXT, caption TEXT,
+        sender_name TEXT, sender_username TEXT, receiver_name TEXT, receiver_username TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+    columns = ("message_id, sender_id, receiver_id, text, media_type, file_id, caption, "
+               "sender_name, sender_username, receiver_name, receiver_username, timestamp")
+    cursor.execute(f"INSERT INTO messages_new (id, {columns}) SELECT rowid, {columns} FROM messages")
+    cursor.execute("DROP TABLE messages")
+    cursor.execute("ALTER TABLE messages_new RENAME TO messages")
+    cursor.execute("CREATE INDEX IF NOT EXISTS messages_receiver_idx ON messages (receiver_id)")
+    cursor.execute('''CREATE VIRTUAL TABLE messages_fts USING fts5(
+        text, caption, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )''')
+    cursor.execute('''CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, text, caption) VALUES (new.id, new.text, new.caption);
+    END''')
+    cursor.execute('''CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text, caption) VALUES ('delete', old.id, old.text, old.caption);
+    END''')
+    cursor.execute('''CREATE TRIGGER messages_fts_update AFTER UPDATE OF text, caption ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text, caption) VALUES ('delete', old.id, old.text, old.caption);
+        INSERT INTO messages_fts (rowid, text, caption) VALUES (new.id, new.text, new.caption);
+    END''')
+    cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+# Yangi migratsiyalar faqat ro'yxat oxiriga qo'shiladi
+MIGRATIONS = [
+    migration_initial_schema,
+    migration_deliveries,
+    migration_messages_fts,
+    migration_users_last_seen,
+    migration_users_inactive,
+    migration_outbox,
+    migration_messages_receiver_index,
+    migration_channel_members,
+    migration_messages_integer_key,
+]
+
+def init_db(path=DB_PATH) -> int:
+    conn = get_db_connection(path)
+    try:
+        # WAL: bir nechta jarayon bir vaqtda o'qiydi va yozadi
+        conn.execute("PRAGMA journal_mode=WAL")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+            conn.execute("BEGIN")
+            migration(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+            print(f"Migratsiya {number} ({migration.__name__}) bajarildi")
+            version = number
+    finally:
+        conn.close()
+    return version
+
+# Backenddan mustaqil xatolar: handlerlar sqlite3 xatolariga bog'lanmaydi
+class StorageError(Exception):
+    pass
+
+class DuplicateKeyError(StorageError):
+    pass
+
+# Qidiruv so'rovi sintaksisi noto'g'ri (masalan, yopilmagan qo'shtirnoq)
+class QueryError(StorageError):
+    pass
+
+# Ma'lumotlar ombori interfeysi. Handlerlar faqat shu interfeysga bog'liq:
+# SqliteStorage - asosiy backend, MemoryStorage - testlar va benchmarklar uchun.
+class Storage(ABC):
+    @abstractmethod
+    def migrate(self) -> int:
+        ...
+
+    # Health tekshiruvi: baza javob beryaptimi
+    @abstractmethod
+    def ping(self) -> bool:
+        ...
+
+    # Settings
+    @abstractmethod
+    def get_setting(self, key: str, default=None):
+        ...
+
+    @abstractmethod
+    def set_setting(self, key: str, value: str):
+        ...
+
+    # Users
+    @abstractmethod
+    def add_user(self, user_id: int, language='uz', first_name=None, username=None):
+        ...
+
+    @abstractmethod
+    def get_user(self, user_id: int):
+        ...
+
+    @abstractmethod
+    def update_user_info(self, user_id: int, first_name: str, username: str):
+        ...
+
+    @abstractmethod
+    def set_user_language(self, user_id: int, language: str):
+        ...
+
+    @abstractmethod
+    def find_user_by_custom_ref(self, custom_ref: str):
+        ...
+
+    @abstractmethod
+    def set_custom_ref(self, user_id: int, custom_ref: str) -> bool:
+        ...
+
+    @abstractmethod
+    def count_users(self) -> int:
+        ...
+
+    @abstractmethod
+    def touch_users(self, seen: dict):
+        ...
+
+    @abstractmethod
+    def mark_inactive(self, user_ids):
+        ...
+
+    # Broadcast segmenti: ban qilinmagan va faol foydalanuvchilar id bo'yicha sahifalab,
+    # har bir sahifa (array('q') id lar, tillar) juftligi
+    @abstractmethod
+    def iter_recipient_chunks(self, language=None, active_days=None, min_referrals=None, batch_size=None):
+        ...
+
+    @abstractmethod
+    def count_recipients(self, language=None, active_days=None, min_referrals=None) -> int:
+        ...
+
+    @abstractmethod
+    def top_users(self, limit: int) -> list:
+        ...
+
+    @abstractmethod
+    def get_popularity_rank(self, user_id: int) -> int:
+        ...
+
+    # Bans
+    @abstractmethod
+    def ban_user(self, user_id: int):
+        ...
+
+    @abstractmethod
+    def unban_user(self, user_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    def is_user_banned(self, user_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    def count_banned(self) -> int:
+        ...
+
+    # Blacklists
+    @abstractmethod
+    def block_user(self, blocker_id: int, blocked_id: int):
+        ...
+
+    @abstractmethod
+    def unblock_user(self, blocker_id: int, blocked_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    def clear_blacklist(self, blocker_id: int) -> int:
+        ...
+
+    @abstractmethod
+    def is_user_blocked(self, blocker_id: int, blocked_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    def count_blacklist(self, blocker_id: int) -> int:
+        ...
+
+    @abstractmethod
+    def get_blacklist(self, blocker_id: int) -> set:
+        ...
+
+    # Channels
+    @abstractmethod
+    def get_channels(self) -> list:
+        ...
+
+    @abstractmethod
+    def set_channels(self, channels: list):
+        ...
+
+    # Messages
+    @abstractmethod
+    def add_message(self, message: dict):
+        ...
+
+    @abstractmethod
+    def get_message(self, message_id: str):
+        ...
+
+    @abstractmethod
+    def count_messages(self, receiver_id=None, day=None) -> int:
+        ...
+
+    # Qabul qilingan xabarlar, yangilari birinchi. before - eskiroq sahifa, after - yangiroq sahifa (row_key bo'yicha)
+    @abstractmethod
+    def list_inbox(self, receiver_id: int, before=None, after=None, limit=5) -> list:
+        ...
+
+    @abstractmethod
+    def add_delivery(self, chat_id: int, delivered_message_id: int, sender_id: int, message_id=None):
+        ...
+
+    # Kanal a'zoligi: chat_member update laridan yig'iladi; natija channel -> status
+    @abstractmethod
+    def get_memberships(self, user_id: int, channels) -> dict:
+        ...
+
+    @abstractmethod
+    def set_membership(self, channels, user_id: int, status: str):
+        ...
+
+    @abstractmethod
+    def get_delivery(self, chat_id: int, delivered_message_id: int):
+        ...
+
+    # Outbox: xabar va yetkazish vazifasi bitta tranzaksiyada yoziladi
+    @abstractmethod
+    def enqueue_outbox(self, message: dict, chat_id: int, payload: str) -> bool:
+        ...
+
+    # Muddati kelgan qatorlarni lease bilan band qilish (boshqa jarayonlar olmaydi).
+    # Qaytgan next_attempt - lease egaligi belgisi: quyidagi metodlar faqat u o'zgarmagan bo'lsa yozadi.
+    @abstractmethod
+    def claim_outbox(self, now: float, lease: float, limit: int) -> list:
+        ...
+
+    @abstractmethod
+    def renew_outbox_lease(self, outbox_id: int, lease_until: float, new_lease_until: float) -> bool:
+        ...
+
+    # Albom bir nechta xabar bo'lib yetkaziladi: har biriga reply qilish mumkin
+    @abstractmethod
+    def complete_outbox(self, outbox_id: int, delivered_message_ids: list, lease_until: float):
+        ...
+
+    @abstractmethod
+    def reschedule_outbox(self, outbox_id: int, next_attempt, error: str, lease_until: float):
+        ...
+
+    @abstractmethod
+    def count_outbox(self) -> int:
+        ...
+
+    # Dead qatorlar (next_attempt NULL): admin qayta navbatga qo'yadi yoki o'chiradi
+    @abstractmethod
+    def count_dead_outbox(self) -> int:
+        ...
+
+    @abstractmethod
+    def retry_dead_outbox(self, now: float) -> int:
+        ...
+
+    @abstractmethod
+    def purge_dead_outbox(self) -> int:
+        ...
+
+    # To'liq matnli qidiruv: eng yangi xabarlardan boshlab, before - oldingi sahifaning oxirgi row_key qiymati
+    @abstractmethod
+    def search_messages(self, query: str, since=None, until=None, before=None, limit=10) -> list:
+        ...
+
+    # Sessions
+    @abstractmethod
+    def get_session(self, user_id: int):
+        ...
+
+    @abstractmethod
+    def set_session(self, user_id: int, step: str, data: str):
+        ...
+
+    @abstractmethod
+    def set_session_step(self, user_id: int, step: str):
+        ...
+
+    @abstractmethod
+    def delete_session(self, user_id: int):
+        ...
+
+    # Referrals
+    @abstractmethod
+    def add_referral_visit(self, referrer_id: int, visitor_id: int):
+        ...
+
+    @abstractmethod
+    def add_referral(self, referrer_id: int, referred_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    def count_referrals(self, referrer_id: int) -> int:
+        ...
+
+    @abstractmethod
+    def count_referral_visitors(self, referrer_id: int, day: str) -> int:
+        ...
+
+    # Eksport: qatorlarni sahifalab (keyset) qaytaruvchi generator
+    @abstractmethod
+    def iter_export(self, kind: str, since=None, until=None, batch_size=None):
+        ...
+
+MESSAGE_COLUMNS = ("message_id", "sender_id", "receiver_id", "text", "media_type", "file_id", "caption",
+                   "sender_name", "sender_username", "receiver_name", "receiver_username")
+
+# Eksport turlari: jadval, ustunlar va sana filtri ustuni (users jadvalida sana yo'q)
+EXPORT_TABLES = {
+    "users": ("users", ("id", "language", "referrals", "custom_ref", "first_name", "username"), None),
+    "messages": ("messages", MESSAGE_COLUMNS + ("timestamp",), "timestamp"),
+    "referrals": ("referrals", ("referrer_id", "referred_id", "timestamp"), "timestamp"),
+    "blacklists": ("user_blacklists", ("blocker_id", "blocked_id", "timestamp"), "timestamp"),
+}
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+RECIPIENT_BATCH_SIZE = int(os.getenv('RECIPIENT_BATCH_SIZE', '1000'))
+
+# FTS5 snippet() belgilari: HTML ga o'tkazishda <b> bilan almashtiriladi
+SNIPPET_OPEN, SNIPPET_CLOSE = "\x02", "\x03"
+
+class SqliteStorage(Storage):
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        # Har bir jarayonda bitta ulanish, birinchi murojaatda ochiladi
+        if self._conn is None:
+            self._conn = get_db_connection(self.path)
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def migrate(self) -> int:
+        return init_db(self.path)
+
+    def ping(self):
+        return self._scalar("SELECT COUNT(*) FROM sqlite_master") >= 0
+
+    def _fetchone(self, sql, parameters=()):
+        return self.conn.execute(sql, parameters).fetchone()
+
+    def _scalar(self, sql, parameters=()):
+        return self._fetchone(sql, parameters)[0]
+
+    def _write(self, sql, parameters=()) -> int:
+        with self.conn:
+            return self.conn.execute(sql, parameters).rowcount
+
+    def get_setting(self, key, default=None):
+        row = self._fetchone("SELECT value FROM settings WHERE key = ?", (key,))
+        return row['value'] if row else default
+
+    def set_setting(self, key, value):
+        self._write("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+    def add_user(self, user_id, language='uz', first_name=None, username=None):
+        self._write("INSERT OR IGNORE INTO users (id, language, first_name, username) VALUES (?, ?, ?, ?)", (user_id, language, first_name, username))
+
+    def get_user(self, user_id):
+        return self._fetchone("SELECT * FROM users WHERE id = ?", (user_id,))
+
+    def update_user_info(self, user_id, first_name, username):
+        self._write("UPDATE users SET first_name = ?, username = ? WHERE id = ?", (first_name, username, user_id))
+
+    def set_user_language(self, user_id, language):
+        self._write("UPDATE users SET language = ? WHERE id = ?", (language, user_id))
+
+    def find_user_by_custom_ref(self, custom_ref):
+        row = self._fetchone("SELECT id FROM users WHERE custom_ref = ?", (custom_ref,))
+        return row['id'] if row else None
+
+    def set_custom_ref(self, user_id, custom_ref):
+        try:
+            self._write("UPDATE users SET custom_ref = ? WHERE id = ?", (custom_ref, user_id))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def count_users(self):
+        return self._scalar("SELECT COUNT(*) FROM users")
+
+    def touch_users(self, seen):
+        # Qaytib kelgan foydalanuvchi botni blokdan chiqargan bo'ladi
+        with self.conn:
+            self.conn.executemany("UPDATE users SET last_seen = ?, inactive = 0 WHERE id = ?", [(ts, user_id) for user_id, ts in seen.items()])
+
+    def mark_inactive(self, user_ids):
+        with self.conn:
+            self.conn.executemany("UPDATE users SET inactive = 1 WHERE id = ?", [(user_id,) for user_id in user_ids])
+
+    def _segment_conditions(self, language, active_days, min_referrals):
+        conditions, parameters = ["inactive = 0", "id NOT IN (SELECT user_id FROM banned_users)"], []
+        if language:
+            conditions.append("language = ?")
+            parameters.append(language)
+        if active_days:
+            conditions.append("last_seen >= datetime('now', ?)")
+            parameters.append(f"-{int(active_days)} days")
+        if min_referrals:
+            conditions.append("referrals >= ?")
+            parameters.append(min_referrals)
+        return conditions, parameters
+
+    def iter_recipient_chunks(self, language=None, active_days=None, min_referrals=None, batch_size=None):
+        batch_size = batch_size or RECIPIENT_BATCH_SIZE
+        conditions, parameters = self._segment_conditions(language, active_days, min_referrals)
+        sql = f"SELECT id, language FROM users WHERE id > ? AND {' AND '.join(conditions)} ORDER BY id LIMIT ?"
+        last_id = -1
+        while True:
+            rows = self.conn.execute(sql, (last_id, *parameters, batch_size)).fetchall()
+            if not rows:
+                return
+            yield array('q', (row[0] for row in rows)), [row[1] for row in rows]
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    def count_recipients(self, language=None, active_days=None, min_referrals=None):
+        conditions, parameters = self._segment_conditions(language, active_days, min_referrals)
+        return self._scalar(f"SELECT COUNT(*) FROM users WHERE {' AND '.join(conditions)}", parameters)
+
+    def top_users(self, limit):
+        return self.conn.execute("""
+            SELECT u.id, u.first_name, u.username, COUNT(r.referred_id) as cnt
+            FROM users u LEFT JOIN referrals r ON u.id = r.referrer_id
+            GROUP BY u.id
+            ORDER BY cnt DESC
+            LIMIT ?
+        """, (limit,)).fetchall()
+
+    def get_popularity_rank(self, user_id):
+        ranks = self.conn.execute("""
+            SELECT u.id, COUNT(r.referred_id) as cnt
+            FROM users u LEFT JOIN referrals r ON u.id = r.referrer_id
+            GROUP BY u.id
+            ORDER BY cnt DESC
+        """).fetchall()
+        rank_dict = {row['id']: i+1 for i, row in enumerate(ranks)}
+        return rank_dict.get(user_id, len(ranks) + 1)
+
+    def ban_user(self, user_id):
+        self._write("INSERT OR IGNORE INTO banned_users (user_id) VALUES (?)", (user_id,))
+
+    def unban_user(self, user_id):
+        return self._write("DELETE FROM banned_users WHERE user_id = ?", (user_id,)) > 0
+
+    def is_user_banned(self, user_id):
+        return bool(self._fetchone("SELECT 1 FROM banned_users WHERE user_id = ?", (user_id,)))
+
+    def count_banned(self):
+        return self._scalar("SELECT COUNT(*) FROM banned_users")
+
+    def block_user(self, blocker_id, blocked_id):
+        self._write("INSERT OR IGNORE INTO user_blacklists (blocker_id, blocked_id) VALUES (?, ?)", (blocker_id, blocked_id))
+
+    def unblock_user(self, blocker_id, blocked_id):
+        return self._write("DELETE FROM user_blacklists WHERE blocker_id = ? AND blocked_id = ?", (blocker_id, blocked_id)) > 0
+
+    def clear_blacklist(self, blocker_id):
+        return self._write("DELETE FROM user_blacklists WHERE blocker_id = ?", (blocker_id,))
+
+    def is_user_blocked(self, blocker_id, blocked_id):
+        return bool(self._fetchone("SELECT 1 FROM user_blacklists WHERE blocker_id = ? AND blocked_id = ?", (blocker_id, blocked_id)))
+
+    def count_blacklist(self, blocker_id):
+        return self._scalar("SELECT COUNT(*) FROM user_blacklists WHERE blocker_id = ?", (blocker_id,))
+
+    def get_blacklist(self, blocker_id):
+        return {row[0] for row in self.conn.execute("SELECT blocked_id FROM user_blacklists WHERE blocker_id = ?", (blocker_id,))}
+
+    def get_channels(self):
+        return self.conn.execute("SELECT id, link, name FROM channels").fetchall()
+
+    def set_channels(self, channels):
+        with self.conn:
+            self.conn.execute("DELETE FROM channels")
+            for channel in channels:
+                self.conn.execute("INSERT INTO channels (id, link, name) VALUES (?, ?, ?)",
+                                  (channel["id"], channel["link"], channel["name"]))
+
+    def add_message(self, message):
+        try:
+            self._write(f"INSERT INTO messages ({', '.join(MESSAGE_COLUMNS)}) VALUES ({', '.join('?' * len(MESSAGE_COLUMNS))})",
+                        tuple(message.get(column) for column in MESSAGE_COLUMNS))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(str(e)) from e
+
+    def get_message(self, message_id):
+        return self._fetchone("SELECT * FROM messages WHERE message_id = ?", (message_id,))
+
+    def count_messages(self, receiver_id=None, day=None):
+        if receiver_id is None:
+            return self._scalar("SELECT COUNT(*) FROM messages")
+        if day is None:
+            return self._scalar("SELECT COUNT(*) FROM messages WHERE receiver_id = ?", (receiver_id,))
+        return self._scalar("SELECT COUNT(*) FROM messages WHERE receiver_id = ? AND DATE(timestamp) = ?", (receiver_id, day))
+
+    def list_inbox(self, receiver_id, before=None, after=None, limit=5):
+        columns = "rowid AS row_key, message_id, text, media_type, file_id, caption, timestamp"
+        if after is not None:
+            rows = self.conn.execute(f"SELECT {columns} FROM messages WHERE receiver_id = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                                     (receiver_id, after, limit)).fetchall()
+            return rows[::-1]
+        return self.conn.execute(f"SELECT {columns} FROM messages WHERE receiver_id = ? AND rowid < ? ORDER BY rowid DESC LIMIT ?",
+                                 (receiver_id, before if before is not None else 2 ** 63 - 1, limit)).fetchall()
+
+    def add_delivery(self, chat_id, delivered_message_id, sender_id, message_id=None):
+        self._write("INSERT OR REPLACE INTO deliveries (chat_id, delivered_message_id, sender_id, message_id) VALUES (?, ?, ?, ?)",
+                    (chat_id, delivered_message_id, sender_id, message_id))
+
+    def get_memberships(self, user_id, channels):
+        channels = list(channels)
+        rows = self.conn.execute(f"SELECT channel, status FROM channel_members WHERE user_id = ? AND channel IN ({', '.join('?' * len(channels))})",
+                                 (user_id, *channels)).fetchall()
+        return {row['channel']: row['status'] for row in rows}
+
+    def set_membership(self, channels, user_id, status):
+        updated_at = utc_timestamp()
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO channel_members (channel, user_id, status, updated_at) VALUES (?, ?, ?, ?)",
+                                  [(channel, user_id, status, updated_at) for channel in channels])
+
+    def get_delivery(self, chat_id, delivered_message_id):
+        return self._fetchone("SELECT sender_id, message_id FROM deliveries WHERE chat_id = ? AND delivered_message_id = ?",
+                              (chat_id, delivered_message_id))
+
+    def enqueue_outbox(self, message, chat_id, payload):
+        with self.conn:
+            try:
+                self.conn.execute(f"INSERT INTO messages ({', '.join(MESSAGE_COLUMNS)}) VALUES ({', '.join('?' * len(MESSAGE_COLUMNS))})",
+                                  tuple(message.get(column) for column in MESSAGE_COLUMNS))
+            except sqlite3.IntegrityError:
+                # Takroriy update (qayta ishga tushirishdan keyin): allaqachon navbatda
+                return False
+            self.conn.execute("INSERT INTO outbox (message_id, chat_id, sender_id, payload, next_attempt) VALUES (?, ?, ?, ?, ?)",
+                              (message["message_id"], chat_id, message["sender_id"], payload, time.time()))
+        return True
+
+    def claim_outbox(self, now, lease, limit):
+        with self.conn:
+            return self.conn.execute("""
+                UPDATE outbox SET next_attempt = ?
+                WHERE id IN (SELECT id FROM outbox WHERE next_attempt <= ? ORDER BY next_attempt LIMIT ?)
+                RETURNING id, message_id, chat_id, sender_id, payload, attempts, next_attempt
+            """, (now + lease, now, limit)).fetchall()
+
+    def renew_outbox_lease(self, outbox_id, lease_until, new_lease_until):
+        with self.conn:
+            return self.conn.execute("UPDATE outbox SET next_attempt = ? WHERE id = ? AND next_attempt = ?",
+                                     (new_lease_until, outbox_id, lease_until)).rowcount == 1
+
+    def complete_outbox(self, outbox_id, delivered_message_ids, lease_until):
+        with self.conn:
+            self.conn.executemany("""
+                INSERT OR REPLACE INTO deliveries (chat_id, delivered_message_id, sender_id, message_id)
+                SELECT chat_id, ?, sender_id, message_id FROM outbox WHERE id = ?
+            """, [(delivered_message_id, outbox_id) for delivered_message_id in delivered_message_ids])
+            self.conn.execute("DELETE FROM outbox WHERE id = ? AND next_attempt = ?", (outbox_id, lease_until))
+
+    def reschedule_outbox(self, outbox_id, next_attempt, error, lease_until):
+        self._write("UPDATE outbox SET attempts = attempts + 1, next_attempt = ?, last_error = ? WHERE id = ? AND next_attempt = ?",
+                    (next_attempt, error, outbox_id, lease_until))
+
+    def count_outbox(self):
+        return self._scalar("SELECT COUNT(*) FROM outbox WHERE next_attempt IS NOT NULL")
+
+    def count_dead_outbox(self):
+        return self._scalar("SELECT COUNT(*) FROM outbox WHERE next_attempt IS NULL")
+
+    def retry_dead_outbox(self, now):
+        return self._write("UPDATE outbox SET attempts = 0, next_attempt = ? WHERE next_attempt IS NULL", (now,))
+
+    def purge_dead_outbox(self):
+        return self._write("DELETE FROM outbox WHERE next_attempt IS NULL")
+
+    def search_messages(self, query, since=None, until=None, before=None, limit=10):
+        try:
+            return self._search_messages(query, since, until, before, limit)
+        except sqlite3.OperationalError as e:
+            # FTS5 so'rov tahlilchisi xatolari (fts5: syntax error, unterminated string, ...)
+            raise QueryError(str(e)) from e
+
+    def _search_messages(self, query, since, until, before, limit):
+        conditions, parameters = ["messages_fts MATCH ?"], [query]
+        if before is not None:
+            conditions.append("messages_fts.rowid < ?")
+            parameters.append(before)
+        if since:
+            conditions.append("m.timestamp >= ?")
+            parameters.append(since)
+        if until:
+            conditions.append("m.timestamp < ?")
+            parameters.append(until)
+        return self.conn.execute(f"""
+            SELECT m.rowid AS row_key, m.message_id, m.sender_id, m.receiver_id, m.media_type,
+                   m.sender_name, m.sender_username, m.receiver_name, m.receiver_username, m.timestamp,
+                   snippet(messages_fts, -1, ?, ?, '…', 16) AS snippet
+            FROM messages_fts JOIN messages m ON m.rowid = messages_fts.rowid
+            WHERE {' AND '.join(conditions)}
+            ORDER BY messages_fts.rowid DESC
+            LIMIT ?
+        """, (SNIPPET_OPEN, SNIPPET_CLOSE, *parameters, limit)).fetchall()
+
+    def get_session(self, user_id):
+        return self._fetchone("SELECT step, data FROM sessions WHERE user_id = ?", (user_id,))
+
+    def set_session(self, user_id, step, data):
+        self._write("INSERT OR REPLACE INTO sessions (user_id, step, data) VALUES (?, ?, ?)", (user_id, step, data))
+
+    def set_session_step(self, user_id, step):
+        self._write("UPDATE sessions SET step = ? WHERE user_id = ?", (step, user_id))
+
+    def delete_session(self, user_id):
+        self._write("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def add_referral_visit(self, referrer_id, visitor_id):
+        self._write("INSERT INTO referral_visits (referrer_id, visitor_id) VALUES (?, ?)", (referrer_id, visitor_id))
+
+    def add_referral(self, referrer_id, referred_id):
+        with self.conn:
+            cursor = self.conn.execute("INSERT OR IGNORE INTO referrals (referrer_id, referred_id) VALUES (?, ?)", (referrer_id, referred_id))
+            if cursor.rowcount > 0:
+                self.conn.execute("UPDATE users SET referrals = referrals + 1 WHERE id = ?", (referrer_id,))
+                return True
+        return False
+
+    def count_referrals(self, referrer_id):
+        return self._scalar("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (referrer_id,))
+
+    def count_referral_visitors(self, referrer_id, day):
+        return self._scalar("SELECT COUNT(DISTINCT visitor_id) FROM referral_visits WHERE referrer_id = ? AND DATE(timestamp) = ?", (referrer_id, day))
+
+    def iter_export(self, kind, since=None, until=None, batch_size=None):
+        table, columns, date_column = EXPORT_TABLES[kind]
+        batch_size = batch_size or EXPORT_BATCH_SIZE
+        conditions, parameters = ["rowid > ?"], []
+        if date_column and since:
+            conditions.append(f"{date_column} >= ?")
+            parameters.append(since)
+        if date_column and until:
+            conditions.append(f"{date_column} < ?")
+            parameters.append(until)
+        sql = (f"SELECT rowid AS row_key, {', '.join(columns)} FROM {table} WHERE {' AND '.join(conditions)} "
+               f"ORDER BY rowid LIMIT ?")
+        # Eksport alohida oqimda ishlaydi, shuning uchun o'z ulanishi bilan
+        conn = get_db_connection(self.path)
+        try:
+            last_rowid = 0
+            while True:
+                rows = conn.execute(sql, (last_rowid, *parameters, batch_size)).fetchall()
+                for row in rows:
+                    yield {column: row[column] for column in columns}
+                if len(rows) < batch_size:
+                    break
+                last_rowid = rows[-1]["row_key"]
+        finally:
+            conn.close()
+
+def utc_timestamp() -> str:
+    # SQLite CURRENT_TIMESTAMP bilan bir xil format
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.settings = {'notify_blocks': 'on'}
+        self.users = {}  # id -> dict
+        self.banned = set()
+        self.blacklists = {}  # blocker_id -> {blocked_id: timestamp}
+        self.channels = []
+        self.messages = {}  # message_id -> dict
+        self.sessions = {}  # user_id -> dict(step, data)
+        self.referrals = {}  # referrer_id -> {referred_id: timestamp}
+        self.referral_visits = []  # (referrer_id, visitor_id, timestamp)
+        self.deliveries = {}  # (chat_id, delivered_message_id) -> dict
+        self.outbox = {}  # id -> dict
+        self.channel_members = {}  # (user_id, channel) -> status
+
+    def migrate(self):
+        return len(MIGRATIONS)
+
+    def ping(self):
+        return True
+
+    def get_setting(self, key, default=None):
+        return self.settings.get(key, default)
+
+    def set_setting(self, key, value):
+        self.settings[key] = value
+
+    def add_user(self, user_id, language='uz', first_name=None, username=None):
+        if user_id not in self.users:
+            self.users[user_id] = {"id": user_id, "language": language, "referrals": 0, "custom_ref": None,
+                                   "first_name": first_name, "username": username, "last_seen": None, "inactive": 0}
+
+    def get_user(self, user_id):
+        return self.users.get(user_id)
+
+    def update_user_info(self, user_id, first_name, username):
+        if user_id in self.users:
+            self.users[user_id].update(first_name=first_name, username=username)
+
+    def set_user_language(self, user_id, language):
+        if user_id in self.users:
+            self.users[user_id]["language"] = language
+
+    def find_user_by_custom_ref(self, custom_ref):
+        for user in self.users.values():
+            if user["custom_ref"] == custom_ref:
+                return user["id"]
+        return None
+
+    def set_custom_ref(self, user_id, custom_ref):
+        owner = self.find_user_by_custom_ref(custom_ref)
+        if owner is not None and owner != user_id:
+            return False
+        if user_id in self.users:
+            self.users[user_id]["custom_ref"] = custom_ref
+        return True
+
+    def count_users(self):
+        return len(self.users)
+
+    def touch_users(self, seen):
+        for user_id, ts in seen.items():
+            if user_id in self.users:
+                self.users[user_id].update(last_seen=ts, inactive=0)
+
+    def mark_inactive(self, user_ids):
+        for user_id in user_ids:
+            if user_id in self.users:
+                self.users[user_id]["inactive"] = 1
+
+    def _segment_match(self, user, language, threshold, min_referrals):
+        return (not user["inactive"] and user["id"] not in self.banned
+                and (not language or user["language"] == language)
+                and (not threshold or (user["last_seen"] or "") >= threshold)
+                and (not min_referrals or user["referrals"] >= min_referrals))
+
+    def iter_recipient_chunks(self, language=None, active_days=None, min_referrals=None, batch_size=None):
+        batch_size = batch_size or RECIPIENT_BATCH_SIZE
+        threshold = (datetime.utcnow() - timedelta(days=active_days)).strftime("%Y-%m-%d %H:%M:%S") if active_days else None
+        ids, languages = array('q'), []
+        for user_id in array('q', sorted(self.users)):
+            user = self.users.get(user_id)
+            if user and self._segment_match(user, language, threshold, min_referrals):
+                ids.append(user_id)
+                languages.append(user["language"])
+                if len(ids) >= batch_size:
+                    yield ids, languages
+                    ids, languages = array('q'), []
+        if ids:
+            yield ids, languages
+
+    def count_recipients(self, language=None, active_days=None, min_referrals=None):
+        threshold = (datetime.utcnow() - timedelta(days=active_days)).strftime("%Y-%m-%d %H:%M:%S") if active_days else None
+        return sum(1 for user in self.users.values() if self._segment_match(user, language, threshold, min_referrals))
+
+    def _referral_counts(self):
+        counts = [(user_id, len(self.referrals.get(user_id, ()))) for user_id in self.users]
+        counts.sort(key=lambda item: item[1], reverse=True)
+        return counts
+
+    def top_users(self, limit):
+        return [dict(self.users[user_id], cnt=cnt) for user_id, cnt in self._referral_counts()[:limit]]
+
+    def get_popularity_rank(self, user_id):
+        counts = self._referral_counts()
+        for i, (uid, _) in enumerate(counts, 1):
+            if uid == user_id:
+                return i
+        return len(counts) + 1
+
+    def ban_user(self, user_id):
+        self.banned.add(user_id)
+
+    def unban_user(self, user_id):
+        if user_id in self.banned:
+            self.banned.discard(user_id)
+            return True
+        return False
+
+    def is_user_banned(self, user_id):
+        return user_id in self.banned
+
+    def count_banned(self):
+        return len(self.banned)
+
+    def block_user(self, blocker_id, blocked_id):
+        self.blacklists.setdefault(blocker_id, {}).setdefault(blocked_id, utc_timestamp())
+
+    def unblock_user(self, blocker_id, blocked_id):
+        return self.blacklists.get(blocker_id, {}).pop(blocked_id, None) is not None
+
+    def clear_blacklist(self, blocker_id):
+        return len(self.blacklists.pop(blocker_id, {}))
+
+    def is_user_blocked(self, blocker_id, blocked_id):
+        return blocked_id in self.blacklists.get(blocker_id, {})
+
+    def count_blacklist(self, blocker_id):
+        return len(self.blacklists.get(blocker_id, {}))
+
+    def get_blacklist(self, blocker_id):
+        return set(self.blacklists.get(blocker_id, ()))
+
+    def get_channels(self):
+        return list(self.channels)
+
+    def set_channels(self, channels):
+        self.channels = [{"id": c["id"], "link": c["link"], "name": c["name"]} for c in channels]
+
+    def add_message(self, message):
+        if message["message_id"] in self.messages:
+            raise DuplicateKeyError(f"messages.message_id: {message['message_id']}")
+        row = {column: message.get(column) for column in MESSAGE_COLUMNS}
+        row["timestamp"] = utc_timestamp()
+        self.messages[message["message_id"]] = row
+
+    def get_message(self, message_id):
+        return self.messages.get(message_id)
+
+    def count_messages(self, receiver_id=None, day=None):
+        if receiver_id is None:
+            return len(self.messages)
+        return sum(1 for m in self.messages.values()
+                   if m["receiver_id"] == receiver_id and (day is None or m["timestamp"][:10] == day))
+
+    def list_inbox(self, receiver_id, before=None, after=None, limit=5):
+        rows = [dict(m, row_key=row_key) for row_key, m in enumerate(self.messages.values(), 1) if m["receiver_id"] == receiver_id]
+        if after is not None:
+            return [row for row in rows if row["row_key"] > after][:limit][::-1]
+        return [row for row in reversed(rows) if before is None or row["row_key"] < before][:limit]
+
+    def add_delivery(self, chat_id, delivered_message_id, sender_id, message_id=None):
+        self.deliveries[(chat_id, delivered_message_id)] = {"sender_id": sender_id, "message_id": message_id}
+
+    def get_delivery(self, chat_id, delivered_message_id):
+        return self.deliveries.get((chat_id, delivered_message_id))
+
+    def get_memberships(self, user_id, channels):
+        return {channel: self.channel_members[(user_id, channel)] for channel in channels if (user_id, channel) in self.channel_members}
+
+    def set_membership(self, channels, user_id, status):
+        for channel in channels:
+            self.channel_members[(user_id, channel)] = status
+
+    def enqueue_outbox(self, message, chat_id, payload):
+        try:
+            self.add_message(message)
+        except DuplicateKeyError:
+            return False
+        outbox_id = max(self.outbox, default=0) + 1
+        self.outbox[outbox_id] = {"id": outbox_id, "message_id": message["message_id"], "chat_id": chat_id,
+                                  "sender_id": message["sender_id"], "payload": payload, "attempts": 0,
+                                  "next_attempt": time.time(), "last_error": None}
+        return True
+
+    def claim_outbox(self, now, lease, limit):
+        due = sorted((row for row in self.outbox.values() if row["next_attempt"] is not None and row["next_attempt"] <= now),
+                     key=lambda row: row["next_attempt"])[:limit]
+        for row in due:
+            row["next_attempt"] = now + lease
+        return [dict(row) for row in due]
+
+    def _owns_outbox(self, outbox_id, lease_until):
+        return outbox_id in self.outbox and self.outbox[outbox_id]["next_attempt"] == lease_until
+
+    def renew_outbox_lease(self, outbox_id, lease_until, new_lease_until):
+        if not self._owns_outbox(outbox_id, lease_until):
+            return False
+        self.outbox[outbox_id]["next_attempt"] = new_lease_until
+        return True
+
+    def complete_outbox(self, outbox_id, delivered_message_ids, lease_until):
+        row = self.outbox.get(outbox_id)
+        if row:
+            for delivered_message_id in delivered_message_ids:
+                self.add_delivery(row["chat_id"], delivered_message_id, row["sender_id"], row["message_id"])
+        if self._owns_outbox(outbox_id, lease_until):
+            del self.outbox[outbox_id]
+
+    def reschedule_outbox(self, outbox_id, next_attempt, error, lease_until):
+        if self._owns_outbox(outbox_id, lease_until):
+            self.outbox[outbox_id].update(attempts=self.outbox[outbox_id]["attempts"] + 1, next_attempt=next_attempt, last_error=error)
+
+    def count_outbox(self):
+        return sum(1 for row in self.outbox.values() if row["next_attempt"] is not None)
+
+    def count_dead_outbox(self):
+        return sum(1 for row in self.outbox.values() if row["next_attempt"] is None)
+
+    def retry_dead_outbox(self, now):
+        dead = [row for row in self.outbox.values() if row["next_attempt"] is None]
+        for row in dead:
+            row.update(attempts=0, next_attempt=now)
+        return len(dead)
+
+    def purge_dead_outbox(self):
+        dead = [outbox_id for outbox_id, row in self.outbox.items() if row["next_attempt"] is None]
+        for outbox_id in dead:
+            del self.outbox[outbox_id]
+        return len(dead)
+
+    def search_messages(self, query, since=None, until=None, before=None, limit=10):
+        # FTS5 sintaksisining soddalashtirilgan varianti: "ibora", prefiks* va oddiy so'zlar (AND)
+        if query.count('"') % 2:
+            raise QueryError("unterminated string")
+        terms = [phrase or word for phrase, word in re.findall(r'"([^"]*)"|(\S+)', query.lower())]
+        results = []
+        rows = list(self.messages.values())
+        for row_key in range(len(rows), 0, -1):
+            if before is not None and row_key >= before:
+                continue
+            row = rows[row_key - 1]
+            if (since and row["timestamp"] < since) or (until and row["timestamp"] >= until):
+                continue
+            content = f"{row['text'] or ''} {row['caption'] or ''}".lower()
+            words = re.findall(r"\w+", content)
+            if all(term[:-1] and any(w.startswith(term[:-1]) for w in words) if term.endswith("*")
+                   else (term in content if " " in term else term in words) for term in terms):
+                results.append(dict(row, row_key=row_key, snippet=content.strip()[:120]))
+                if len(results) >= limit:
+                    break
+        return results
+
+    def get_session(self, user_id):
+        return self.sessions.get(user_id)
+
+    def set_session(self, user_id, step, data):
+        self.sessions[user_id] = {"step": step, "data": data}
+
+    def set_session_step(self, user_id, step):
+        if user_id in self.sessions:
+            self.sessions[user_id]["step"] = step
+
+    def delete_session(self, user_id):
+        self.sessions.pop(user_id, None)
+
+    def add_referral_visit(self, referrer_id, visitor_id):
+        self.referral_visits.append((referrer_id, visitor_id, utc_timestamp()))
+
+    def add_referral(self, referrer_id, referred_id):
+        referred = self.referrals.setdefault(referrer_id, {})
+        if referred_id in referred:
+            return False
+        referred[referred_id] = utc_timestamp()
+        if referrer_id in self.users:
+            self.users[referrer_id]["referrals"] += 1
+        return True
+
+    def count_referrals(self, referrer_id):
+        return len(self.referrals.get(referrer_id, ()))
+
+    def count_referral_visitors(self, referrer_id, day):
+        return len({visitor for referrer, visitor, ts in self.referral_visits if referrer == referrer_id and ts[:10] == day})
+
+    def iter_export(self, kind, since=None, until=None, batch_size=None):
+        if kind == "users":
+            rows = [self.users[user_id] for user_id in sorted(self.users)]
+        elif kind == "messages":
+            rows = list(self.messages.values())
+        elif kind == "referrals":
+            rows = [{"referrer_id": referrer, "referred_id": referred, "timestamp": ts}
+                    for referrer, referred_map in list(self.referrals.items()) for referred, ts in list(referred_map.items())]
+        else:
+            rows = [{"blocker_id": blocker, "blocked_id": blocked, "timestamp": ts}
+                    for blocker, blocked_map in list(self.blacklists.items()) for blocked, ts in list(blocked_map.items())]
+        _, columns, date_column = EXPORT_TABLES[kind]
+        for row in rows:
+            if date_column and ((since and row[date_column] < since) or (until and row[date_column] >= until)):
+                continue
+            yield {column: row.get(column) for column in columns}
+
+def create_storage(kind: str, path: str = DB_PATH) -> Storage:
+    if kind == 'memory':
+        return MemoryStorage()
+    if kind == 'sqlite':
+        return SqliteStorage(path)
+    raise ValueError(f"Noma'lum storage turi: {kind}")
+
+# Bir jarayonda bir nechta bot: har bir bot (tenant) o'z tokeni, admini, bazasi
+# va username iga ega. Botga tegishli holat (storage, keshlar, navbatlar)
+# TenantLocal orqali olinadi: qiymat joriy tenant uchun birinchi murojaatda
+# yaratiladi. Joriy tenant ContextVar da turadi; bot Application i shu
+# kontekstda ishga tushirilgani uchun uning barcha tasklari uni meros oladi.
+class Tenant:
+    def __init__(self, name: str, token: str, admin_id: int, username: str, db_path: str):
+        self.name = name
+        self.token = token
+        self.admin_id = admin_id
+        self.username = username
+        self.db_path = db_path
+        self.state = {}  # TenantLocal nomi -> qiymat
+
+default_tenant = Tenant("default", BOT_TOKEN, ADMIN_ID, BOT_USERNAME, DB_PATH)
+current_tenant = contextvars.ContextVar("current_tenant", default=default_tenant)
+
+def tenant() -> Tenant:
+    return current_tenant.get()
+
+# Shu jarayonda ishlayotgan botlar (post_init qo'shadi, post_shutdown olib tashlaydi)
+active_tenants = []
+
+def running_tenants() -> list:
+    return active_tenants or [tenant()]
+
+@contextlib.contextmanager
+def use_tenant(bot_tenant: Tenant):
+    token = current_tenant.set(bot_tenant)
+    try:
+        yield
+    finally:
+        current_tenant.reset(token)
+
+def load_tenants(path: str) -> list:
+    # [{"name": ..., "token": ..., "admin_id": ..., "username": ..., "db_path": ...}, ...]
+    with open(path, encoding="utf-8") as bots_file:
+        entries = json.load(bots_file)
+    return [Tenant(entry["name"], entry["token"], int(entry["admin_id"]), entry["username"],
+                   entry.get("db_path") or f"{entry['name']}.db") for entry in entries]
+
+class TenantLocal:
+    def __init__(self, name: str, factory):
+        self._name = name
+        self._factory = factory
+
+    def _value(self):
+        state = tenant().state
+        if self._name not in state:
+            state[self._name] = self._factory()
+        return state[self._name]
+
+    def __getattr__(self, attr):
+        return getattr(self._value(), attr)
+
+    def __getitem__(self, key):
+        return self._value()[key]
+
+    def __setitem__(self, key, value):
+        self._value()[key] = value
+
+    def __contains__(self, key):
+        return key in self._value()
+
+    def __len__(self):
+        return len(self._value())
+
+    def __bool__(self):
+        return bool(self._value())
+
+    def __iter__(self):
+        return iter(self._value())
+
+storage = TenantLocal("storage", lambda: create_storage(STORAGE, tenant().db_path))
+# Application ga bog'liq navbatlar (update_queue, ApiGovernor) har bir bot uchun alohida
+tenant_queue_depths = TenantLocal("queue_depths", dict)
+
+# Sozlamalar va kanallar juda kam o'zgaradi: birinchi murojaatda xotiraga
+# yuklanadi, yozish registr orqali o'tadi va qiymat bitta almashtirish bilan
+# yangilanadi. Obunachilar (masalan, klaviatura keshi) o'zgarish kalitini
+# oladi, boshqa workerlar esa "config" holat o'zgarishi bilan qayta yuklaydi.
+class ConfigRegistry:
+    # Obunachilar barcha botlar uchun umumiy: ular o'zgartirgan bot kontekstida chaqiriladi
+    subscribers = []
+
+    def __init__(self):
+        self.settings = {}
+        self.channels = None
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def _notify(self, key):
+        for callback in self.subscribers:
+            callback(key)
+
+    def get_setting(self, key: str, default=None):
+        if key not in self.settings:
+            self.settings[key] = storage.get_setting(key, default)
+        return self.settings[key]
+
+    def set_setting(self, key: str, value: str):
+        storage.set_setting(key, value)
+        self.settings[key] = value
+        self._notify(key)
+        publish_state_change("config", key)
+
+    def get_channels(self) -> tuple:
+        if self.channels is None:
+            self.channels = tuple({"id": row["id"], "link": row["link"], "name": row["name"]} for row in storage.get_channels())
+        return self.channels
+
+    def set_channels(self, channels: list):
+        storage.set_channels(channels)
+        self.channels = tuple({"id": c["id"], "link": c["link"], "name": c["name"]} for c in channels)
+        self._notify("channels")
+        publish_state_change("config", "channels")
+
+    def invalidate(self, key):
+        # Boshqa worker o'zgartirdi: keyingi o'qishda bazadan olinadi
+        if key == "channels":
+            self.channels = None
+        else:
+            self.settings.pop(key, None)
+        self._notify(key)
+
+config = TenantLocal("config", ConfigRegistry)
+on_state_change("config", lambda key: config.invalidate(key))
 
 # Bloklash bildirishnomasini yoqilganligini tekshirish funksiyasi
 def is_notify_blocks_enabled():
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM settings WHERE key = 'notify_blocks'")
-        row = cursor.fetchone()
-        return row['value'] == 'on' if row else True  # Default: on
+    return config.get_setting('notify_blocks', 'on') == 'on'  # Default: on
 
 # Bloklash bildirishnomasini toggle qilish
 def toggle_notify_blocks():
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM settings WHERE key = 'notify_blocks'")
-        row = cursor.fetchone()
-        new_value = 'off' if row and row['value'] == 'on' else 'on'
-        cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('notify_blocks', ?)", (new_value,))
-        conn.commit()
+    new_value = 'off' if is_notify_blocks_enabled() else 'on'
+    config.set_setting('notify_blocks', new_value)
     return new_value
 
 def encode_user_id(uid: int) -> str:
@@ -122,112 +1943,117 @@ def decode_user_id(code: str) -> int:
     except Exception:
         raise ValueError("Noto'g'ri havola kodi")
 
+# Referal kodlari keshi (ikki tomonlama): kod -> user_id va user_id -> kod.
+# url_command custom_ref ni o'zgartirganda invalidate_ref_cache chaqiriladi.
+REF_CACHE_SIZE = int(os.getenv('REF_CACHE_SIZE', '50000'))
+ref_code_cache = TenantLocal("ref_code_cache", lambda: LRUCache(REF_CACHE_SIZE))  # kod -> user_id
+ref_user_cache = TenantLocal("ref_user_cache", lambda: LRUCache(REF_CACHE_SIZE))  # user_id -> kod
+
+def resolve_ref_code(code: str):
+    user_id = storage.find_user_by_custom_ref(code)
+    if user_id is not None:
+        return user_id
+    try:
+        decoded = decode_user_id(code)
+        user = storage.get_user(decoded)
+        if user and user['custom_ref'] is None:
+            return decoded
+    except:
+        pass
+    return None
+
 def get_user_from_ref(code: str) -> int:
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM users WHERE custom_ref = ?", (code,))
-        row = cursor.fetchone()
-        if row:
-            return row['id']
-        try:
-            decoded = decode_user_id(code)
-            cursor.execute("SELECT id FROM users WHERE id = ? AND custom_ref IS NULL", (decoded,))
-            row = cursor.fetchone()
-            if row:
-                return decoded
-        except:
-            pass
-    raise ValueError("Noto'g'ri havola kodi")
+    user_id = ref_code_cache.get(code)
+    if user_id is None:
+        user_id = resolve_ref_code(code)
+        if user_id is None:
+            raise ValueError("Noto'g'ri havola kodi")
+        ref_code_cache.put(code, user_id)
+    return user_id
+
+def get_ref_code(user_id: int) -> str:
+    code = ref_user_cache.get(user_id)
+    if code is None:
+        user = storage.get_user(user_id)
+        custom_ref = user['custom_ref'] if user else None
+        code = custom_ref or encode_user_id(user_id)
+        ref_user_cache.put(user_id, code)
+    return code
 
 def get_ref_link(user_id: int) -> str:
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT custom_ref FROM users WHERE id = ?", (user_id,))
-        row = cursor.fetchone()
-        custom_ref = row['custom_ref'] if row else None
-    if custom_ref:
-        return f"https://t.me/{BOT_USERNAME}?start={custom_ref}"
-    else:
-        return f"https://t.me/{BOT_USERNAME}?start={encode_user_id(user_id)}"
+    return f"https://t.me/{tenant().username}?start={get_ref_code(user_id)}"
+
+def invalidate_ref_cache(user_id: int):
+    ref_user_cache.pop(user_id)
+    # Kamdan-kam holat (link o'zgarishi), shuning uchun to'liq ko'rib chiqish yetarli
+    for code in [code for code, uid in ref_code_cache.items.items() if uid == user_id]:
+        ref_code_cache.pop(code)
+
+on_state_change("ref", invalidate_ref_cache)
 
 def add_user_to_db(user_id: int, language='uz', first_name=None, username=None):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT OR IGNORE INTO users (id, language, first_name, username) VALUES (?, ?, ?, ?)", (user_id, language, first_name, username))
-        conn.commit()
+    storage.add_user(user_id, language, first_name, username)
 
 def update_user_info(user_id: int, first_name: str, username: str):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET first_name = ?, username = ? WHERE id = ?", (first_name, username, user_id))
-        conn.commit()
+    storage.update_user_info(user_id, first_name, username)
 
 def update_user_language(user_id: int, language: str):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET language = ? WHERE id = ?", (language, user_id))
-        conn.commit()
+    storage.set_user_language(user_id, language)
 
 def get_user_language(user_id: int) -> str:
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT language FROM users WHERE id = ?", (user_id,))
-        row = cursor.fetchone()
-        return row['language'] if row else 'uz'
+    user = storage.get_user(user_id)
+    return user['language'] if user else 'uz'
 
 def is_user_banned(user_id: int) -> bool:
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM banned_users WHERE user_id = ?", (user_id,))
-        return bool(cursor.fetchone())
+    return storage.is_user_banned(user_id)
+
+# Qabul qiluvchilarning qora ro'yxatlari xotirada (LRU). Birinchi murojaatda
+# yuklanadi, block/unblock/clear orqali yangilanadi.
+BLACKLIST_CACHE_SIZE = int(os.getenv('BLACKLIST_CACHE_SIZE', '10000'))
+blacklist_cache = TenantLocal("blacklist_cache", lambda: LRUCache(BLACKLIST_CACHE_SIZE))  # blocker_id -> set(blocked_id)
+
+def get_cached_blacklist(blocker_id: int) -> set:
+    blocked = blacklist_cache.get(blocker_id)
+    if blocked is None:
+        blocked = storage.get_blacklist(blocker_id)
+        blacklist_cache.put(blocker_id, blocked)
+    return blocked
+
+# Boshqa workerdagi o'zgarish: keshdagi nusxa eskirgan
+on_state_change("blacklist", lambda blocker_id: blacklist_cache.pop(blocker_id, None))
 
 def is_user_blocked(blocker_id: int, blocked_id: int) -> bool:
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM user_blacklists WHERE blocker_id = ? AND blocked_id = ?", (blocker_id, blocked_id))
-        return bool(cursor.fetchone())
+    return blocked_id in get_cached_blacklist(blocker_id)
 
 def block_user(blocker_id: int, blocked_id: int):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT OR IGNORE INTO user_blacklists (blocker_id, blocked_id) VALUES (?, ?)", (blocker_id, blocked_id))
-        conn.commit()
+    storage.block_user(blocker_id, blocked_id)
+    if blocker_id in blacklist_cache:
+        blacklist_cache.get(blocker_id).add(blocked_id)
+    publish_state_change("blacklist", blocker_id)
 
 def unblock_user(blocker_id: int, blocked_id: int) -> bool:
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM user_blacklists WHERE blocker_id = ? AND blocked_id = ?", (blocker_id, blocked_id))
-        deleted = cursor.rowcount > 0
-        conn.commit()
-        return deleted
+    deleted = storage.unblock_user(blocker_id, blocked_id)
+    if blocker_id in blacklist_cache:
+        blacklist_cache.get(blocker_id).discard(blocked_id)
+    publish_state_change("blacklist", blocker_id)
+    return deleted
 
 def clear_blacklist(blocker_id: int) -> int:
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM user_blacklists WHERE blocker_id = ?", (blocker_id,))
-        deleted_count = cursor.rowcount
-        conn.commit()
-        return deleted_count
+    deleted_count = storage.clear_blacklist(blocker_id)
+    if blocker_id in blacklist_cache:
+        blacklist_cache.get(blocker_id).clear()
+    publish_state_change("blacklist", blocker_id)
+    return deleted_count
 
 def get_blacklist_count(blocker_id: int) -> int:
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM user_blacklists WHERE blocker_id = ?", (blocker_id,))
-        return cursor.fetchone()[0]
+    return len(get_cached_blacklist(blocker_id))
 
+# Ban holati keshlanmaydi (har safar bazadan o'qiladi): workerlarga xabar kerak emas
 def ban_user(user_id: int):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("INSERT OR IGNORE INTO banned_users (user_id) VALUES (?)", (user_id,))
-        conn.commit()
+    storage.ban_user(user_id)
 
 def unban_user(user_id: int) -> bool:
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM banned_users WHERE user_id = ?", (user_id,))
-        deleted = cursor.rowcount > 0
-        conn.commit()
-        return deleted
+    return storage.unban_user(user_id)
 
 def is_valid_url(url: str) -> bool:
     regex = r'^https?://[^\s/$.?#].[^\s]*$'
@@ -282,38 +2108,77 @@ def serialize_poll(poll: Poll) -> dict:
         "type": poll.type
     }
 
-async def check_channel_membership(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM channels")
-        channels = [row["id"] for row in cursor.fetchall()]
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+def channel_keys(chat) -> list:
+    # Sozlamada kanal "-100..." yoki "@username" ko'rinishida bo'lishi mumkin: ikkalasiga ham yoziladi
+    keys = [str(chat.id)]
+    if chat.username:
+        keys.append(f"@{chat.username}".lower())
+    return keys
+
+def channel_key(channel_id) -> str:
+    return str(channel_id).lower()
+
+def membership_status(member) -> str:
+    # Cheklangan, lekin kanalda qolgan foydalanuvchi a'zo hisoblanadi
+    return "member" if member.status == "restricted" and member.is_member else member.status
+
+async def track_channel_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Bot kanalda admin bo'lsa Telegram har bir qo'shilish/chiqishni yuboradi
+    change = update.chat_member
+    keys = channel_keys(change.chat)
+    # Faqat majburiy kanallar: bot admin bo'lgan boshqa chatlar jadvalni to'ldirmaydi
+    configured = {channel_key(channel["id"]) for channel in config.get_channels()}
+    if configured.isdisjoint(keys):
+        return
+    member = change.new_chat_member
+    storage.set_membership(keys, member.user.id, membership_status(member))
+
+async def check_channel_membership(user_id: int, context: ContextTypes.DEFAULT_TYPE, refresh=False) -> bool:
+    # Mahalliy jadvaldan bitta so'rov; get_chat_member faqat hali ko'rilmagan (yoki refresh da a'zo bo'lmagan) kanallar uchun
+    channels = config.get_channels()
     if not channels:
         return True
-    for channel_id in channels:
+    known = storage.get_memberships(user_id, [channel_key(channel["id"]) for channel in channels])
+    for channel_id in (channel["id"] for channel in channels):
+        status = known.get(channel_key(channel_id))
+        if status in MEMBER_STATUSES:
+            continue
+        if status is not None and not refresh:
+            return False
         try:
             member = await context.bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-            if member.status not in ["member", "administrator", "creator"]:
-                return False
         except Exception:
             return False
+        # A'zo bo'lmagan holat ham yoziladi: keyingi xabarlar API ga bormaydi (refresh va chat_member yangilaydi)
+        status = membership_status(member)
+        storage.set_membership([channel_key(channel_id)], user_id, status)
+        if status not in MEMBER_STATUSES:
+            return False
     return True
 
+# Til -> tayyor klaviatura; kanallar o'zgarganda tozalanadi
+channels_keyboard_cache = TenantLocal("channels_keyboard_cache", dict)
+config.subscribe(lambda key: channels_keyboard_cache.clear() if key == "channels" else None)
+
 async def get_channels_keyboard(lang='uz') -> InlineKeyboardMarkup:
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT link FROM channels")
-        links = [row["link"] for row in cursor.fetchall()]
+    if lang in channels_keyboard_cache:
+        return channels_keyboard_cache[lang]
+    links = [channel["link"] for channel in config.get_channels()]
     join_text = "Qo'shilish" if lang == 'uz' else "Join" if lang == 'en' else "Присоединиться"
     check_text = "Tekshirish ✅" if lang == 'uz' else "Check ✅" if lang == 'en' else "Проверить ✅"
     keyboard = [[InlineKeyboardButton(join_text, url=link)] for link in links]
     keyboard.append([InlineKeyboardButton(check_text, callback_data="check_membership")])
-    return InlineKeyboardMarkup(keyboard)
+    channels_keyboard_cache[lang] = InlineKeyboardMarkup(keyboard)
+    return channels_keyboard_cache[lang]
 
 async def set_bot_commands(context: ContextTypes.DEFAULT_TYPE):
     commands = [
         BotCommand(command="start", description="✨ Referal havolangizni olish uchun"),
         BotCommand(command="lang", description="🏳️ Bot tilini tanlash"),
         BotCommand(command="mystats", description="📊 Profil statistikangizni ko'rish"),
+        BotCommand(command="inbox", description="📥 Kelgan xabarlarni ko'rish"),
         BotCommand(command="blacklist", description="📜 Qora ro‘yxatni ko'rish "),
         BotCommand(command="url", description="🔗 Referal linkni o'zgartirish"),
         BotCommand(command="help", description="❓ Yordam"),
@@ -321,7 +2186,7 @@ async def set_bot_commands(context: ContextTypes.DEFAULT_TYPE):
     await context.bot.set_my_commands(commands)
 
 def is_admin(user_id: int) -> bool:
-    return user_id == ADMIN_ID
+    return user_id == tenant().admin_id
 
 # Translations
 translations = {
@@ -360,6 +2225,9 @@ translations = {
         'thanks_subscribed': "Rahmat! Endi botdan foydalana olasiz.",
         'reply_prompt': "<b>Javobingizni yozing yoki media yuboring, u anonim tarzda yuboriladi!</b>",
         'message_not_found': "Xatolik! Xabar topilmadi.",
+        'inbox_title': "<b>📥 Sizga kelgan anonim xabarlar</b>",
+        'inbox_empty': "Sizga hali anonim xabar kelmagan.",
+        'album_actions': "⬆️ Anonim albom",
         'block': "Bloklash",
         'block_sent': "<b>Foydalanuvchi muvaffaqiyatli bloklandi. ✅</b>\n\n<blockquote>/blacklist - qora ro‘yxatni tozalash</blockquote>",
         'unblock': "Blokdan chiqarish",
@@ -367,6 +2235,8 @@ translations = {
         'clear_blacklist': "Qora ro‘yxatni tozalash 🗑",
         'blacklist_cleared': "Qora ro‘yxat muvaffaqiyatli tozalandi.",
         'broadcast_message_prompt': "Barcha foydalanuvchilarga yuboriladigan xabarni yoki mediayni kiriting:",
+        'broadcast_segment_prompt': "Qabul qiluvchilarni tanlang: <code>all</code> yoki filtrlar, masalan <code>lang=uz days=30 refs=5</code>\n(lang - til, days - oxirgi N kunda faol, refs - kamida N referal)",
+        'broadcast_segment_selected': "Tanlangan qabul qiluvchilar: {count}",
         'forward_message_prompt': "Forward qilinadigan xabarni yoki mediayni yuboring:",
         'ban_usage': "Iltimos, foydalanuvchi ID sini kiriting: /ban <user_id>",
         'banned_user': "Foydalanuvchi {user_id} bloklandi.",
@@ -398,6 +2268,7 @@ translations = {
         'congrats_referrals': "Tabriklaymiz 😊. Siz kamida 5ta odam taklif qilgansiz, endi referal havolangizni o'zgartirishingiz mumkin.",
         'prohibited_content': "<b>Bunday xabarni yuborish taqiqlangan!</b>",
         'broadcast_ask_media': "Matnga media qo'shmoqchimisiz?",
+        'flood_limited': "<b>Juda ko'p xabar yuboryapsiz. Birozdan so'ng qayta urinib ko'ring.</b>",
         'help_message': "Botda - xabardan tashqari rasm, video va ovozli xabar yuborish mumkin ✅\n<b>.apk fayllar, har xil havolalar, karta raqam, kontakt va videoxabar yuborish taqiqlangan.</b>\n\nSizga kelgan anonim xabarlarga odatdagi chatlar kabi <b>reply</b> qilib (chapga surib) anonim javob berishingiz mumkin.\n\nHavolani oʻzgartirmoqchi boʻlganingizda, bot sizga bergan birinchi havoladan kamida 5ta doʻstlaringiz foydalansa siz havolani oʻzgartira olishingiz mumkin. Buning uchun botga <b>/url yangihavola</b> kabi buyruq joʻnatishingiz kerak.",  # Placeholder for help text
     },
     'en': {
@@ -435,6 +2306,9 @@ translations = {
         'thanks_subscribed': "Thanks! You can now use the bot.",
         'reply_prompt': "<b>Write your reply or send media, it will be sent anonymously!</b>",
         'message_not_found': "Error! Message not found.",
+        'inbox_title': "<b>📥 Anonymous messages you received</b>",
+        'inbox_empty': "You have not received any anonymous messages yet.",
+        'album_actions': "⬆️ Anonymous album",
         'block': "Block",
         'block_sent': "<b>User successfully blocked. ✅</b>\n\n<blockquote>/blacklist - Clear blacklist</blockquote>",
         'unblock': "Unblock",
@@ -442,6 +2316,8 @@ translations = {
         'clear_blacklist': "Clear blacklist 🗑",
         'blacklist_cleared': "Blacklist successfully cleared.",
         'broadcast_message_prompt': "Enter the message or media to broadcast to all users:",
+        'broadcast_segment_prompt': "Choose recipients: <code>all</code> or filters, e.g. <code>lang=uz days=30 refs=5</code>\n(lang - language, days - active in the last N days, refs - at least N referrals)",
+        'broadcast_segment_selected': "Selected recipients: {count}",
         'forward_message_prompt': "Send the message or media to forward:",
         'ban_usage': "Please enter user ID: /ban <user_id>",
         'banned_user': "User {user_id} banned.",
@@ -473,6 +2349,7 @@ translations = {
         'congrats_referrals': "Congratulations 😊. You have invited at least 5 people, now you can change your referral link.",
         'prohibited_content': "<b>Sending such a message is prohibited!</b>",
         'broadcast_ask_media': "Do you want to add media to the text?",
+        'flood_limited': "<b>You are sending too many messages. Please try again later.</b>",
         'help_message': "In the bot, besides messages, you can send photos, videos, and voice messages ✅\n<b>.apk files, various links, card numbers, contacts, and video messages are prohibited.</b>\n\nYou can reply anonymously to the anonymous messages you receive, just like in regular chats, by using <b>reply</b> (swipe left).\n\nIf you want to change the link, you can only do so after at least 5 of your friends have used the first link provided by the bot. To do this, you need to send the bot a command like <b>/url newlink</b>.",  # Placeholder for help text
     },
     'ru': {
@@ -510,6 +2387,9 @@ translations = {
         'thanks_subscribed': "Спасибо! Теперь вы можете использовать бота.",
         'reply_prompt': "<b>Напишите ваш ответ или отправьте медиа, оно будет отправлено анонимно!</b>",
         'message_not_found': "Ошибка! Сообщение не найдено.",
+        'inbox_title': "<b>📥 Полученные анонимные сообщения</b>",
+        'inbox_empty': "Вы ещё не получали анонимных сообщений.",
+        'album_actions': "⬆️ Анонимный альбом",
         'block': "Заблокировать",
         'block_sent': "<b>Пользователь успешно заблокирован. ✅</b>\n\n<blockquote>/blacklist - Очистить черный список</blockquote>",
         'unblock': "Разблокировать",
@@ -517,6 +2397,8 @@ translations = {
         'clear_blacklist': "Очистить черный список 🗑",
         'blacklist_cleared': "Черный список успешно очищен.",
         'broadcast_message_prompt': "Введите сообщение или медиа для рассылки всем пользователям:",
+        'broadcast_segment_prompt': "Выберите получателей: <code>all</code> или фильтры, например <code>lang=uz days=30 refs=5</code>\n(lang - язык, days - активны за последние N дней, refs - не менее N рефералов)",
+        'broadcast_segment_selected': "Выбрано получателей: {count}",
         'forward_message_prompt': "Отправьте сообщение или медиа для пересылки:",
         'ban_usage': "Пожалуйста, введите ID пользователя: /ban <user_id>",
         'banned_user': "Пользователь {user_id} заблокирован.",
@@ -548,6 +2430,7 @@ translations = {
         'congrats_referrals': "Поздравляем 😊. Вы пригласили как минимум 5 человек, теперь вы можете изменить свою реферальную ссылку.",
         'prohibited_content': "<b>Отправка такого сообщения запрещена!</b>",
         'broadcast_ask_media': "Хотите добавить медиа к тексту?",
+        'flood_limited': "<b>Вы отправляете слишком много сообщений. Попробуйте позже.</b>",
         'help_message': "В боте, кроме сообщений, можно отправлять фото, видео и голосовые сообщения ✅\n<b>.apk файлы, различные ссылки, номера карт, контакты и видеосообщения отправлять запрещено.</b>\n\nНа анонимные сообщения, пришедшие вам, можно отвечать анонимно так же, как в обычных чатах, используя <b>reply</b> (свайп влево).\n\nЕсли вы захотите изменить ссылку, то сможете это сделать только после того, как минимум 5 ваших друзей воспользуются первой ссылкой, которую вы получили от бота. Для этого нужно отправить боту команду вида <b>/url newlink</b>.",  # Placeholder for help text
     }
 }
@@ -569,27 +2452,118 @@ def has_prohibited_content(content: str) -> bool:
         return True
     return False
 
-async def send_media_message(bot, chat_id, media_type, file_id, caption, text, reply_markup=None, entities=None, poll_data=None, lang='uz'):
+# Flood nazorati: sliding window, yuboruvchi va (yuboruvchi, qabul qiluvchi) juftligi bo'yicha
+FLOOD_WINDOW = float(os.getenv('FLOOD_WINDOW', '60'))  # soniya
+FLOOD_SENDER_LIMIT = int(os.getenv('FLOOD_SENDER_LIMIT', '30'))  # oynada bitta yuboruvchidan
+FLOOD_PAIR_LIMIT = int(os.getenv('FLOOD_PAIR_LIMIT', '10'))  # oynada bitta qabul qiluvchiga
+FLOOD_STATS_SIZE = int(os.getenv('FLOOD_STATS_SIZE', '1000'))  # /flood uchun saqlanadigan kalitlar
+
+class SlidingWindowLimiter:
+    def __init__(self, limit: int, window: float, stats_size=FLOOD_STATS_SIZE):
+        self.limit = limit
+        self.window = window
+        self.stats_size = stats_size
+        self.hits = {}  # key -> deque(vaqtlar)
+        # key -> rad etilganlar soni; oynadan mustaqil, eng uzoq rad etilmagan kalit chiqariladi
+        self.throttled = OrderedDict()
+        self.notified = {}  # key -> oxirgi ogohlantirish vaqti
+        self.last_purge = time.monotonic()
+
+    def hit(self, key) -> bool:
+        now = time.monotonic()
+        if now - self.last_purge > self.window:
+            self.purge(now)
+        hits = self.hits.get(key)
+        if hits is None:
+            hits = self.hits[key] = deque()
+        while hits and now - hits[0] >= self.window:
+            hits.popleft()
+        if len(hits) >= self.limit:
+            self.throttled[key] = self.throttled.pop(key, 0) + 1
+            if len(self.throttled) > self.stats_size:
+                self.throttled.popitem(last=False)
+            return False
+        hits.append(now)
+        return True
+
+    def should_notify(self, key) -> bool:
+        # Bitta oynada faqat bir marta javob beriladi
+        now = time.monotonic()
+        if now - self.notified.get(key, -self.window) >= self.window:
+            self.notified[key] = now
+            return True
+        return False
+
+    def purge(self, now: float):
+        self.last_purge = now
+        for key in [key for key, hits in self.hits.items() if not hits or now - hits[-1] >= self.window]:
+            del self.hits[key]
+        for key in [key for key, at in self.notified.items() if now - at >= self.window]:
+            del self.notified[key]
+
+sender_limiter = TenantLocal("sender_limiter", lambda: SlidingWindowLimiter(FLOOD_SENDER_LIMIT, FLOOD_WINDOW))
+pair_limiter = TenantLocal("pair_limiter", lambda: SlidingWindowLimiter(FLOOD_PAIR_LIMIT, FLOOD_WINDOW))
+
+async def reject_flood(update: Update, limiter: SlidingWindowLimiter, key, lang=None):
+    if limiter.should_notify(key):
+        await update.message.reply_text(get_translation(lang or get_user_language(update.effective_user.id), 'flood_limited'), parse_mode="HTML")
+
+async def check_pair_limit(update: Update, user_id: int, session) -> bool:
+    if session["step"] not in ("send", "reply") or is_admin(user_id):
+        return True
+    key = (user_id, int(session["data"]))
+    if pair_limiter.hit(key):
+        return True
+    await reject_flood(update, pair_limiter, key)
+    return False
+
+# Albom (media group) bitta mantiqiy xabar: media_type 'album', file_id - elementlar JSON ro'yxati
+ALBUM_MEDIA = {"photo": InputMediaPhoto, "video": InputMediaVideo, "document": InputMediaDocument, "audio": InputMediaAudio}
+
+def album_item(message) -> dict:
+    if message.photo:
+        return {"type": "photo", "file_id": message.photo[-1].file_id}
+    for media_type in ("video", "document", "audio"):
+        if getattr(message, media_type):
+            return {"type": media_type, "file_id": getattr(message, media_type).file_id}
+    return None
+
+def build_album_media(file_id: str, caption: str, caption_entities) -> list:
+    # Izoh faqat birinchi elementda: Telegram albom ostida shuni ko'rsatadi
+    return [ALBUM_MEDIA[item["type"]](item["file_id"], caption=caption if i == 0 else None,
+                                      caption_entities=caption_entities if i == 0 else None)
+            for i, item in enumerate(json.loads(file_id))]
+
+def sent_message_ids(sent) -> list:
+    # send_media_group xabarlar ro'yxatini, qolgan yuborish metodlari bitta Message qaytaradi
+    return [message.message_id for message in sent] if isinstance(sent, (list, tuple)) else [sent.message_id]
+
+# fallback=False: xato chaqiruvchiga ko'tariladi (outbox qayta urinadi), aks holda matnli zaxira xabar yuboriladi
+async def send_media_message(bot, chat_id, media_type, file_id, caption, text, reply_markup=None, entities=None, poll_data=None, lang='uz', fallback=True):
     try:
         caption_entities = deserialize_entities(entities)
-        if media_type == 'photo':
-            await bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption, reply_markup=reply_markup, caption_entities=caption_entities)
+        if media_type == 'album':
+            # send_media_group tugma qabul qilmaydi: reply_markup e'tiborsiz qoldiriladi.
+            # Albomning barcha xabarlari qaytariladi (sent_message_ids)
+            return await bot.send_media_group(chat_id=chat_id, media=build_album_media(file_id, caption, caption_entities))
+        elif media_type == 'photo':
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption, reply_markup=reply_markup, caption_entities=caption_entities)
         elif media_type == 'video':
-            await bot.send_video(chat_id=chat_id, video=file_id, caption=caption, reply_markup=reply_markup, caption_entities=caption_entities)
+            return await bot.send_video(chat_id=chat_id, video=file_id, caption=caption, reply_markup=reply_markup, caption_entities=caption_entities)
         elif media_type == 'document':
-            await bot.send_document(chat_id=chat_id, document=file_id, caption=caption, reply_markup=reply_markup, caption_entities=caption_entities)
+            return await bot.send_document(chat_id=chat_id, document=file_id, caption=caption, reply_markup=reply_markup, caption_entities=caption_entities)
         elif media_type == 'sticker':
-            await bot.send_sticker(chat_id=chat_id, sticker=file_id, reply_markup=reply_markup)
+            return await bot.send_sticker(chat_id=chat_id, sticker=file_id, reply_markup=reply_markup)
         elif media_type == 'audio':
-            await bot.send_audio(chat_id=chat_id, audio=file_id, caption=caption, reply_markup=reply_markup, caption_entities=caption_entities)
+            return await bot.send_audio(chat_id=chat_id, audio=file_id, caption=caption, reply_markup=reply_markup, caption_entities=caption_entities)
         elif media_type == 'animation':
-            await bot.send_animation(chat_id=chat_id, animation=file_id, caption=caption, reply_markup=reply_markup, caption_entities=caption_entities)
+            return await bot.send_animation(chat_id=chat_id, animation=file_id, caption=caption, reply_markup=reply_markup, caption_entities=caption_entities)
         elif media_type == 'voice':
-            await bot.send_voice(chat_id=chat_id, voice=file_id, caption=caption, reply_markup=reply_markup, caption_entities=caption_entities)
+            return await bot.send_voice(chat_id=chat_id, voice=file_id, caption=caption, reply_markup=reply_markup, caption_entities=caption_entities)
         elif media_type == 'video_note':
-            await bot.send_video_note(chat_id=chat_id, video_note=file_id, reply_markup=reply_markup)
+            return await bot.send_video_note(chat_id=chat_id, video_note=file_id, reply_markup=reply_markup)
         elif media_type == 'poll':
-            await bot.send_poll(
+            return await bot.send_poll(
                 chat_id=chat_id,
                 question=poll_data['question'],
                 options=poll_data['options'],
@@ -600,10 +2574,225 @@ async def send_media_message(bot, chat_id, media_type, file_id, caption, text, r
             )
         else:
             entities_list = deserialize_entities(entities)
-            await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, entities=entities_list)
+            return await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, entities=entities_list)
+    except Exception as e:
+        if not fallback:
+            raise
+        print(f"Media yuborishda xato: {e}")
+        return await bot.send_message(chat_id=chat_id, text=get_translation(lang, 'media_error') + text)
+
+# Admin uchun bloklash hisobotlari: callback yo'lidan tashqarida navbatga
+# qo'yiladi va davriy digest sifatida yuboriladi.
+BLOCK_DIGEST_INTERVAL = float(os.getenv('BLOCK_DIGEST_INTERVAL', '300'))  # soniya
+BLOCK_DIGEST_SIZE = int(os.getenv('BLOCK_DIGEST_SIZE', '50'))  # shuncha hisobot yig'ilsa darhol yuboriladi
+block_reports = TenantLocal("block_reports", list)
+block_reports_ready = TenantLocal("block_reports_ready", asyncio.Event)
+register_queue_depth("block_reports", lambda: len(block_reports))
+
+def queue_block_report(message):
+    block_reports.append(dict(message))
+    if len(block_reports) >= BLOCK_DIGEST_SIZE:
+        block_reports_ready.set()
+
+def format_block_digest(reports: list):
+    groups = {}
+    for report in reports:
+        groups.setdefault(report['sender_id'], []).append(report)
+    chunks, buttons = [], []
+    text = f"📢 <b>Bloklash hisobotlari</b>: {len(reports)} ta, {len(groups)} ta yuboruvchi\n\n"
+    for sender_id, items in sorted(groups.items(), key=lambda item: len(item[1]), reverse=True):
+        last = items[-1]
+        blockers = ", ".join(
+            f"<a href=\"tg://user?id={r['receiver_id']}\">{html.escape(r['receiver_name'] or str(r['receiver_id']))}</a>"
+            for r in items[:5]
+        )
+        entry = (
+            f"👤 <a href=\"tg://user?id={sender_id}\">{html.escape(last['sender_name'] or str(sender_id))}</a> "
+            f"@{html.escape(last['sender_username'] or '')} ID: <code>{sender_id}</code>\n"
+            f"🚫 {len(items)} marta bloklandi: {blockers}{' ...' if len(items) > 5 else ''}\n"
+            f"📜 {html.escape((last['text'] or '')[:200])}\n\n"
+        )
+        if len(text) + len(entry) > 4000:
+            chunks.append(text)
+            text = ""
+        text += entry
+        media = [r for r in items if r['media_type'] != 'text']
+        if media and len(buttons) < 10:
+            buttons.append([InlineKeyboardButton(f"📎 Media: {last['sender_name'] or sender_id}"[:60], callback_data=f"report_media_{media[-1]['message_id']}")])
+    chunks.append(text)
+    return chunks, buttons
+
+async def send_block_digest(bot):
+    if not block_reports:
+        return
+    reports = block_reports[:]
+    block_reports.clear()
+    chunks, buttons = format_block_digest(reports)
+    with api_lane(BULK_LANE):
+        for i, chunk in enumerate(chunks):
+            reply_markup = InlineKeyboardMarkup(buttons) if buttons and i == len(chunks) - 1 else None
+            await bot.send_message(chat_id=tenant().admin_id, text=chunk, parse_mode="HTML", reply_markup=reply_markup)
+
+async def block_digest_loop(bot):
+    while True:
+        try:
+            await asyncio.wait_for(block_reports_ready.wait(), timeout=BLOCK_DIGEST_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        block_reports_ready.clear()
+        try:
+            await send_block_digest(bot)
+        except Exception as e:
+            print(f"Bloklash digestini yuborishda xato: {e}")
+
+# Oxirgi faollik: har bir update uchun yozish o'rniga xotirada yig'iladi va
+# LAST_SEEN_FLUSH_INTERVAL da bir marta bitta tranzaksiyada saqlanadi.
+LAST_SEEN_FLUSH_INTERVAL = float(os.getenv('LAST_SEEN_FLUSH_INTERVAL', '60'))  # soniya
+last_seen_pending = TenantLocal("last_seen_pending", dict)
+register_queue_depth("last_seen_pending", lambda: len(last_seen_pending))
+
+async def record_last_seen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user:
+        last_seen_pending[update.effective_user.id] = utc_timestamp()
+
+def flush_last_seen():
+    if not last_seen_pending:
+        return
+    seen = dict(last_seen_pending)
+    last_seen_pending.clear()
+    storage.touch_users(seen)
+
+async def last_seen_flush_loop():
+    while True:
+        await asyncio.sleep(LAST_SEEN_FLUSH_INTERVAL)
+        try:
+            flush_last_seen()
+        except Exception as e:
+            print(f"last_seen yozishda xato: {e}")
+
+# Anonim xabarlar outbox orqali yetkaziladi: handler qatorni yozib darhol javob
+# beradi, fon workerlari yetkazadi va xatoda eksponensial kutish bilan qayta urinadi.
+# Band qilingan qator OUTBOX_LEASE dan keyin yana muddati kelgan hisoblanadi,
+# shuning uchun jarayon o'lsa ham xabar qayta ishga tushgach yetkaziladi.
+# Navbatga yozish idempotent (message_id UNIQUE), yetkazish esa kamida bir marta:
+# Bot API yuborish va complete_outbox bitta tranzaksiya emas, jarayon ular orasida
+# o'lsa lease tugagach xabar qayta yuboriladi (takror bo'lishi mumkin).
+# Yetkazib bo'lmagan (dead) qatorlar /outbox da ko'rinadi va qayta yuboriladi yoki o'chiriladi.
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '4'))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '20'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_BACKOFF_BASE = float(os.getenv('OUTBOX_BACKOFF_BASE', '2'))  # soniya
+OUTBOX_BACKOFF_MAX = float(os.getenv('OUTBOX_BACKOFF_MAX', '600'))  # soniya
+OUTBOX_LEASE = float(os.getenv('OUTBOX_LEASE', '120'))  # soniya
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '5'))  # soniya
+outbox_ready = TenantLocal("outbox_ready", asyncio.Event)
+register_queue_depth("outbox", lambda: storage.count_outbox())
+register_queue_depth("outbox_dead", lambda: storage.count_dead_outbox())
+
+async def deliver_outbox_row(bot, row):
+    payload = json.loads(row["payload"])
+    reply_markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton(get_translation(payload["lang"], 'block'), callback_data=f"block_{row['message_id']}")]
+    ])
+    if payload["media_type"] == 'text':
+        return await bot.send_message(chat_id=row["chat_id"], text=payload["text"], reply_markup=reply_markup,
+                                      entities=deserialize_entities(payload["entities"]))
+    if payload["media_type"] == 'album':
+        # Albomga tugma qo'yib bo'lmaydi: bloklash tugmasi albomga javob sifatida alohida xabarda
+        delivered = await send_media_message(bot, row["chat_id"], 'album', payload["file_id"], payload["caption"],
+                                             payload["text"], None, payload["entities"], None, payload["lang"], fallback=False)
+        actions = await bot.send_message(chat_id=row["chat_id"], text=get_translation(payload["lang"], 'album_actions'),
+                                         reply_markup=reply_markup, reply_to_message_id=delivered[0].message_id)
+        return [*delivered, actions]
+    return await send_media_message(bot, row["chat_id"], payload["media_type"], payload["file_id"], payload["caption"],
+                                    payload["text"], reply_markup, payload["entities"], payload.get("poll_data"), payload["lang"],
+                                    fallback=False)
+
+async def process_outbox_row(bot, row):
+    # Qator navbatda kutib turganda lease tugagan bo'lishi mumkin: yuborishdan oldin lease yangilanadi.
+    # Boshqa worker qatorni qayta band qilgan bo'lsa (belgi o'zgargan), bu nusxa yuborilmaydi.
+    lease_until = time.time() + OUTBOX_LEASE
+    if not storage.renew_outbox_lease(row["id"], row["next_attempt"], lease_until):
+        return
+    try:
+        delivered = await deliver_outbox_row(bot, row)
+    except (telegram.error.Forbidden, telegram.error.BadRequest) as e:
+        # Qabul qiluvchi botni bloklagan yoki chat yo'q: qayta urinishdan foyda yo'q
+        if isinstance(e, telegram.error.Forbidden):
+            storage.mark_inactive([row["chat_id"]])
+        storage.reschedule_outbox(row["id"], None, str(e), lease_until)
+        return
     except Exception as e:
-        print(f"Media yuborishda xato: {e}")
-        await bot.send_message(chat_id=chat_id, text=get_translation(lang, 'media_error') + text)
+        attempts = row["attempts"] + 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            print(f"Outbox: {row['message_id']} yetkazilmadi ({attempts} urinish): {e}")
+            storage.reschedule_outbox(row["id"], None, str(e), lease_until)
+            return
+        delay = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+        if isinstance(e, telegram.error.RetryAfter):
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            delay = max(delay, retry_after)
+        storage.reschedule_outbox(row["id"], time.time() + delay, str(e), lease_until)
+        return
+    storage.complete_outbox(row["id"], sent_message_ids(delivered), lease_until)
+
+async def outbox_worker(bot, queue: asyncio.Queue):
+    while True:
+        row = await queue.get()
+        try:
+            await process_outbox_row(bot, row)
+        except Exception as e:
+            print(f"Outbox worker xato: {e}")
+
+async def outbox_loop(bot):
+    queue = asyncio.Queue(OUTBOX_WORKERS)
+    workers = [asyncio.create_task(outbox_worker(bot, queue)) for _ in range(OUTBOX_WORKERS)]
+    try:
+        while True:
+            outbox_ready.clear()
+            try:
+                rows = storage.claim_outbox(time.time(), OUTBOX_LEASE, OUTBOX_BATCH_SIZE)
+            except Exception as e:
+                print(f"Outbox o'qishda xato: {e}")
+                rows = []
+            for row in rows:
+                await queue.put(row)
+            if len(rows) < OUTBOX_BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(outbox_ready.wait(), timeout=OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+def iter_recipients(segment=None):
+    # Qabul qiluvchilar sahifalab o'qiladi: broadcast davomida xotira foydalanuvchilar soniga bog'liq emas
+    for ids, languages in storage.iter_recipient_chunks(**(segment or {})):
+        yield from zip(ids, languages)
+
+SEGMENT_KEYS = {"lang": "language", "days": "active_days", "refs": "min_referrals"}
+
+def parse_segment(text: str):
+    # "all" yoki "lang=uz days=30 refs=5" -> iter_recipient_chunks argumentlari, noto'g'ri bo'lsa None
+    tokens = text.lower().split()
+    if tokens in (["all"], ["hammasi"], ["все"]):
+        return {}
+    segment = {}
+    for token in tokens:
+        key, _, value = token.partition("=")
+        if key not in SEGMENT_KEYS or not value:
+            return None
+        if key == "lang":
+            if value not in translations:
+                return None
+            segment["language"] = value
+        elif value.isdigit() and int(value) > 0:
+            segment[SEGMENT_KEYS[key]] = int(value)
+        else:
+            return None
+    return segment if tokens else None
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -618,11 +2807,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_channel_membership(user_id, context):
         reply_markup = await get_channels_keyboard(lang)
         await update.message.reply_text(get_translation(lang, 'subscribe_channels'), reply_markup=reply_markup)
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("INSERT OR REPLACE INTO sessions (user_id, step, data) VALUES (?, ?, ?)",
-                           (user_id, "pending_membership", json.dumps({"args": context.args})))
-            conn.commit()
+        storage.set_session(user_id, "pending_membership", json.dumps({"args": context.args}))
         return
 
     add_user_to_db(user_id, lang, first_name, username)
@@ -640,24 +2825,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text(get_translation(lang, 'user_banned'))
                 return
             # Track referral visit (every time, even if not new)
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("INSERT INTO referral_visits (referrer_id, visitor_id) VALUES (?, ?)", (receiver_id, user_id))
-                conn.commit()
+            storage.add_referral_visit(receiver_id, user_id)
 
             # Track unique referral (as before)
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("INSERT OR IGNORE INTO referrals (referrer_id, referred_id) VALUES (?, ?)", (receiver_id, user_id))
-                if cursor.rowcount > 0:
-                    cursor.execute("UPDATE users SET referrals = referrals + 1 WHERE id = ?", (receiver_id,))
-                conn.commit()
+            storage.add_referral(receiver_id, user_id)
             add_user_to_db(user_id, lang, first_name, username)
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("INSERT OR REPLACE INTO sessions (user_id, step, data) VALUES (?, ?, ?)",
-                               (user_id, "send", str(receiver_id)))
-                conn.commit()
+            storage.set_session(user_id, "send", str(receiver_id))
             await update.message.reply_text(get_translation(lang, 'send_message'), parse_mode="HTML")
         except ValueError:
             await update.message.reply_text(get_translation(lang, 'invalid_link'))
@@ -673,11 +2846,8 @@ async def url_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Yangi cheklov: 5+ referral kerak
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT referrals FROM users WHERE id = ?", (user_id,))
-        row = cursor.fetchone()
-        referrals = row['referrals'] if row else 0
+    user = storage.get_user(user_id)
+    referrals = user['referrals'] if user else 0
 
     if referrals < 5:
         await update.message.reply_text(get_translation(lang, 'insufficient_referrals'))
@@ -694,14 +2864,10 @@ async def url_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(get_translation(lang, 'url_invalid'))
         return
 
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users WHERE custom_ref = ?", (new_ref,))
-        if cursor.fetchone()[0] > 0:
-            await update.message.reply_text(get_translation(lang, 'url_taken'))
-            return
-        cursor.execute("UPDATE users SET custom_ref = ? WHERE id = ?", (new_ref, user_id))
-        conn.commit()
+    if storage.find_user_by_custom_ref(new_ref) is not None or not storage.set_custom_ref(user_id, new_ref):
+        await update.message.reply_text(get_translation(lang, 'url_taken'))
+        return
+    notify_state_change("ref", user_id)
 
     ref_link = get_ref_link(user_id)
     await update.message.reply_text(get_translation(lang, 'url_set', ref_link=ref_link), parse_mode="HTML")
@@ -739,30 +2905,16 @@ async def mystats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     update_user_info(user_id, first_name, username)
     today = datetime.now().date().isoformat()
 
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        # Today messages received
-        cursor.execute("SELECT COUNT(*) FROM messages WHERE receiver_id = ? AND DATE(timestamp) = ?", (user_id, today))
-        today_messages = cursor.fetchone()[0]
-        # Total messages received
-        cursor.execute("SELECT COUNT(*) FROM messages WHERE receiver_id = ?", (user_id,))
-        total_messages = cursor.fetchone()[0]
-        # Today unique referral visitors (unique visitor_ids today)
-        cursor.execute("SELECT COUNT(DISTINCT visitor_id) FROM referral_visits WHERE referrer_id = ? AND DATE(timestamp) = ?", (user_id, today))
-        today_referrals = cursor.fetchone()[0]
-        # Total unique referrals (as before)
-        cursor.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (user_id,))
-        total_referrals = cursor.fetchone()[0]
-        # Popularity rank based on referrals
-        cursor.execute("""
-            SELECT u.id, COUNT(r.referred_id) as cnt
-            FROM users u LEFT JOIN referrals r ON u.id = r.referrer_id
-            GROUP BY u.id
-            ORDER BY cnt DESC
-        """)
-        ranks = cursor.fetchall()
-        rank_dict = {row['id']: i+1 for i, row in enumerate(ranks)}
-        popularity_rank = rank_dict.get(user_id, len(ranks) + 1)
+    # Today messages received
+    today_messages = storage.count_messages(user_id, today)
+    # Total messages received
+    total_messages = storage.count_messages(user_id)
+    # Today unique referral visitors (unique visitor_ids today)
+    today_referrals = storage.count_referral_visitors(user_id, today)
+    # Total unique referrals (as before)
+    total_referrals = storage.count_referrals(user_id)
+    # Popularity rank based on referrals
+    popularity_rank = storage.get_popularity_rank(user_id)
 
     ref_link = get_ref_link(user_id)
     stats_text = get_translation(lang, 'mystats', today_messages=today_messages, today_referrals=today_referrals,
@@ -775,6 +2927,45 @@ async def mystats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(stats_text, reply_markup=reply_markup, parse_mode="HTML")
 
+INBOX_PAGE_SIZE = int(os.getenv('INBOX_PAGE_SIZE', '5'))
+
+def format_inbox_page(user_id: int, lang: str, before=None, after=None):
+    # Bitta indeks diapazoni: limit+1 qator, ortiqchasi keyingi sahifa borligini bildiradi
+    rows = storage.list_inbox(user_id, before, after, INBOX_PAGE_SIZE + 1)
+    has_more = len(rows) > INBOX_PAGE_SIZE
+    if after is not None:
+        rows = rows[-INBOX_PAGE_SIZE:]
+        has_newer, has_older = has_more, True
+    else:
+        rows = rows[:INBOX_PAGE_SIZE]
+        has_newer, has_older = before is not None, has_more
+    if not rows:
+        return get_translation(lang, 'inbox_empty'), None
+    lines = [get_translation(lang, 'inbox_title'), ""]
+    buttons = []
+    for i, row in enumerate(rows, 1):
+        content = row["text"] if row["media_type"] == 'text' else f"[{row['media_type']}] {row['caption'] or ''}"
+        lines.append(f"{i}. 🕒 {row['timestamp']}\n<blockquote>{html.escape((content or '')[:300])}</blockquote>")
+        if row["media_type"] != 'text' and row["file_id"]:
+            buttons.append([InlineKeyboardButton(f"📎 {i}. {row['media_type']}", callback_data=f"inbox_media_{row['message_id']}")])
+    navigation = []
+    if has_newer:
+        navigation.append(InlineKeyboardButton("⬅️", callback_data=f"inbox_newer_{rows[0]['row_key']}"))
+    if has_older:
+        navigation.append(InlineKeyboardButton("➡️", callback_data=f"inbox_older_{rows[-1]['row_key']}"))
+    if navigation:
+        buttons.append(navigation)
+    return "\n".join(lines), InlineKeyboardMarkup(buttons) if buttons else None
+
+async def inbox_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    lang = get_user_language(user_id)
+    if is_user_banned(user_id):
+        await update.message.reply_text(get_translation(lang, 'banned'))
+        return
+    text, reply_markup = format_inbox_page(user_id, lang)
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="HTML")
+
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     lang = get_user_language(user_id)
@@ -808,24 +2999,400 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(user_id):
         await update.message.reply_text(get_translation(lang, 'admin_only'))
         return
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        users_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM banned_users")
-        banned_users_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM messages")
-        messages_count = cursor.fetchone()[0]
+    users_count = storage.count_users()
+    banned_users_count = storage.count_banned()
+    messages_count = storage.count_messages()
     stats_text = get_translation(lang, 'stats', users_count=users_count, banned_users_count=banned_users_count, messages_count=messages_count)
     await update.message.reply_text(stats_text, parse_mode="Markdown")
 
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    lang = get_user_language(user_id)
+    if not is_admin(user_id):
+        await update.message.reply_text(get_translation(lang, 'admin_only'))
+        return
+    metrics_text = render_metrics()
+    if len(metrics_text) < 4000:
+        await update.message.reply_text(f"<pre>{html.escape(metrics_text)}</pre>", parse_mode="HTML")
+    else:
+        await update.message.reply_document(document=io.BytesIO(metrics_text.encode()), filename="metrics.txt")
+
+async def queries_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    lang = get_user_language(user_id)
+    if not is_admin(user_id):
+        await update.message.reply_text(get_translation(lang, 'admin_only'))
+        return
+    if slow_query_threshold is None:
+        await update.message.reply_text("So'rov profileri o'chirilgan. Yoqish uchun SLOW_QUERY_MS ni o'rnating.")
+        return
+    lines = [f"TOP {QUERY_TOP_N} so'rov (umumiy vaqt bo'yicha):", ""]
+    for i, (sql, (count, total, longest)) in enumerate(top_queries(), 1):
+        lines.append(f"{i}. {total * 1000:.1f} ms jami, {count} marta, max {longest * 1000:.1f} ms")
+        lines.append(sql)
+        if sql in query_plans:
+            lines.append(query_plans[sql])
+        lines.append("")
+    report = "\n".join(lines)
+    if len(report) < 4000:
+        await update.message.reply_text(f"<pre>{html.escape(report)}</pre>", parse_mode="HTML")
+    else:
+        await update.message.reply_document(document=io.BytesIO(report.encode()), filename="queries.txt")
+
+async def flood_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    lang = get_user_language(user_id)
+    if not is_admin(user_id):
+        await update.message.reply_text(get_translation(lang, 'admin_only'))
+        return
+    lines = [f"Flood nazorati: {FLOOD_SENDER_LIMIT} xabar/yuboruvchi, {FLOOD_PAIR_LIMIT} xabar/juftlik, oyna {FLOOD_WINDOW:g} s", ""]
+    lines.append("Yuboruvchilar:")
+    for sender_id, count in sorted(sender_limiter.throttled.items(), key=lambda item: item[1], reverse=True)[:20]:
+        lines.append(f"<code>{sender_id}</code>: {count} rad etildi")
+    lines.append("")
+    lines.append("Juftliklar (yuboruvchi → qabul qiluvchi):")
+    for (sender_id, receiver_id), count in sorted(pair_limiter.throttled.items(), key=lambda item: item[1], reverse=True)[:20]:
+        lines.append(f"<code>{sender_id}</code> → <code>{receiver_id}</code>: {count} rad etildi")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
+async def outbox_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    lang = get_user_language(user_id)
+    if not is_admin(user_id):
+        await update.message.reply_text(get_translation(lang, 'admin_only'))
+        return
+    action = context.args[0] if context.args else None
+    if action == "retry":
+        count = storage.retry_dead_outbox(time.time())
+        outbox_ready.set()
+        await update.message.reply_text(f"Qayta navbatga qo'yildi: {count}")
+    elif action == "purge":
+        await update.message.reply_text(f"O'chirildi: {storage.purge_dead_outbox()}")
+    elif action is None:
+        await update.message.reply_text(f"Outbox: navbatda {storage.count_outbox()}, yetkazilmagan {storage.count_dead_outbox()}\n"
+                                        "Foydalanish: /outbox [retry|purge]")
+    else:
+        await update.message.reply_text("Foydalanish: /outbox [retry|purge]")
+
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_MAX_UPLOAD = 50 * 1024 * 1024  # Bot API hujjat yuklash chegarasi
+
+def write_export(kind: str, fmt: str, since=None, until=None):
+    # Qatorlar sahifalab o'qiladi va darhol gzip faylga yoziladi - xotira jadval hajmiga bog'liq emas
+    columns = EXPORT_TABLES[kind][1]
+    handle = tempfile.NamedTemporaryFile(prefix=f"export-{kind}-", suffix=f".{fmt}.gz", delete=False)
+    count = 0
+    try:
+        with handle, gzip.open(handle, "wt", encoding="utf-8", newline="") as out:
+            writer = None
+            if fmt == "csv":
+                writer = csv.DictWriter(out, fieldnames=columns)
+                writer.writeheader()
+            for row in storage.iter_export(kind, since, until):
+                if writer:
+                    writer.writerow(row)
+                else:
+                    out.write(json.dumps(row, ensure_ascii=False) + "\n")
+                count += 1
+    except BaseException:
+        os.remove(handle.name)
+        raise
+    return handle.name, count
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    lang = get_user_language(user_id)
+    if not is_admin(user_id):
+        await update.message.reply_text(get_translation(lang, 'admin_only'))
+        return
+    usage = ("Foydalanish: /export <users|messages|referrals|blacklists> [csv|jsonl] [YYYY-MM-DD] [YYYY-MM-DD]\n"
+             "Sana oralig'i ikkala chegarani ham o'z ichiga oladi (users uchun e'tiborga olinmaydi).")
+    args = list(context.args)
+    if not args or args[0] not in EXPORT_TABLES:
+        await update.message.reply_text(usage)
+        return
+    kind = args.pop(0)
+    fmt = args.pop(0) if args and args[0] in EXPORT_FORMATS else "csv"
+    try:
+        dates = [datetime.strptime(arg, "%Y-%m-%d") for arg in args[:2]]
+    except ValueError:
+        await update.message.reply_text(usage)
+        return
+    since = dates[0].strftime("%Y-%m-%d") if dates else None
+    until = (dates[1] + timedelta(days=1)).strftime("%Y-%m-%d") if len(dates) > 1 else None
+    await update.message.reply_text(f"{kind} eksport qilinmoqda...")
+    # Fayl yozish event loopni to'xtatmasligi uchun alohida oqimda
+    path, count = await asyncio.to_thread(write_export, kind, fmt, since, until)
+    try:
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_UPLOAD:
+            await update.message.reply_text(f"Fayl juda katta ({size // (1024 * 1024)} MB). Sana oralig'ini toraytiring.")
+            return
+        period = "_".join(arg for arg in args[:2])
+        filename = f"{kind}{'_' + period if period else ''}.{fmt}.gz"
+        with open(path, "rb") as document:
+            await update.message.reply_document(document=document, filename=filename, caption=f"{kind}: {count} qator")
+    finally:
+        os.remove(path)
+
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', '10'))
+
+def parse_date_range(args: list):
+    # from:YYYY-MM-DD / to:YYYY-MM-DD (ikkala chegara ham kiradi) -> (since, until, qolgan argumentlar)
+    since = until = None
+    rest = []
+    for arg in args:
+        if arg.startswith("from:"):
+            since = datetime.strptime(arg[5:], "%Y-%m-%d").strftime("%Y-%m-%d")
+        elif arg.startswith("to:"):
+            until = (datetime.strptime(arg[3:], "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+        else:
+            rest.append(arg)
+    return since, until, rest
+
+SEARCH_USAGE = ('Foydalanish: /search [from:YYYY-MM-DD] [to:YYYY-MM-DD] <so\'rov>\n'
+                'Ibora: "aniq ibora", prefiks: so\'z*, mantiqiy: AND / OR / NOT')
+
+def format_search_page(search: dict):
+    rows = storage.search_messages(search["query"], search["since"], search["until"], search["cursors"][-1], SEARCH_PAGE_SIZE + 1)
+    has_next = len(rows) > SEARCH_PAGE_SIZE
+    rows = rows[:SEARCH_PAGE_SIZE]
+    search.pop("next", None)
+    page = len(search["cursors"])
+    lines = [f"🔎 <b>{html.escape(search['query'])}</b> — {page}-sahifa", ""]
+    for row in rows:
+        snippet = html.escape(row["snippet"] or "").replace(SNIPPET_OPEN, "<b>").replace(SNIPPET_CLOSE, "</b>")
+        lines.append(
+            f"🕒 {row['timestamp']} <code>{row['message_id']}</code> ({row['media_type']})\n"
+            f"👤 <a href=\"tg://user?id={row['sender_id']}\">{html.escape(row['sender_name'] or str(row['sender_id']))}</a> → "
+            f"<a href=\"tg://user?id={row['receiver_id']}\">{html.escape(row['receiver_name'] or str(row['receiver_id']))}</a>\n"
+            f"📜 {snippet}\n"
+        )
+    if not rows:
+        lines.append("Hech narsa topilmadi.")
+    buttons = []
+    if page > 1:
+        buttons.append(InlineKeyboardButton("⬅️", callback_data="search_prev"))
+    if has_next:
+        search["next"] = rows[-1]["row_key"]
+        buttons.append(InlineKeyboardButton("➡️", callback_data="search_next"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    lang = get_user_language(user_id)
+    if not is_admin(user_id):
+        await update.message.reply_text(get_translation(lang, 'admin_only'))
+        return
+    try:
+        since, until, terms = parse_date_range(context.args)
+    except ValueError:
+        await update.message.reply_text(SEARCH_USAGE)
+        return
+    if not terms:
+        await update.message.reply_text(SEARCH_USAGE)
+        return
+    search = {"query": " ".join(terms), "since": since, "until": until, "cursors": [None]}
+    try:
+        text, reply_markup = format_search_page(search)
+    except QueryError as e:
+        await update.message.reply_text(f"So'rovda xato: {e}\n\n{SEARCH_USAGE}")
+        return
+    context.user_data["search"] = search
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="HTML", disable_web_page_preview=True)
+
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    lang = get_user_language(user_id)
+    if not is_admin(user_id):
+        await update.message.reply_text(get_translation(lang, 'admin_only'))
+        return
+    if context.args[:1] == ["status"] or backup_status["running"]:
+        await update.message.reply_text(format_backup_status())
+        return
+
+    async def backup_and_report():
+        try:
+            await run_backup()
+        except Exception as e:
+            await update.message.reply_text(f"Zaxira nusxa xato: {e}")
+            return
+        await update.message.reply_text(format_backup_status())
+
+    # Handler update navbatini band qilmasligi uchun fon vazifasi sifatida
+    context.application.create_task(backup_and_report(), update=update)
+    await update.message.reply_text("Zaxira nusxa olinmoqda...")
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    lang = get_user_language(user_id)
+    if not is_admin(user_id):
+        await update.message.reply_text(get_translation(lang, 'admin_only'))
+        return
+    try:
+        seconds = min(float(context.args[0]), PROFILE_MAX_SECONDS) if context.args else 10.0
+    except ValueError:
+        await update.message.reply_text(f"Foydalanish: /profile [soniya, maks. {PROFILE_MAX_SECONDS}]")
+        return
+    if seconds <= 0 or profiler_state["running"]:
+        await update.message.reply_text("Profiler allaqachon ishlamoqda" if profiler_state["running"] else
+                                        f"Foydalanish: /profile [soniya, maks. {PROFILE_MAX_SECONDS}]")
+        return
+
+    async def profile_and_report():
+        samples = await run_profiler(seconds)
+        collapsed = "".join(f"{stack} {count}\n" for stack, count in sorted(samples.items()))
+        summary = format_profile_top(samples, seconds)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        await update.message.reply_document(document=io.BytesIO(collapsed.encode()), filename=f"profile-{stamp}.folded",
+                                            caption="flamegraph.pl / speedscope uchun collapsed-stack")
+        if len(summary) < 4000:
+            await update.message.reply_text(f"<pre>{html.escape(summary)}</pre>", parse_mode="HTML")
+        else:
+            await update.message.reply_document(document=io.BytesIO(summary.encode()), filename=f"profile-{stamp}.txt")
+
+    # Profil boshqa update lar ishlayotganda olinishi kerak: handler kutmaydi
+    context.application.create_task(profile_and_report(), update=update)
+    await update.message.reply_text(f"Profiler {seconds:g} s ishlaydi...")
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     lang = get_user_language(user_id)
     await update.message.reply_text(get_translation(lang, 'help_message'), parse_mode="HTML")
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Albom elementlari alohida update bo'lib keladi: media_group_id bo'yicha
+# MEDIA_GROUP_WINDOW davomida yig'iladi (har yangi element oynani uzaytiradi)
+# va handle_message ga bitta xabar sifatida beriladi. Albom update lar
+# navbati orqali (AlbumFlush) yuboriladi, foydalanuvchining keyingi update i
+# esa kutilayotgan albomni oldin yuboradi: tartib saqlanadi.
+MEDIA_GROUP_WINDOW = float(os.getenv('MEDIA_GROUP_WINDOW', '1.0'))  # soniya
+MEDIA_GROUP_MAX_ITEMS = 10  # Telegram albomida ko'pi bilan 10 element
+media_groups = TenantLocal("media_groups", dict)  # (user_id, media_group_id) -> {"updates": [...], "timer": TimerHandle}
+
+class AlbumFlush:
+    # update_queue ga qo'yiladigan belgi: oyna yopildi, albomni yuborish vaqti
+    def __init__(self, key):
+        self.key = key
+
+def buffer_media_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    # Albom bitta xabar: flood limiti yangi guruh ochilganda bir marta olinadi,
+    # guruh esa MEDIA_GROUP_MAX_ITEMS bilan chegaralanadi. False - limitdan oshdi.
+    user_id = update.effective_user.id
+    key = (user_id, update.message.media_group_id)
+    if key in media_groups:
+        if len(media_groups[key]["updates"]) >= MEDIA_GROUP_MAX_ITEMS:
+            return True
+        media_groups[key]["timer"].cancel()
+    else:
+        if not is_admin(user_id) and not sender_limiter.hit(user_id):
+            return False
+        media_groups[key] = {"updates": [], "timer": None}
+    media_groups[key]["updates"].append(update)
+    media_groups[key]["timer"] = asyncio.get_running_loop().call_later(
+        MEDIA_GROUP_WINDOW, context.application.update_queue.put_nowait, AlbumFlush(key))
+    return True
+
+async def flush_media_group(key, context: ContextTypes.DEFAULT_TYPE):
+    group = media_groups.pop(key, None)
+    if group is None:
+        # Keyingi update bilan allaqachon yuborilgan
+        return
+    group["timer"].cancel()
+    updates = sorted(group["updates"], key=lambda item: item.message.message_id)
+    album_context = context.application.context_types.context.from_update(updates[0], context.application)
+    await handle_message(updates[0], album_context, album=[item.message for item in updates])
+
+async def handle_album_flush(flush: AlbumFlush, context: ContextTypes.DEFAULT_TYPE):
+    await flush_media_group(flush.key, context)
+
+async def flush_pending_albums(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not media_groups or not update.effective_user:
+        return
+    current = update.message.media_group_id if update.message else None
+    for key in [key for key in media_groups if key[0] == update.effective_user.id and key[1] != current]:
+        await flush_media_group(key, context)
+
+# Broadcast va forward fon vazifasi sifatida ishlaydi: update lar ketma-ket
+# bajarilgani uchun handler ichidagi sikl boshqa foydalanuvchilarni ham
+# kuttirib qo'yardi. Vazifa BULK yo'lakda yuboradi, shuning uchun governor
+# interaktiv javoblarni undan oldin o'tkazadi.
+def start_bulk_job(context: ContextTypes.DEFAULT_TYPE, update: Update, job):
+    context.application.create_task(job, update=update)
+
+async def broadcast_job(bot, report_to, sender_id: int, lang: str, session_data: dict, reply_markup):
+    success_count = failed_count = 0
+    blocked_bot = array('q')
+    with api_lane(BULK_LANE):
+        for target_id, target_lang in iter_recipients(session_data.get("segment")):
+            if target_id == sender_id:
+                continue
+            try:
+                if session_data["media_type"] == 'text':
+                    await bot.send_message(chat_id=target_id, text=session_data["message"],
+                                           entities=deserialize_entities(session_data["entities"]), reply_markup=reply_markup)
+                elif session_data["media_type"] == 'poll':
+                    await send_media_message(bot, target_id, session_data["media_type"], None, None, None, reply_markup, None, session_data.get("poll_data"), target_lang)
+                else:
+                    await send_media_message(bot, target_id, session_data["media_type"], session_data["file_id"], session_data["caption"], session_data["message"], reply_markup, session_data["entities"], None, target_lang)
+                success_count += 1
+            except telegram.error.Forbidden:
+                blocked_bot.append(target_id)
+                failed_count += 1
+            except Exception as e:
+                print(f"Broadcast xato: {e} for user {target_id}")
+                failed_count += 1
+    storage.mark_inactive(blocked_bot)
+    await report_to.reply_text(get_translation(lang, 'broadcast_sent', success=success_count, failed=failed_count))
+
+async def forward_job(message, sender_id: int, lang: str):
+    success_count = failed_count = 0
+    blocked_bot = array('q')
+    with api_lane(BULK_LANE):
+        for target_id, _ in iter_recipients():
+            if target_id == sender_id:
+                continue
+            try:
+                await message.forward(chat_id=target_id)
+                success_count += 1
+            except telegram.error.Forbidden:
+                blocked_bot.append(target_id)
+                failed_count += 1
+            except Exception:
+                failed_count += 1
+    storage.mark_inactive(blocked_bot)
+    await message.reply_text(get_translation(lang, 'forward_sent', success=success_count, failed=failed_count))
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, album=None):
     user_id = update.effective_user.id
+    if update.message.media_group_id and album is None:
+        if not buffer_media_group(update, context):
+            await reject_flood(update, sender_limiter, user_id)
+        return
+    # Albom uchun limit buffer_media_group da olingan
+    if album is None and not is_admin(user_id) and not sender_limiter.hit(user_id):
+        await reject_flood(update, sender_limiter, user_id)
+        return
+    reply_to = update.message.reply_to_message
+    replying = reply_to and reply_to.from_user.id == context.bot.id
+    session = storage.get_session(user_id)
+    reply_target = None
+    if replying:
+        # Anonim xabar yoki javobga reply: yetkazilgan message_id bo'yicha bitta qidiruv
+        delivery = storage.get_delivery(update.effective_chat.id, reply_to.message_id)
+        if delivery:
+            reply_target = delivery["sender_id"]
+        else:
+            # Indeksdan oldin yetkazilgan xabarlar uchun eski usul (block_ tugmasi)
+            keyboard = reply_to.reply_markup.inline_keyboard if reply_to.reply_markup else None
+            if keyboard and keyboard[0] and (keyboard[0][0].callback_data or "").startswith("block_"):
+                message = storage.get_message(keyboard[0][0].callback_data.split("_", 1)[1])
+                if message:
+                    reply_target = message["sender_id"]
+        if reply_target is not None:
+            session = {"step": "reply", "data": str(reply_target)}
+    # Juftlik limiti boshqa baza ishidan oldin: rad etilgan xabar sessiya (va reply da yetkazish) o'qishiga tushadi
+    if session and not await check_pair_limit(update, user_id, session):
+        return
     first_name = update.effective_user.first_name
     username = update.effective_user.username
     update_user_info(user_id, first_name, username)
@@ -839,27 +3406,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(get_translation(lang, 'subscribe_channels'), reply_markup=reply_markup)
         return
 
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT step, data FROM sessions WHERE user_id = ?", (user_id,))
-        session = cursor.fetchone()
-
-    reply_to = update.message.reply_to_message
-    if reply_to and reply_to.from_user.id == context.bot.id and reply_to.reply_markup and reply_to.reply_markup.inline_keyboard:
-        # Check if it's an anonymous message
-        keyboard = reply_to.reply_markup.inline_keyboard
-        if keyboard and keyboard[0] and keyboard[0][0].callback_data.startswith("block_"):
-            message_id = keyboard[0][0].callback_data.split("_", 1)[1]
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT sender_id FROM messages WHERE message_id = ?", (message_id,))
-                message = cursor.fetchone()
-                if message:
-                    # Set session to reply mode
-                    cursor.execute("INSERT OR REPLACE INTO sessions (user_id, step, data) VALUES (?, ?, ?)",
-                                   (user_id, "reply", str(message["sender_id"])))
-                    conn.commit()
-                    session = {"step": "reply", "data": str(message["sender_id"])}
+    if reply_target is not None:
+        # Set session to reply mode
+        storage.set_session(user_id, "reply", str(reply_target))
 
     if not session:
         await update.message.reply_text(get_translation(lang, 'use_link_first'))
@@ -908,6 +3457,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         poll_data = serialize_poll(update.message.poll)
         text = update.message.poll.question  # For consistency
 
+    if album:
+        items = [album_item(item) for item in album]
+        if any(item.document and (item.document.file_name or '').lower().endswith('.apk') for item in album):
+            await update.message.reply_text(get_translation(lang, 'apk_banned'), parse_mode="HTML")
+            return
+        captioned = next((item for item in album if item.caption), album[0])
+        media_type = 'album'
+        file_id = json.dumps([item for item in items if item])
+        caption = captioned.caption or ''
+        text = caption or "Media fayl"
+        entities = [serialize_entity(entity) for entity in (captioned.caption_entities or [])]
+
     if step == "send":
         # Yangi taqiqlar
         content_to_check = text + " " + caption
@@ -928,26 +3489,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             receiver_name = receiver_username = "Unknown"
 
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''INSERT INTO messages (message_id, sender_id, receiver_id, text, media_type, file_id, caption, sender_name, sender_username, receiver_name, receiver_username)
-                              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                           (message_id, user_id, receiver_id, text, media_type, file_id, caption,
-                            update.effective_user.first_name or "Unknown", update.effective_user.username or "Unknown",
-                            receiver_name, receiver_username))
-            cursor.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
-            conn.commit()
-
         receiver_lang = get_user_language(receiver_id)
-        keyboard = [
-            [InlineKeyboardButton(get_translation(receiver_lang, 'block'), callback_data=f"block_{message_id}")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
         new_msg_text = get_translation(receiver_lang, 'new_message', text=text)
         if media_type == 'text':
-            entities_list = deserialize_entities(entities)
-            await context.bot.send_message(chat_id=receiver_id, text=new_msg_text, reply_markup=reply_markup, entities=entities_list)
+            payload = {"media_type": media_type, "text": new_msg_text, "entities": entities}
         else:
             full_caption = new_msg_text + "\n\n" + caption
             prepended_length = len(new_msg_text) + 2
@@ -956,7 +3501,20 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 ent_copy = ent.copy()
                 ent_copy['offset'] += prepended_length
                 adjusted_entities.append(ent_copy)
-            await send_media_message(context.bot, receiver_id, media_type, file_id, full_caption, text, reply_markup, adjusted_entities, poll_data, receiver_lang)
+            payload = {"media_type": media_type, "file_id": file_id, "caption": full_caption, "text": text,
+                       "entities": adjusted_entities, "poll_data": poll_data}
+        payload["lang"] = receiver_lang
+
+        # Xabar va yetkazish vazifasi bitta tranzaksiyada; yetkazishni outbox workerlari bajaradi
+        storage.enqueue_outbox({
+            "message_id": message_id, "sender_id": user_id, "receiver_id": receiver_id, "text": text,
+            "media_type": media_type, "file_id": file_id, "caption": caption,
+            "sender_name": update.effective_user.first_name or "Unknown",
+            "sender_username": update.effective_user.username or "Unknown",
+            "receiver_name": receiver_name, "receiver_username": receiver_username,
+        }, receiver_id, json.dumps(payload))
+        outbox_ready.set()
+        storage.delete_session(user_id)
 
         await update.message.reply_text(get_translation(lang, 'message_sent'))
         ref_link = get_ref_link(user_id)
@@ -968,7 +3526,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_msg_text = get_translation(sender_lang, 'reply_message', text=text)
         if media_type == 'text':
             entities_list = deserialize_entities(entities)
-            await context.bot.send_message(chat_id=original_sender_id, text=reply_msg_text, entities=entities_list)
+            delivered = await context.bot.send_message(chat_id=original_sender_id, text=reply_msg_text, entities=entities_list)
         else:
             full_caption = reply_msg_text + "\n\n" + caption
             prepended_length = len(reply_msg_text) + 2
@@ -977,17 +3535,31 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 ent_copy = ent.copy()
                 ent_copy['offset'] += prepended_length
                 adjusted_entities.append(ent_copy)
-            await send_media_message(context.bot, original_sender_id, media_type, file_id, full_caption, text, None, adjusted_entities, poll_data, sender_lang)
+            delivered = await send_media_message(context.bot, original_sender_id, media_type, file_id, full_caption, text, None, adjusted_entities, poll_data, sender_lang)
+        # Javobga ham reply qilish mumkin (ikki tomonlama anonim suhbat)
+        for delivered_message_id in sent_message_ids(delivered):
+            storage.add_delivery(original_sender_id, delivered_message_id, user_id)
         await update.message.reply_text(get_translation(lang, 'reply_sent'))
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
-            conn.commit()
+        storage.delete_session(user_id)
+
+    elif step == "broadcast_segment":
+        if not is_admin(user_id):
+            await update.message.reply_text(get_translation(lang, 'admin_only'))
+            return
+        segment = parse_segment(text)
+        if segment is None:
+            await update.message.reply_text(get_translation(lang, 'broadcast_segment_prompt'), parse_mode="HTML")
+            return
+        storage.set_session(user_id, "broadcast_message", json.dumps({"segment": segment}))
+        count = storage.count_recipients(**segment)
+        await update.message.reply_text(get_translation(lang, 'broadcast_segment_selected', count=count))
+        await update.message.reply_text(get_translation(lang, 'broadcast_message_prompt'))
 
     elif step == "broadcast_message":
         if not is_admin(user_id):
             await update.message.reply_text(get_translation(lang, 'admin_only'))
             return
+        segment = json.loads(data).get("segment")
         if media_type == 'text':
             # Faqat matn yuborilganda, media so'rash
             broadcast_data = {
@@ -995,13 +3567,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "file_id": file_id,
                 "caption": caption,
                 "message": text,
-                "entities": entities
+                "entities": entities,
+                "segment": segment
             }
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("INSERT OR REPLACE INTO sessions (user_id, step, data) VALUES (?, ?, ?)",
-                               (user_id, "broadcast_ask_media", json.dumps(broadcast_data)))
-                conn.commit()
+            storage.set_session(user_id, "broadcast_ask_media", json.dumps(broadcast_data))
             yes_text = "Ha" if lang == 'uz' else "Yes" if lang == 'en' else "Да"
             no_text = "Yo‘q" if lang == 'uz' else "No" if lang == 'en' else "Нет"
             keyboard = [
@@ -1016,15 +3585,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "file_id": file_id,
                 "caption": caption,
                 "message": text,
-                "entities": entities
+                "entities": entities,
+                "segment": segment
             }
             if media_type == 'poll':
                 broadcast_data["poll_data"] = poll_data
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("INSERT OR REPLACE INTO sessions (user_id, step, data) VALUES (?, ?, ?)",
-                               (user_id, "broadcast_ask_inline", json.dumps(broadcast_data)))
-                conn.commit()
+            storage.set_session(user_id, "broadcast_ask_inline", json.dumps(broadcast_data))
             yes_text = "Ha" if lang == 'uz' else "Yes" if lang == 'en' else "Да"
             no_text = "Yo‘q" if lang == 'uz' else "No" if lang == 'en' else "Нет"
             keyboard = [
@@ -1040,10 +3606,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if media_type == 'text':
             await update.message.reply_text("Iltimos, media yuboring (rasm, video va h.k.).")
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,))
-            session_data = json.loads(cursor.fetchone()["data"])
+        session_data = json.loads(storage.get_session(user_id)["data"])
         # Oldingi matnni captionga qo'shish
         old_text = session_data["message"]
         old_entities = session_data["entities"]
@@ -1062,15 +3625,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "file_id": file_id,
             "caption": full_caption,
             "message": text,
-            "entities": adjusted_entities
+            "entities": adjusted_entities,
+            "segment": session_data.get("segment")
         }
         if media_type == 'poll':
             broadcast_data["poll_data"] = poll_data
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE sessions SET step = ?, data = ? WHERE user_id = ?",
-                           ("broadcast_ask_inline", json.dumps(broadcast_data), user_id))
-            conn.commit()
+        storage.set_session(user_id, "broadcast_ask_inline", json.dumps(broadcast_data))
         yes_text = "Ha" if lang == 'uz' else "Yes" if lang == 'en' else "Да"
         no_text = "Yo‘q" if lang == 'uz' else "No" if lang == 'en' else "Нет"
         keyboard = [
@@ -1088,16 +3648,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if button_count <= 0 or button_count > 10:
                 await update.message.reply_text(get_translation(lang, 'button_count_prompt'))
                 return
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,))
-                session_data = json.loads(cursor.fetchone()["data"])
-                session_data["count"] = button_count
-                session_data["names"] = []
-                session_data["urls"] = []
-                cursor.execute("UPDATE sessions SET step = ?, data = ? WHERE user_id = ?",
-                               ("broadcast_ask_button_name", json.dumps(session_data), user_id))
-                conn.commit()
+            session_data = json.loads(storage.get_session(user_id)["data"])
+            session_data["count"] = button_count
+            session_data["names"] = []
+            session_data["urls"] = []
+            storage.set_session(user_id, "broadcast_ask_button_name", json.dumps(session_data))
             await update.message.reply_text(get_translation(lang, 'button_name_prompt', current=1, total=button_count))
         except ValueError:
             await update.message.reply_text(get_translation(lang, 'invalid_number'))
@@ -1106,20 +3661,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not is_admin(user_id):
             await update.message.reply_text(get_translation(lang, 'admin_only'))
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,))
-            session_data = json.loads(cursor.fetchone()["data"])
-            session_data["names"].append(text)
-            if len(session_data["names"]) < session_data["count"]:
-                cursor.execute("UPDATE sessions SET data = ? WHERE user_id = ?", (json.dumps(session_data), user_id))
-                conn.commit()
-                await update.message.reply_text(get_translation(lang, 'button_name_prompt', current=len(session_data["names"])+1, total=session_data["count"]))
-            else:
-                cursor.execute("UPDATE sessions SET step = ?, data = ? WHERE user_id = ?",
-                               ("broadcast_ask_button_url", json.dumps(session_data), user_id))
-                conn.commit()
-                await update.message.reply_text(get_translation(lang, 'button_url_prompt', current=1))
+        session_data = json.loads(storage.get_session(user_id)["data"])
+        session_data["names"].append(text)
+        if len(session_data["names"]) < session_data["count"]:
+            storage.set_session(user_id, step, json.dumps(session_data))
+            await update.message.reply_text(get_translation(lang, 'button_name_prompt', current=len(session_data["names"])+1, total=session_data["count"]))
+        else:
+            storage.set_session(user_id, "broadcast_ask_button_url", json.dumps(session_data))
+            await update.message.reply_text(get_translation(lang, 'button_url_prompt', current=1))
 
     elif step == "broadcast_ask_button_url":
         if not is_admin(user_id):
@@ -1129,64 +3678,23 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not is_valid_url(url):
             await update.message.reply_text(get_translation(lang, 'invalid_url'))
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,))
-            session_data = json.loads(cursor.fetchone()["data"])
-            session_data["urls"].append(url)
-            if len(session_data["urls"]) < session_data["count"]:
-                cursor.execute("UPDATE sessions SET data = ? WHERE user_id = ?", (json.dumps(session_data), user_id))
-                conn.commit()
-                await update.message.reply_text(get_translation(lang, 'button_url_prompt', current=len(session_data["urls"])+1))
-            else:
-                keyboard = [[InlineKeyboardButton(name, url=u)] for name, u in zip(session_data["names"], session_data["urls"])]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                cursor.execute("SELECT id FROM users")
-                users = [row["id"] for row in cursor.fetchall()]
-                cursor.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
-                conn.commit()
-                success_count = failed_count = 0
-                for target_id in users:
-                    if not is_user_banned(target_id) and target_id != user_id:
-                        target_lang = get_user_language(target_id)
-                        try:
-                            if session_data["media_type"] == 'text':
-                                entities_list = deserialize_entities(session_data["entities"])
-                                await context.bot.send_message(
-                                    chat_id=target_id,
-                                    text=session_data["message"],
-                                    entities=entities_list,
-                                    reply_markup=reply_markup
-                                )
-                            elif session_data["media_type"] == 'poll':
-                                await send_media_message(context.bot, target_id, session_data["media_type"], None, None, None, reply_markup, None, session_data.get("poll_data"), target_lang)
-                            else:
-                                await send_media_message(context.bot, target_id, session_data["media_type"], session_data["file_id"], session_data["caption"], session_data["message"], reply_markup, session_data["entities"], None, target_lang)
-                            success_count += 1
-                        except Exception as e:
-                            print(f"Broadcast xato: {e} for user {target_id}")
-                            failed_count += 1
-                await update.message.reply_text(get_translation(lang, 'broadcast_sent', success=success_count, failed=failed_count))
+        session_data = json.loads(storage.get_session(user_id)["data"])
+        session_data["urls"].append(url)
+        if len(session_data["urls"]) < session_data["count"]:
+            storage.set_session(user_id, step, json.dumps(session_data))
+            await update.message.reply_text(get_translation(lang, 'button_url_prompt', current=len(session_data["urls"])+1))
+        else:
+            keyboard = [[InlineKeyboardButton(name, url=u)] for name, u in zip(session_data["names"], session_data["urls"])]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            storage.delete_session(user_id)
+            start_bulk_job(context, update, broadcast_job(context.bot, update.message, user_id, lang, session_data, reply_markup))
 
     elif step == "forward_message":
         if not is_admin(user_id):
             await update.message.reply_text(get_translation(lang, 'admin_only'))
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM users")
-            users = [row["id"] for row in cursor.fetchall()]
-            cursor.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
-            conn.commit()
-        success_count = failed_count = 0
-        for target_id in users:
-            if not is_user_banned(target_id) and target_id != user_id:
-                try:
-                    await update.message.forward(chat_id=target_id)
-                    success_count += 1
-                except Exception:
-                    failed_count += 1
-        await update.message.reply_text(get_translation(lang, 'forward_sent', success=success_count, failed=failed_count))
+        storage.delete_session(user_id)
+        start_bulk_job(context, update, forward_job(update.message, user_id, lang))
 
     elif step == "set_channel_count":
         if not is_admin(user_id):
@@ -1197,11 +3705,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if channel_count <= 0 or channel_count > 10:
                 await update.message.reply_text(get_translation(lang, 'channel_count_prompt'))
                 return
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("INSERT OR REPLACE INTO sessions (user_id, step, data) VALUES (?, ?, ?)",
-                               (user_id, "set_channel_id", json.dumps({"count": channel_count, "channels": [], "current_channel": 1})))
-                conn.commit()
+            storage.set_session(user_id, "set_channel_id", json.dumps({"count": channel_count, "channels": [], "current_channel": 1}))
             await update.message.reply_text(get_translation(lang, 'channel_id_prompt', current=1))
         except ValueError:
             await update.message.reply_text(get_translation(lang, 'invalid_number'))
@@ -1214,14 +3718,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not is_valid_channel_id(input_str):
             await update.message.reply_text(get_translation(lang, 'invalid_channel_id'))
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,))
-            session_data = json.loads(cursor.fetchone()["data"])
-            session_data["channels"].append({"id": input_str, "name": "Join", "link": ""})
-            cursor.execute("UPDATE sessions SET step = ?, data = ? WHERE user_id = ?",
-                           ("set_channel_link", json.dumps(session_data), user_id))
-            conn.commit()
+        session_data = json.loads(storage.get_session(user_id)["data"])
+        session_data["channels"].append({"id": input_str, "name": "Join", "link": ""})
+        storage.set_session(user_id, "set_channel_link", json.dumps(session_data))
         await update.message.reply_text(get_translation(lang, 'channel_link_prompt', current=session_data['current_channel']))
 
     elif step == "set_channel_link":
@@ -1232,25 +3731,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not is_valid_invite_link(invite_link):
             await update.message.reply_text(get_translation(lang, 'invalid_invite_link'))
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,))
-            session_data = json.loads(cursor.fetchone()["data"])
-            session_data["channels"][-1]["link"] = invite_link
-            if len(session_data["channels"]) < session_data["count"]:
-                session_data["current_channel"] += 1
-                cursor.execute("UPDATE sessions SET step = ?, data = ? WHERE user_id = ?",
-                               ("set_channel_id", json.dumps(session_data), user_id))
-                conn.commit()
-                await update.message.reply_text(get_translation(lang, 'channel_id_prompt', current=session_data['current_channel']))
-            else:
-                cursor.execute("DELETE FROM channels")
-                for channel in session_data["channels"]:
-                    cursor.execute("INSERT INTO channels (id, link, name) VALUES (?, ?, ?)",
-                                   (channel["id"], channel["link"], channel["name"]))
-                cursor.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
-                conn.commit()
-                await update.message.reply_text(get_translation(lang, 'channels_set', count=session_data['count']))
+        session_data = json.loads(storage.get_session(user_id)["data"])
+        session_data["channels"][-1]["link"] = invite_link
+        if len(session_data["channels"]) < session_data["count"]:
+            session_data["current_channel"] += 1
+            storage.set_session(user_id, "set_channel_id", json.dumps(session_data))
+            await update.message.reply_text(get_translation(lang, 'channel_id_prompt', current=session_data['current_channel']))
+        else:
+            config.set_channels(session_data["channels"])
+            storage.delete_session(user_id)
+            await update.message.reply_text(get_translation(lang, 'channels_set', count=session_data['count']))
 
     elif step == "get_user_id":
         if not is_admin(user_id):
@@ -1261,36 +3751,20 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except ValueError:
             await update.message.reply_text(get_translation(lang, 'error_id'))
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT first_name, username FROM users WHERE id = ?", (target_id,))
-            user = cursor.fetchone()
-            if not user:
-                await update.message.reply_text(get_translation(lang, 'user_not_found'))
-                cursor.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
-                conn.commit()
-                return
-            first_name = html.escape(user['first_name'] or get_translation(lang, 'unknown'))
-            username = html.escape(user['username'] or get_translation(lang, 'unknown'))
-            cursor.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (target_id,))
-            referrals = cursor.fetchone()[0]
-            cursor.execute("SELECT COUNT(*) FROM messages WHERE receiver_id = ?", (target_id,))
-            messages = cursor.fetchone()[0]
-            cursor.execute("SELECT COUNT(*) FROM user_blacklists WHERE blocker_id = ?", (target_id,))
-            blocks = cursor.fetchone()[0]
-            cursor.execute("""
-                SELECT u.id, COUNT(r.referred_id) as cnt
-                FROM users u LEFT JOIN referrals r ON u.id = r.referrer_id
-                GROUP BY u.id
-                ORDER BY cnt DESC
-            """)
-            ranks = cursor.fetchall()
-            rank_dict = {row['id']: i+1 for i, row in enumerate(ranks)}
-            rank = rank_dict.get(target_id, len(ranks) + 1)
-            info_text = get_translation(lang, 'user_info', id=target_id, first_name=first_name, username=username, referrals=referrals, messages=messages, blocks=blocks, rank=rank)
-            await update.message.reply_text(info_text, parse_mode="HTML")
-            cursor.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
-            conn.commit()
+        user = storage.get_user(target_id)
+        if not user:
+            await update.message.reply_text(get_translation(lang, 'user_not_found'))
+            storage.delete_session(user_id)
+            return
+        first_name = html.escape(user['first_name'] or get_translation(lang, 'unknown'))
+        username = html.escape(user['username'] or get_translation(lang, 'unknown'))
+        referrals = storage.count_referrals(target_id)
+        messages = storage.count_messages(target_id)
+        blocks = storage.count_blacklist(target_id)
+        rank = storage.get_popularity_rank(target_id)
+        info_text = get_translation(lang, 'user_info', id=target_id, first_name=first_name, username=username, referrals=referrals, messages=messages, blocks=blocks, rank=rank)
+        await update.message.reply_text(info_text, parse_mode="HTML")
+        storage.delete_session(user_id)
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1318,85 +3792,98 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.edit_text(f"Til {new_lang.upper()} ga o'zgartirildi." if lang == 'uz' else f"Language set to {new_lang.upper()}" if lang == 'en' else f"Язык установлен на {new_lang.upper()}")
 
     elif data == "check_membership":
-        if await check_channel_membership(user_id, context):
+        # Foydalanuvchi endigina qo'shilgan bo'lishi mumkin: chat_member update kechiksa ham API dan tekshiriladi
+        if await check_channel_membership(user_id, context, refresh=True):
             await query.message.delete()
             await context.bot.send_message(chat_id=user_id, text=get_translation(lang, 'thanks_subscribed'))
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,))
-                session = cursor.fetchone()
-                if session:
-                    args = json.loads(session["data"]).get("args", [])
-                    cursor.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
-                    conn.commit()
-                    if args:
-                        try:
-                            receiver_id = get_user_from_ref(args[0])
-                            if receiver_id == user_id:
-                                await context.bot.send_message(chat_id=user_id, text=get_translation(lang, 'self_message'))
-                                return
-                            if is_user_banned(receiver_id):
-                                await context.bot.send_message(chat_id=user_id, text=get_translation(lang, 'user_banned'))
-                                return
-                            # Track referral visit (every time, even if not new)
-                            with get_db_connection() as conn:
-                                cursor = conn.cursor()
-                                cursor.execute("INSERT INTO referral_visits (referrer_id, visitor_id) VALUES (?, ?)", (receiver_id, user_id))
-                                conn.commit()
-
-                            # Track unique referral (as before)
-                            with get_db_connection() as conn:
-                                cursor = conn.cursor()
-                                cursor.execute("INSERT OR IGNORE INTO referrals (referrer_id, referred_id) VALUES (?, ?)", (receiver_id, user_id))
-                                if cursor.rowcount > 0:
-                                    cursor.execute("UPDATE users SET referrals = referrals + 1 WHERE id = ?", (receiver_id,))
-                                conn.commit()
-                            add_user_to_db(user_id, lang, first_name, username)
-                            with get_db_connection() as conn:
-                                cursor = conn.cursor()
-                                cursor.execute("INSERT OR REPLACE INTO sessions (user_id, step, data) VALUES (?, ?, ?)",
-                                               (user_id, "send", str(receiver_id)))
-                                conn.commit()
-                            await context.bot.send_message(chat_id=user_id, text=get_translation(lang, 'send_message'), parse_mode="HTML")
-                        except ValueError:
-                            await context.bot.send_message(chat_id=user_id, text=get_translation(lang, 'invalid_link'))
-                    else:
-                        ref_link = get_ref_link(user_id)
-                        await context.bot.send_message(
-                            chat_id=user_id,
-                            text=get_translation(lang, 'own_link', ref_link=ref_link),
-                            parse_mode="HTML"
-                        )
+            session = storage.get_session(user_id)
+            if session:
+                args = json.loads(session["data"]).get("args", [])
+                storage.delete_session(user_id)
+                if args:
+                    try:
+                        receiver_id = get_user_from_ref(args[0])
+                        if receiver_id == user_id:
+                            await context.bot.send_message(chat_id=user_id, text=get_translation(lang, 'self_message'))
+                            return
+                        if is_user_banned(receiver_id):
+                            await context.bot.send_message(chat_id=user_id, text=get_translation(lang, 'user_banned'))
+                            return
+                        # Track referral visit (every time, even if not new)
+                        storage.add_referral_visit(receiver_id, user_id)
+
+                        # Track unique referral (as before)
+                        storage.add_referral(receiver_id, user_id)
+                        add_user_to_db(user_id, lang, first_name, username)
+                        storage.set_session(user_id, "send", str(receiver_id))
+                        await context.bot.send_message(chat_id=user_id, text=get_translation(lang, 'send_message'), parse_mode="HTML")
+                    except ValueError:
+                        await context.bot.send_message(chat_id=user_id, text=get_translation(lang, 'invalid_link'))
+                else:
+                    ref_link = get_ref_link(user_id)
+                    await context.bot.send_message(
+                        chat_id=user_id,
+                        text=get_translation(lang, 'own_link', ref_link=ref_link),
+                        parse_mode="HTML"
+                    )
         else:
             await query.answer(get_translation(lang, 'not_subscribed_alert'), show_alert=True)
 
     elif data.startswith("block_"):
         message_id = data.split("_", 1)[1]
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM messages WHERE message_id = ?", (message_id,))
-            message = cursor.fetchone()
+        message = storage.get_message(message_id)
         if message:
             block_user(user_id, message["sender_id"])
             if is_notify_blocks_enabled():
-                report_lang = get_user_language(ADMIN_ID)
-                report_text = (
-                    f"📢 *{get_translation(report_lang, 'block')}*\n\n"
-                    f"👤 *Bloklovchi*:\n  Ism: [{message['receiver_name']}](tg://user?id={message['receiver_id']})\n"
-                    f"  Username: @{message['receiver_username']}\n  ID: `{message['receiver_id']}`\n\n"
-                    f"👤 *Bloklangan*:\n  Ism: [{message['sender_name']}](tg://user?id={message['sender_id']})\n"
-                    f"  Username: @{message['sender_username']}\n  ID: `{message['sender_id']}`\n\n"
-                    f"📜 *Xabar*:\n{message['text']}\n"
-                )
-                await context.bot.send_message(chat_id=ADMIN_ID, text=report_text, parse_mode="Markdown")
-                if message['media_type'] != 'text':
-                    await send_media_message(context.bot, ADMIN_ID, message['media_type'], message['file_id'], message['caption'], message['text'], lang=report_lang)
+                queue_block_report(message)
             keyboard = [[InlineKeyboardButton(get_translation(lang, 'unblock'), callback_data=f"unblock_{message['sender_id']}")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await query.message.reply_text(get_translation(lang, 'block_sent'), reply_markup=reply_markup, parse_mode="HTML")
         else:
             await query.message.reply_text(get_translation(lang, 'message_not_found'))
 
+    elif data.startswith("report_media_"):
+        if not is_admin(user_id):
+            await query.message.reply_text(get_translation(lang, 'admin_only'))
+            return
+        message = storage.get_message(data.split("_", 2)[2])
+        if message:
+            await send_media_message(context.bot, user_id, message['media_type'], message['file_id'], message['caption'], message['text'], lang=lang)
+        else:
+            await query.message.reply_text(get_translation(lang, 'message_not_found'))
+
+    elif data in ("search_next", "search_prev"):
+        search = context.user_data.get("search")
+        if not is_admin(user_id) or not search:
+            return
+        if data == "search_next" and search.get("next"):
+            search["cursors"].append(search.pop("next"))
+        elif data == "search_prev" and len(search["cursors"]) > 1:
+            search["cursors"].pop()
+        try:
+            text, reply_markup = format_search_page(search)
+        except QueryError as e:
+            context.user_data.pop("search", None)
+            await query.message.edit_text(f"So'rovda xato: {e}\n\n{SEARCH_USAGE}")
+            return
+        await query.message.edit_text(text, reply_markup=reply_markup, parse_mode="HTML", disable_web_page_preview=True)
+
+    elif data.startswith(("inbox_older_", "inbox_newer_")):
+        _, direction, row_key = data.split("_", 2)
+        if direction == "older":
+            text, reply_markup = format_inbox_page(user_id, lang, before=int(row_key))
+        else:
+            text, reply_markup = format_inbox_page(user_id, lang, after=int(row_key))
+        await query.message.edit_text(text, reply_markup=reply_markup, parse_mode="HTML")
+
+    elif data.startswith("inbox_media_"):
+        message = storage.get_message(data.split("_", 2)[2])
+        # Faqat qabul qiluvchining o'ziga
+        if message and message['receiver_id'] == user_id:
+            await send_media_message(context.bot, user_id, message['media_type'], message['file_id'], message['caption'], message['text'], lang=lang)
+        else:
+            await query.message.reply_text(get_translation(lang, 'message_not_found'))
+
     elif data.startswith("unblock_"):
         blocked_id = int(data.split("_", 1)[1])
         if unblock_user(user_id, blocked_id):
@@ -1412,42 +3899,28 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not is_admin(user_id):
             await query.message.reply_text(get_translation(lang, 'admin_only'))
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("INSERT OR REPLACE INTO sessions (user_id, step, data) VALUES (?, ?, ?)",
-                           (user_id, "broadcast_message", json.dumps({})))
-            conn.commit()
-        await query.message.reply_text(get_translation(lang, 'broadcast_message_prompt'))
+        storage.set_session(user_id, "broadcast_segment", json.dumps({}))
+        await query.message.reply_text(get_translation(lang, 'broadcast_segment_prompt'), parse_mode="HTML")
 
     elif data == "forward":
         if not is_admin(user_id):
             await query.message.reply_text(get_translation(lang, 'admin_only'))
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("INSERT OR REPLACE INTO sessions (user_id, step, data) VALUES (?, ?, ?)",
-                           (user_id, "forward_message", json.dumps({})))
-            conn.commit()
+        storage.set_session(user_id, "forward_message", json.dumps({}))
         await query.message.reply_text(get_translation(lang, 'forward_message_prompt'))
 
     elif data == "broadcast_add_media":
         if not is_admin(user_id):
             await query.message.reply_text(get_translation(lang, 'admin_only'))
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE sessions SET step = ? WHERE user_id = ?", ("broadcast_wait_media", user_id))
-            conn.commit()
+        storage.set_session_step(user_id, "broadcast_wait_media")
         await query.message.reply_text("Iltimos, media yuboring (rasm, video va h.k.).")
 
     elif data == "broadcast_no_media":
         if not is_admin(user_id):
             await query.message.reply_text(get_translation(lang, 'admin_only'))
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE sessions SET step = ? WHERE user_id = ?", ("broadcast_ask_inline", user_id))
-            conn.commit()
+        storage.set_session_step(user_id, "broadcast_ask_inline")
         yes_text = "Ha" if lang == 'uz' else "Yes" if lang == 'en' else "Да"
         no_text = "Yo‘q" if lang == 'uz' else "No" if lang == 'en' else "Нет"
         keyboard = [
@@ -1460,80 +3933,36 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not is_admin(user_id):
             await query.message.reply_text(get_translation(lang, 'admin_only'))
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE sessions SET step = ? WHERE user_id = ?", ("broadcast_ask_count", user_id))
-            conn.commit()
+        storage.set_session_step(user_id, "broadcast_ask_count")
         await query.message.reply_text(get_translation(lang, 'button_count_prompt'))
 
     elif data == "broadcast_no_buttons":
         if not is_admin(user_id):
             await query.message.reply_text(get_translation(lang, 'admin_only'))
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,))
-            session_data = json.loads(cursor.fetchone()["data"])
-            cursor.execute("SELECT id FROM users")
-            users = [row["id"] for row in cursor.fetchall()]
-            cursor.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
-            conn.commit()
-        success_count = failed_count = 0
-        for target_id in users:
-            if not is_user_banned(target_id) and target_id != user_id:
-                target_lang = get_user_language(target_id)
-                try:
-                    if session_data["media_type"] == 'text':
-                        entities_list = deserialize_entities(session_data["entities"])
-                        await context.bot.send_message(
-                            chat_id=target_id,
-                            text=session_data["message"],
-                            entities=entities_list
-                        )
-                    elif session_data["media_type"] == 'poll':
-                        await send_media_message(context.bot, target_id, session_data["media_type"], None, None, None, None, None, session_data.get("poll_data"), target_lang)
-                    else:
-                        await send_media_message(context.bot, target_id, session_data["media_type"], session_data["file_id"], session_data["caption"], session_data["message"], None, session_data["entities"], None, target_lang)
-                    success_count += 1
-                except Exception:
-                    failed_count += 1
-        await query.message.reply_text(get_translation(lang, 'broadcast_sent', success=success_count, failed=failed_count))
+        session_data = json.loads(storage.get_session(user_id)["data"])
+        storage.delete_session(user_id)
+        start_bulk_job(context, update, broadcast_job(context.bot, query.message, user_id, lang, session_data, None))
 
     elif data == "set_channel":
         if not is_admin(user_id):
             await query.message.reply_text(get_translation(lang, 'admin_only'))
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("INSERT OR REPLACE INTO sessions (user_id, step, data) VALUES (?, ?, ?)",
-                           (user_id, "set_channel_count", json.dumps({})))
-            conn.commit()
+        storage.set_session(user_id, "set_channel_count", json.dumps({}))
         await query.message.reply_text(get_translation(lang, 'channel_count_prompt'))
 
     elif data == "remove_channel":
         if not is_admin(user_id):
             await query.message.reply_text(get_translation(lang, 'admin_only'))
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM channels")
-            conn.commit()
+        config.set_channels([])
         await query.message.reply_text(get_translation(lang, 'channels_removed'))
 
     elif data == "top_users":
         if not is_admin(user_id):
             await query.message.reply_text(get_translation(lang, 'admin_only'))
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT u.id, u.first_name, u.username, COUNT(r.referred_id) as cnt
-                FROM users u LEFT JOIN referrals r ON u.id = r.referrer_id
-                GROUP BY u.id
-                ORDER BY cnt DESC
-                LIMIT 30
-            """)
-            top_users = cursor.fetchall()
+        top_users = storage.top_users(30)
         top_text = get_translation(lang, 'top_users_title')
         for i, user in enumerate(top_users, 1):
             first_name = html.escape(user['first_name'] or get_translation(lang, 'unknown'))
@@ -1545,11 +3974,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not is_admin(user_id):
             await query.message.reply_text(get_translation(lang, 'admin_only'))
             return
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("INSERT OR REPLACE INTO sessions (user_id, step, data) VALUES (?, ?, ?)",
-                           (user_id, "get_user_id", json.dumps({})))
-            conn.commit()
+        storage.set_session(user_id, "get_user_id", json.dumps({}))
         await query.message.reply_text(get_translation(lang, 'user_info_prompt'))
 
     elif data == "toggle_notify_blocks":
@@ -1633,26 +4058,456 @@ async def warn(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         await update.message.reply_text(get_translation(lang, 'error_id'))
 
+# Onlayn zaxira nusxa: sqlite3 backup API kichik sahifa qadamlarida, alohida
+# oqimda ishlaydi. Manba ulanishida ochiq o'qish tranzaksiyasi bitta WAL
+# snapshotini ushlab turadi: yozuvchilar bloklanmaydi, backup esa boshqa
+# ulanishlar yozganda qaytadan boshlanmaydi. Natija gzip qilinadi va eng
+# yangi BACKUP_KEEP ta nusxa saqlanadi.
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+BACKUP_INTERVAL = float(os.getenv('BACKUP_INTERVAL', '86400'))  # soniya, 0 - faqat /backup orqali
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))
+BACKUP_PAGES = int(os.getenv('BACKUP_PAGES', '256'))  # bir qadamda nusxalanadigan sahifalar
+BACKUP_STEP_PAUSE = float(os.getenv('BACKUP_STEP_PAUSE', '0.01'))  # qadamlar orasida, soniya
+backup_status = TenantLocal("backup_status", lambda: {"running": False, "progress": None, "last": None})
+
+def backup_dir() -> str:
+    # Bir nechta bot bo'lsa har biriga o'z papkasi
+    return BACKUP_DIR if tenant() is default_tenant else os.path.join(BACKUP_DIR, tenant().name)
+
+def write_backup(path: str) -> dict:
+    started = time.perf_counter()
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    directory = backup_dir()
+    os.makedirs(directory, exist_ok=True)
+    raw_path = os.path.join(directory, f"bot-{stamp}.db.tmp")
+    final_path = os.path.join(directory, f"bot-{stamp}.db.gz")
+    source = sqlite3.connect(path, isolation_level=None)
+    target = sqlite3.connect(raw_path)
+    try:
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+
+        def progress(status, remaining, total):
+            backup_status["progress"] = (total - remaining, total)
+            time.sleep(BACKUP_STEP_PAUSE)
+
+        source.backup(target, pages=BACKUP_PAGES, progress=progress)
+        source.execute("COMMIT")
+    finally:
+        target.close()
+        source.close()
+    try:
+        with open(raw_path, "rb") as raw, gzip.open(final_path, "wb") as compressed:
+            while chunk := raw.read(1024 * 1024):
+                compressed.write(chunk)
+    finally:
+        os.remove(raw_path)
+    snapshots = sorted(name for name in os.listdir(directory) if name.startswith("bot-") and name.endswith(".db.gz"))
+    for name in snapshots[:-BACKUP_KEEP]:
+        os.remove(os.path.join(directory, name))
+    return {"path": final_path, "size": os.path.getsize(final_path), "pages": backup_status["progress"][1],
+            "duration": time.perf_counter() - started, "finished": utc_timestamp(), "error": None}
+
+async def run_backup() -> dict:
+    if STORAGE != 'sqlite':
+        raise RuntimeError("Zaxira nusxa faqat sqlite storage uchun")
+    if backup_status["running"]:
+        raise RuntimeError("Zaxira nusxa allaqachon olinmoqda")
+    backup_status.update(running=True, progress=None)
+    try:
+        backup_status["last"] = await asyncio.to_thread(write_backup, storage.path)
+    except Exception as e:
+        backup_status["last"] = {"error": str(e), "finished": utc_timestamp()}
+        raise
+    finally:
+        backup_status["running"] = False
+    return backup_status["last"]
+
+async def backup_loop():
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL)
+        try:
+            result = await run_backup()
+            print(f"Zaxira nusxa: {result['path']} ({result['size'] // 1024} KB, {result['duration']:.1f} s)")
+        except Exception as e:
+            print(f"Zaxira nusxa xato: {e}")
+
+def format_backup_status() -> str:
+    lines = [f"Zaxira nusxalar: {backup_dir()}, har {BACKUP_INTERVAL / 3600:g} soatda, {BACKUP_KEEP} ta saqlanadi"
+             if BACKUP_INTERVAL > 0 else f"Zaxira nusxalar: {backup_dir()}, faqat qo'lda, {BACKUP_KEEP} ta saqlanadi"]
+    if backup_status["running"]:
+        done, total = backup_status["progress"] or (0, 0)
+        lines.append(f"Hozir olinmoqda: {done}/{total} sahifa")
+    last = backup_status["last"]
+    if last is None:
+        lines.append("Bu jarayonda hali zaxira olinmagan.")
+    elif last["error"]:
+        lines.append(f"Oxirgi urinish ({last['finished']} UTC) xato: {last['error']}")
+    else:
+        lines.append(f"Oxirgi nusxa: {last['finished']} UTC, {last['path']}, {last['size'] // 1024} KB, "
+                     f"{last['pages']} sahifa, {last['duration']:.1f} s")
+    return "\n".join(lines)
+
+# Trafik izi: TRACE_PATH berilsa har bir update anonimlashtirilib JSONL ga yoziladi
+# (replay.py bilan qayta o'ynatish uchun). ID lar TRACE_SALT bilan xeshlanadi,
+# matnlar uzunligi saqlangan holda almashtiriladi, ism va fayllar olib tashlanadi.
+TRACE_PATH = os.getenv('TRACE_PATH')
+TRACE_SALT = (os.getenv('TRACE_SALT') or os.urandom(16).hex()).encode()
+TRACE_ID_KEYS = ("id", "user_id", "chat_id")
+TRACE_NAME_KEYS = ("first_name", "last_name", "title", "username")
+TRACE_FILE_KEYS = ("file_id", "file_unique_id")
+TRACE_DROP_KEYS = ("phone_number", "vcard", "latitude", "longitude", "address", "invite_link", "url")
+trace_state = TenantLocal("trace", lambda: {"file": None, "started": 0.0})
+
+def anonymize_id(value: int) -> int:
+    digest = hashlib.blake2b(str(abs(value)).encode(), key=TRACE_SALT, digest_size=8).digest()
+    anonymous = int.from_bytes(digest, "big") % 9_000_000_000 + 1_000_000_000
+    return -anonymous if value < 0 else anonymous
+
+def sanitize_ref_code(code: str) -> str:
+    # Maxsus havola (custom_ref) barqaror xesh bilan almashtiriladi: replay egasini shu kod bilan yaratadi
+    try:
+        return encode_user_id(anonymize_id(decode_user_id(code)))
+    except ValueError:
+        return f"r{hashlib.blake2b(code.encode(), key=TRACE_SALT, digest_size=4).hexdigest()}"
+
+def sanitize_trace_text(text: str) -> str:
+    if text.startswith("/start "):
+        command, arg = text.split(" ", 1)
+        return f"{command} {sanitize_ref_code(arg)}"
+    if text.startswith("/"):
+        # /ban <user_id> kabi argumentlardagi id lar anonimlashtiriladi, qolgani yashiriladi
+        command, separator, rest = text.partition(" ")
+        return command + separator + re.sub(r"\S+", lambda m: str(anonymize_id(int(m.group())))
+                                            if m.group().isdigit() and len(m.group()) >= 5 else "x" * len(m.group()), rest)
+    return re.sub(r"\S", "x", text)
+
+def sanitize_trace(value, key=None, parent=None):
+    if isinstance(value, dict):
+        return {k: sanitize_trace(v, k, value) for k, v in value.items()}
+    if isinstance(value, list):
+        return [sanitize_trace(item, key, parent) for item in value]
+    if key in TRACE_ID_KEYS and isinstance(value, int) and not parent.get("is_bot"):
+        return anonymize_id(value)
+    if key in TRACE_NAME_KEYS and isinstance(value, str) and not parent.get("is_bot"):
+        return key
+    if key in TRACE_FILE_KEYS:
+        return hashlib.blake2b(str(value).encode(), key=TRACE_SALT, digest_size=12).hexdigest()
+    if key in TRACE_DROP_KEYS:
+        return None
+    if key in ("text", "caption", "question") and isinstance(value, str):
+        return sanitize_trace_text(value)
+    if key == "data" and isinstance(value, str):
+        # callback_data ichidagi user id lar (block_<id>_<id>_<n>, unblock_<id>)
+        return re.sub(r"\d{5,}", lambda m: str(anonymize_id(int(m.group()))), value)
+    return value
+
+def trace_annotations(update: Update) -> dict:
+    # Izdan tiklab bo'lmaydigan holat (anonim ID larda): maxsus havola egasi va
+    # reply qilingan yetkazilgan xabar yuboruvchisi - replay ularni qayta bog'laydi
+    message = update.message
+    if not message:
+        return {}
+    annotations = {}
+    if message.text and message.text.startswith("/start "):
+        code = message.text.split(" ", 1)[1]
+        owner = storage.find_user_by_custom_ref(code)
+        if owner is not None:
+            annotations["ref"] = {"code": sanitize_ref_code(code), "owner": anonymize_id(owner)}
+    if message.reply_to_message:
+        delivery = storage.get_delivery(message.chat_id, message.reply_to_message.message_id)
+        if delivery:
+            annotations["reply_sender"] = anonymize_id(delivery["sender_id"])
+    return annotations
+
+async def record_trace(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if trace_state["file"] is None:
+        # Har bir bot (va shard) o'z fayliga o'z sarlavhasi bilan yozadi
+        path = TRACE_PATH if tenant() is default_tenant else f"{TRACE_PATH}.{tenant().name}"
+        if worker_shard is not None:
+            path = f"{path}.{worker_shard}"
+        trace_state["file"] = open(path, "a", encoding="utf-8", buffering=1)
+        trace_state["started"] = time.monotonic()
+        trace_state["file"].write(json.dumps({"header": True, "bot_id": context.bot.id, "bot_username": context.bot.username,
+                                              "admin": anonymize_id(tenant().admin_id)}) + "\n")
+    entry = {"t": round(time.monotonic() - trace_state["started"], 4), "update": sanitize_trace(update.to_dict()),
+             **trace_annotations(update)}
+    trace_state["file"].write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+background_tasks = TenantLocal("background_tasks", list)
+
 async def post_init(application: Application):
-    await set_bot_commands(application)
+    if tenant() not in active_tenants:
+        active_tenants.append(tenant())
+    if worker_shard in (None, 0):
+        await set_bot_commands(application)
+    tenant_queue_depths["updates"] = application.update_queue.qsize
+    await start_shared_services()
+    background_tasks.append(asyncio.create_task(block_digest_loop(application.bot)))
+    background_tasks.append(asyncio.create_task(last_seen_flush_loop()))
+    background_tasks.append(asyncio.create_task(outbox_loop(application.bot)))
+    if BACKUP_INTERVAL > 0 and worker_shard in (None, 0):
+        background_tasks.append(asyncio.create_task(backup_loop()))
+    print(f"Ishga tushish vaqti: {time.perf_counter() - PROCESS_START:.2f} s")
+
+async def post_shutdown(application: Application):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    try:
+        await send_block_digest(application.bot)
+    except Exception as e:
+        print(f"Bloklash digestini yuborishda xato: {e}")
+    flush_last_seen()
+    await stop_shared_services()
+    if trace_state["file"] is not None:
+        trace_state["file"].close()
+        trace_state["file"] = None
+    if tenant() in active_tenants:
+        active_tenants.remove(tenant())
+
+COMMANDS = {
+    "start": start,
+    "lang": lang,
+    "mystats": mystats,
+    "inbox": inbox_command,
+    "blacklist": blacklist,
+    "url": url_command,
+    "help": help_command,
+    "admin": admin,
+    "stats": stats,
+    "ban": ban,
+    "unban": unban,
+    "warn": warn,
+    "metrics": metrics_command,
+    "queries": queries_command,
+    "flood": flood_command,
+    "outbox": outbox_command,
+    "export": export_command,
+    "search": search_command,
+    "backup": backup_command,
+    "profile": profile_command,
+}
+
+# Bot API ulanishlar puli: outbox workerlari, fon sikllari va handlerlar bir
+# vaqtda so'rov yuboradi (Bot() ning standart HTTPXRequest i bitta ulanishli)
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', str(OUTBOX_WORKERS + 16)))
+
+def build_application(updater=True, request=None) -> Application:
+    # request: maxsus BaseRequest (replay.py soxta Bot API uchun ishlatadi)
+    if request is None:
+        request = HTTPXRequest(connection_pool_size=HTTP_POOL_SIZE)
+    governor = ApiGovernor()
+    tenant_queue_depths["api_interactive_waiting"] = lambda: governor.waiting[INTERACTIVE_LANE]
+    tenant_queue_depths["api_bulk_waiting"] = lambda: governor.waiting[BULK_LANE]
+    bot = MetricsBot(token=tenant().token, rate_limiter=governor, request=request)
+    builder = Application.builder().bot(bot).post_init(post_init).post_shutdown(post_shutdown)
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
+    if TRACE_PATH:
+        app.add_handler(TypeHandler(Update, record_trace), group=-2)
+    app.add_handler(TypeHandler(Update, record_last_seen), group=-1)
+    # Albom oynasi yopilganda yoki shu foydalanuvchidan keyingi update kelganda (har qanday handlerdan oldin)
+    app.add_handler(TypeHandler(AlbumFlush, instrumented(handle_album_flush, "album_flush")), group=-3)
+    app.add_handler(TypeHandler(Update, flush_pending_albums), group=-3)
+    for command, callback in COMMANDS.items():
+        app.add_handler(CommandHandler(command, instrumented(callback, f"command:{command}")))
+    app.add_handler(ChatMemberHandler(instrumented(track_channel_member), ChatMemberHandler.CHAT_MEMBER))
+    app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, instrumented(handle_message)))
+    app.add_handler(CallbackQueryHandler(instrumented(button_callback)))
+    return app
+
+# Sharded rejim: WORKERS ta jarayon, har biri user_id bo'yicha o'z shardiga ega.
+# Dispatcher webhookni qabul qiladi va har bir update ni egasining workeriga
+# yuboradi; worker update larni ketma-ket bajaradi, shuning uchun bitta
+# foydalanuvchi xabarlari tartibi saqlanadi.
+WORKERS = int(os.getenv('WORKERS', '1'))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
+def update_shard_key(data: dict) -> int:
+    for value in data.values():
+        if isinstance(value, dict):
+            if isinstance(value.get('from'), dict):
+                return value['from']['id']
+            if isinstance(value.get('user'), dict):
+                return value['user']['id']
+            if isinstance(value.get('chat'), dict):
+                return value['chat']['id']
+    return 0
+
+def shard_for(user_id: int, workers: int) -> int:
+    return user_id % workers
+
+async def worker_main(shard: int, inbox, outbox):
+    global worker_shard, state_outbox, METRICS_PORT
+    worker_shard = shard
+    state_outbox = outbox
+    if METRICS_PORT:
+        METRICS_PORT += shard
+    app = build_application(updater=False)
+    loop = asyncio.get_running_loop()
+    async with app:
+        await post_init(app)
+        await app.start()
+        print(f"Worker {shard} ishga tushdi")
+        while True:
+            item = await loop.run_in_executor(None, inbox.get)
+            if item is None:
+                break
+            if item[0] == "update":
+                await app.update_queue.put(Update.de_json(item[1], app.bot))
+            elif item[0] == "state":
+                apply_state_change(item[1], item[2])
+        await app.stop()
+        await post_shutdown(app)
+
+def run_worker(shard: int, inbox, outbox):
+    try:
+        asyncio.run(worker_main(shard, inbox, outbox))
+    except KeyboardInterrupt:
+        pass
+
+async def dispatcher_main(inboxes: list, state_queue):
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    def receive_update(headers, body):
+        if WEBHOOK_SECRET and headers.get('x-telegram-bot-api-secret-token') != WEBHOOK_SECRET:
+            return 403, "text/plain", "forbidden\n"
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400, "text/plain", "bad json\n"
+        inboxes[shard_for(update_shard_key(data), len(inboxes))].put(("update", data))
+        return 200, "text/plain", "ok\n"
+
+    async def fan_out_state_changes():
+        while True:
+            item = await loop.run_in_executor(None, state_queue.get)
+            if item is None:
+                return
+            origin, kind, key = item
+            for shard, inbox in enumerate(inboxes):
+                if shard != origin:
+                    inbox.put(("state", kind, key))
+
+    routes = {WEBHOOK_PATH: receive_update}
+    server = await asyncio.start_server(functools.partial(handle_http_request, routes=routes), WEBHOOK_LISTEN, WEBHOOK_PORT)
+    fan_out_task = asyncio.create_task(fan_out_state_changes())
+    async with ExtBot(token=tenant().token) as bot:
+        await bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+    print(f"Dispatcher {len(inboxes)} worker bilan {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH} da ishga tushdi")
+    await stop_event.wait()
+    server.close()
+    await server.wait_closed()
+    state_queue.put(None)
+    await fan_out_task
+
+def run_sharded(workers: int):
+    if not WEBHOOK_URL:
+        raise SystemExit("WORKERS > 1 uchun WEBHOOK_URL kerak")
+    mp_context = multiprocessing.get_context("spawn")
+    state_queue = mp_context.Queue()
+    inboxes = [mp_context.Queue() for _ in range(workers)]
+    processes = [mp_context.Process(target=run_worker, args=(shard, inboxes[shard], state_queue), daemon=True)
+                 for shard in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        asyncio.run(dispatcher_main(inboxes, state_queue))
+    finally:
+        for inbox in inboxes:
+            inbox.put(None)
+        for process in processes:
+            process.join(timeout=30)
+
+# Bir nechta bot bitta jarayonda: umumiy event loop va Bot API ulanishlar puli.
+# getUpdates uzun so'rovlari har bir botning o'z ulanishida qoladi.
+
+class SharedRequest(BaseRequest):
+    # Bir nechta Bot ulashadigan so'rov: oxirgi bot to'xtaganda yopiladi
+    def __init__(self, request: BaseRequest):
+        self.request = request
+        self.users = 0
+
+    @property
+    def read_timeout(self):
+        return self.request.read_timeout
+
+    async def initialize(self):
+        self.users += 1
+        if self.users == 1:
+            await self.request.initialize()
+
+    async def shutdown(self):
+        self.users -= 1
+        if self.users == 0:
+            await self.request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        return await self.request.do_request(url, method, request_data=request_data, read_timeout=read_timeout,
+                                             write_timeout=write_timeout, connect_timeout=connect_timeout,
+                                             pool_timeout=pool_timeout)
+
+async def run_tenant(bot_tenant: Tenant, request: BaseRequest, stop_event: asyncio.Event):
+    # Shu task ichida o'rnatilgan tenant Application yaratgan barcha tasklarga o'tadi
+    current_tenant.set(bot_tenant)
+    print(f"{bot_tenant.name}: sxema versiyasi {storage.migrate()}")
+    app = build_application(request=request)
+    async with app:
+        await post_init(app)
+        await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        await app.start()
+        print(f"{bot_tenant.name} (@{bot_tenant.username}) ishga tushdi")
+        await stop_event.wait()
+        await app.updater.stop()
+        await app.stop()
+        await post_shutdown(app)
+
+async def multi_bot_main(tenants: list):
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    request = SharedRequest(HTTPXRequest(connection_pool_size=HTTP_POOL_SIZE * len(tenants)))
+    # HTTP server va watchdog birorta bot to'xtashi bilan emas, jarayon oxirida to'xtaydi
+    await start_shared_services()
+    try:
+        results = await asyncio.gather(*(run_tenant(bot_tenant, request, stop_event) for bot_tenant in tenants),
+                                       return_exceptions=True)
+    finally:
+        await stop_shared_services()
+    for bot_tenant, result in zip(tenants, results):
+        if isinstance(result, Exception):
+            print(f"{bot_tenant.name} xato bilan to'xtadi: {result!r}")
 
 def main():
-    app = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("lang", lang))
-    app.add_handler(CommandHandler("mystats", mystats))
-    app.add_handler(CommandHandler("blacklist", blacklist))
-    app.add_handler(CommandHandler("url", url_command))
-    app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CommandHandler("admin", admin))
-    app.add_handler(CommandHandler("stats", stats))
-    app.add_handler(CommandHandler("ban", ban))
-    app.add_handler(CommandHandler("unban", unban))
-    app.add_handler(CommandHandler("warn", warn))
-    app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, handle_message))
-    app.add_handler(CallbackQueryHandler(button_callback))
+    if BOTS_FILE:
+        if WORKERS > 1:
+            raise SystemExit("BOTS_FILE va WORKERS > 1 birga ishlatilmaydi")
+        asyncio.run(multi_bot_main(load_tenants(BOTS_FILE)))
+        return
+    if not ADMIN_ID:
+        raise SystemExit("ADMIN_ID o'rnatilmagan")
+    migrate_start = time.perf_counter()
+    schema_version = storage.migrate()
+    print(f"Sxema versiyasi {schema_version}, tekshiruv {(time.perf_counter() - migrate_start) * 1000:.1f} ms")
+    if WORKERS > 1:
+        run_sharded(WORKERS)
+        return
+    app = build_application()
     print("Bot ishga tushdi...")
-    app.run_polling()
+    # chat_member update lari standart ro'yxatda yo'q: aniq so'raladi
+    app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
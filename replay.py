@@ -0,0 +1,217 @@
+# Trafik izini qayta o'ynatish: TRACE_PATH bilan yozilgan JSONL izni soxta Bot API
+# ustida Application ga N barobar tezlikda beradi va natijani chiqaradi:
+# o'tkazuvchanlik, kechikish taqsimoti, baza vaqti va yo'qolgan update lar.
+#
+#   TRACE_PATH=trace.jsonl python anonimsavol.py      # izni yozish
+#   python replay.py trace.jsonl --speed 10          # 10x tezlikda o'ynatish
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import tempfile
+import time
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def read_trace(path: str):
+    with open(path, encoding="utf-8") as trace:
+        for line in trace:
+            if line.strip():
+                yield json.loads(line)
+
+
+def seed_ref_targets(bot, path: str) -> int:
+    # Toza bazada /start havolalari egalari yo'q: ularni oldindan yaratamiz.
+    # Maxsus havolalar izda xeshlangan kod va egasi bilan yozilgan ("ref").
+    targets, custom_refs = set(), {}
+    for entry in itertools.islice(read_trace(path), 1, None):
+        if "ref" in entry:
+            custom_refs[entry["ref"]["owner"]] = entry["ref"]["code"]
+            continue
+        text = (entry["update"].get("message") or {}).get("text") or ""
+        if text.startswith("/start "):
+            try:
+                targets.add(bot.decode_user_id(text.split(" ", 1)[1]))
+            except ValueError:
+                pass
+    for user_id in targets | set(custom_refs):
+        bot.storage.add_user(user_id)
+    for user_id, code in custom_refs.items():
+        bot.storage.set_custom_ref(user_id, code)
+    return len(targets | set(custom_refs))
+
+
+def remap_reply(entry: dict, sent: dict, storage) -> bool:
+    # reply_to_message ID si jonli chatdagi ID: replayda shu yuboruvchidan yetkazilgan
+    # oxirgi xabar ID siga almashtiriladi. Topilmasa (yetkazish hali tugamagan) False.
+    message = entry["update"].get("message") or {}
+    reply_to = message.get("reply_to_message")
+    if not reply_to or "reply_sender" not in entry:
+        return True
+    chat_id = message["chat"]["id"]
+    for delivered_id in reversed(sent.get(chat_id, [])):
+        delivery = storage.get_delivery(chat_id, delivered_id)
+        if delivery and delivery["sender_id"] == entry["reply_sender"]:
+            reply_to["message_id"] = delivered_id
+            return True
+    return False
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Yozilgan update izini soxta Bot API ustida qayta o'ynatish")
+    parser.add_argument("trace", help="TRACE_PATH bilan yozilgan JSONL fayl")
+    parser.add_argument("--speed", type=float, default=1.0, help="tezlik koeffitsienti (10 = 10x tez)")
+    parser.add_argument("--db", help="SQLite fayl (standart: vaqtinchalik yangi baza)")
+    parser.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="soxta Bot API javob vaqti, soniya")
+    parser.add_argument("--drain", type=float, default=30.0, help="oxirgi update dan keyin kutish, soniya")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    header = next(read_trace(args.trace))
+    if not header.get("header"):
+        raise SystemExit("Iz fayli sarlavhasiz: TRACE_PATH bilan yozilgan faylni bering")
+    # Bot moduli sozlamalarni import paytida o'qiydi
+    os.environ.pop("TRACE_PATH", None)
+    os.environ.setdefault("BOT_TOKEN", f"{header['bot_id']}:REPLAY")
+    os.environ["BOT_USERNAME"] = header.get("bot_username") or "replay_bot"
+    os.environ["ADMIN_ID"] = str(header["admin"])
+    os.environ["STORAGE"] = args.storage
+    os.environ["DB_PATH"] = args.db or os.path.join(tempfile.mkdtemp(prefix="replay-"), "bot.db")
+    asyncio.run(replay(args, header))
+
+
+async def replay(args, header):
+    import anonimsavol as bot
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    from telegram.request import BaseRequest
+
+    class FakeRequest(BaseRequest):
+        # Bot API o'rniga: har bir so'rov api_latency kutadi va minimal javob qaytaradi.
+        # ID lar izdagi (jonli) ID lar bilan to'qnashmasligi uchun katta sondan boshlanadi.
+        def __init__(self):
+            self.message_ids = itertools.count(1_000_000_000)
+            self.sent = {}  # chat_id -> yuborilgan message_id lar
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                             connect_timeout=None, pool_timeout=None):
+            endpoint = url.rsplit("/", 1)[-1]
+            parameters = request_data.parameters if request_data else {}
+            await asyncio.sleep(args.api_latency)
+            return 200, json.dumps({"ok": True, "result": self.result(endpoint, parameters)}).encode()
+
+        def result(self, endpoint, parameters):
+            if endpoint == "getMe":
+                return {"id": header["bot_id"], "is_bot": True, "first_name": "Replay",
+                        "username": os.environ["BOT_USERNAME"]}
+            if endpoint == "getChat":
+                return {"id": parameters["chat_id"], "type": "private", "first_name": "first_name"}
+            if endpoint == "getChatMember":
+                return {"status": "member", "user": {"id": parameters["user_id"], "is_bot": False, "first_name": "first_name"}}
+            if endpoint.startswith(("send", "forward", "copy", "edit")):
+                chat_id = parameters.get("chat_id", 0)
+                count = len(parameters["media"]) if endpoint == "sendMediaGroup" else 1
+                messages = [{"message_id": next(self.message_ids), "date": int(time.time()),
+                             "chat": {"id": chat_id, "type": "private"}} for _ in range(count)]
+                if not endpoint.startswith("edit"):
+                    self.sent.setdefault(chat_id, []).extend(message["message_id"] for message in messages)
+                return messages if endpoint == "sendMediaGroup" else messages[0]
+            return True
+
+    schema_version = bot.storage.migrate()
+    print(f"Baza: {os.environ['DB_PATH'] if args.storage == 'sqlite' else 'memory'} (sxema {schema_version}), "
+          f"{seed_ref_targets(bot, args.trace)} ta havola egasi yaratildi")
+
+    request = FakeRequest()
+    app = bot.build_application(updater=False, request=request)
+    pending = {}  # update_id -> navbatga qo'yilgan vaqt
+    latencies = []
+    errors = {}
+    unrouted = 0
+
+    def finish(update):
+        if isinstance(update, Update):
+            started = pending.pop(update.update_id, None)
+            if started is not None:
+                latencies.append(time.perf_counter() - started)
+
+    async def mark_done(update, context):
+        finish(update)
+
+    async def on_error(update, context):
+        name = type(context.error).__name__
+        errors[name] = errors.get(name, 0) + 1
+        finish(update)
+
+    # Eng oxirgi guruh: update barcha handlerlardan o'tgach kechikish yoziladi
+    app.add_handler(TypeHandler(Update, mark_done), group=99)
+    app.add_error_handler(on_error)
+
+    sent = 0
+    async with app:
+        await bot.post_init(app)
+        await app.start()
+        bot.sql_latency.clear()  # migratsiya va seed so'rovlari hisobga kirmaydi
+        started = time.perf_counter()
+        first_offset = None
+        for entry in itertools.islice(read_trace(args.trace), 1, None):
+            if first_offset is None:
+                first_offset = entry["t"]
+            delay = started + (entry["t"] - first_offset) / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if not remap_reply(entry, request.sent, bot.storage):
+                unrouted += 1
+            update = Update.de_json(entry["update"], app.bot)
+            pending[update.update_id] = time.perf_counter()
+            await app.update_queue.put(update)
+            sent += 1
+        fed = time.perf_counter() - started
+        deadline = time.perf_counter() + args.drain
+        while pending and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        # stop() navbatdagi update larni ham bajaradi: ular hisobga kirmaydi
+        completed, dropped = sorted(latencies), len(pending)
+        await app.stop()
+        await bot.post_shutdown(app)
+
+    print(f"Update lar: {sent} yuborildi, {len(completed)} bajarildi, {dropped} yo'qoldi (drain {args.drain:g} s ichida bajarilmadi)")
+    print(f"Vaqt: {fed:.2f} s berish, {elapsed:.2f} s jami; o'tkazuvchanlik {len(completed) / elapsed if elapsed else 0:.1f} update/s")
+    print("Kechikish (ms): " + ", ".join(
+        f"{name} {percentile(completed, fraction) * 1000:.1f}"
+        for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))))
+    # Replay bitta jarayon va bitta ulanishda ishlaydi, shuning uchun SQLITE_BUSY bo'lmaydi:
+    # raqobat o'rniga so'rovlar event loop ni band qilgan vaqt ko'rsatiladi
+    db_time = sum(histogram.sum for histogram in bot.sql_latency.values())
+    db_queries = sum(histogram.count for histogram in bot.sql_latency.values())
+    heaviest = sorted(bot.sql_latency.items(), key=lambda item: -item[1].sum)[:3]
+    print(f"Baza: {db_queries} so'rov, {db_time:.2f} s ({db_time / elapsed * 100 if elapsed else 0:.1f}% vaqt); "
+          + ", ".join(f"{label} {histogram.sum * 1000:.0f} ms" for label, histogram in heaviest))
+    if unrouted:
+        print(f"Reply lar: {unrouted} tasi yetkazilgan xabarga bog'lanmadi (yetkazish replaydan orqada qoldi)")
+    if errors:
+        print("Xatolar: " + ", ".join(f"{name} {count}" for name, count in sorted(errors.items(), key=lambda item: -item[1])))
+    calls = {}
+    for (endpoint, outcome), count in bot.api_calls.items():
+        calls[endpoint] = calls.get(endpoint, 0) + count
+    print("Bot API: " + ", ".join(f"{endpoint} {count}" for endpoint, count in sorted(calls.items(), key=lambda item: -item[1])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+
+# Modul sozlamalarni import paytida o'qiydi
+os.environ.setdefault("BOT_TOKEN", "1:TEST")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="anonimsavol-tests-"), "bot.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from telegram.request import BaseRequest
+
+import anonimsavol as bot
+
+ADMIN = 1
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def tenant(tmp_path, monkeypatch):
+    # Har bir test o'z bazasi va holati bilan alohida tenant ichida ishlaydi
+    monkeypatch.setattr(bot, "STORAGE", "sqlite")
+    test_tenant = bot.Tenant("test", "1:TEST", ADMIN, "TestBot", str(tmp_path / "bot.db"))
+    token = bot.current_tenant.set(test_tenant)
+    bot.storage.migrate()
+    yield test_tenant
+    if "storage" in test_tenant.state and hasattr(test_tenant.state["storage"], "close"):
+        test_tenant.state["storage"].close()
+    bot.current_tenant.reset(token)
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def any_storage(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "STORAGE", request.param)
+    test_tenant = bot.Tenant("test", "1:TEST", ADMIN, "TestBot", str(tmp_path / "bot.db"))
+    token = bot.current_tenant.set(test_tenant)
+    bot.storage.migrate()
+    yield bot.storage
+    bot.current_tenant.reset(token)
+
+
+class FakeRequest(BaseRequest):
+    # Soxta Bot API: chaqiruvlarni yozib boradi, fail[endpoint] dagi xatolarni bir marta ko'taradi
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = []  # (endpoint, parameters, vaqt)
+        self.fail = {}  # endpoint -> [exception, ...]
+        self.message_ids = itertools.count(1000)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def endpoints(self, *names):
+        return [(endpoint, parameters) for endpoint, parameters, _ in self.calls if not names or endpoint in names]
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls.append((endpoint, parameters, time.monotonic()))
+        if self.fail.get(endpoint):
+            raise self.fail[endpoint].pop(0)
+        return 200, json.dumps({"ok": True, "result": self.result(endpoint, parameters)}).encode()
+
+    def result(self, endpoint, parameters):
+        if endpoint == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Test", "username": "TestBot"}
+        if endpoint == "getChat":
+            return {"id": parameters["chat_id"], "type": "private", "first_name": "Receiver"}
+        if endpoint == "getChatMember":
+            return {"status": "member", "user": {"id": parameters["user_id"], "is_bot": False, "first_name": "U"}}
+        if endpoint.startswith(("send", "forward", "copy")):
+            chat = {"id": parameters.get("chat_id", 0), "type": "private"}
+            if endpoint == "sendMediaGroup":
+                return [{"message_id": next(self.message_ids), "date": 0, "chat": chat} for _ in parameters["media"]]
+            return {"message_id": next(self.message_ids), "date": 0, "chat": chat}
+        return True
+
+
+@pytest.fixture
+def fake_request():
+    return FakeRequest()
+
+
+def user(user_id, first_name="User"):
+    return {"id": user_id, "is_bot": False, "first_name": first_name}
+
+
+def message_update(update_id, user_id, text=None, **fields):
+    message = {"message_id": update_id, "date": 0, "chat": {"id": user_id, "type": "private"}, "from": user(user_id)}
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    message.update(fields)
+    return {"update_id": update_id, "message": message}
+
+
+@pytest.fixture
+def app(tenant, fake_request):
+    # Handlerlar to'plami soxta Bot API ustida; update lar process_update bilan beriladi
+    application = bot.build_application(updater=False, request=fake_request)
+    run(application.initialize())
+    yield application
+    run(application.shutdown())
+
+
+def process(application, *updates):
+    from telegram import Update
+
+    async def feed():
+        for data in updates:
+            await application.process_update(Update.de_json(data, application.bot))
+
+    run(feed())
+
+
+def callback_update(update_id, user_id, data, message_id=500):
+    message = {"message_id": message_id, "date": 0, "chat": {"id": user_id, "type": "private"}, "text": "..."}
+    return {"update_id": update_id, "callback_query": {"id": str(update_id), "from": user(user_id),
+                                                       "chat_instance": "1", "data": data, "message": message}}
+
+
+def count_calls(test_tenant, monkeypatch, name):
+    # Tenant omborining metodiga murojaatlarni sanaydi (kesh bazaga bormaganini tekshirish uchun)
+    calls = []
+    instance = test_tenant.state["storage"]
+    original = getattr(instance, name)
+    monkeypatch.setattr(instance, name, lambda *args: calls.append(args) or original(*args))
+    return calls
@@ -0,0 +1,81 @@
+import asyncio
+import json
+import time
+
+from telegram import Update
+
+from conftest import bot, message_update, run
+
+
+def photo_update(update_id, user_id, group="g1", caption=None):
+    photo = [{"file_id": f"PHOTO{update_id}", "file_unique_id": f"u{update_id}", "width": 90, "height": 90}]
+    fields = {"photo": photo, "media_group_id": group}
+    if caption:
+        fields["caption"] = caption
+    return message_update(update_id, user_id, **fields)
+
+
+def feed(application, *updates, settle=0.5):
+    async def scenario():
+        await application.start()
+        for data in updates:
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await asyncio.sleep(settle)
+        await application.stop()
+
+    run(scenario())
+
+
+def texts_to(fake_request, chat_id):
+    return [parameters["text"] for _, parameters in fake_request.endpoints("sendMessage") if parameters["chat_id"] == chat_id]
+
+
+def test_album_is_buffered_into_one_message(app, fake_request, monkeypatch):
+    monkeypatch.setattr(bot, "MEDIA_GROUP_WINDOW", 0.1)
+    bot.storage.add_user(6)
+    bot.storage.set_session(5, "send", "6")
+    feed(app, photo_update(1, 5, caption="albom"), photo_update(2, 5), photo_update(3, 5))
+    message, = bot.storage.conn.execute("SELECT media_type, file_id, caption FROM messages").fetchall()
+    assert message["media_type"] == "album" and message["caption"] == "albom"
+    assert len(json.loads(message["file_id"])) == 3
+    assert not bot.media_groups
+
+
+def test_text_after_album_is_handled_after_it(app, fake_request, monkeypatch):
+    monkeypatch.setattr(bot, "MEDIA_GROUP_WINDOW", 5)
+    bot.storage.add_user(6)
+    bot.storage.set_session(5, "send", "6")
+    feed(app, photo_update(1, 5), photo_update(2, 5), message_update(3, 5, "keyin"), settle=0.3)
+    media_types = [row[0] for row in bot.storage.conn.execute("SELECT media_type FROM messages")]
+    assert media_types == ["album"]
+    replies = texts_to(fake_request, 5)
+    assert replies.index(bot.get_translation("uz", "message_sent")) < replies.index(bot.get_translation("uz", "use_link_first"))
+
+
+def test_album_delivery_records_every_message(app, fake_request, monkeypatch):
+    monkeypatch.setattr(bot, "MEDIA_GROUP_WINDOW", 0.1)
+    bot.storage.add_user(6)
+    bot.storage.set_session(5, "send", "6")
+    feed(app, photo_update(1, 5), photo_update(2, 5), photo_update(3, 5))
+    row, = bot.storage.claim_outbox(time.time() + 1, bot.OUTBOX_LEASE, 10)
+    run(bot.process_outbox_row(app.bot, row))
+    (_, parameters), = fake_request.endpoints("sendMediaGroup")
+    assert len(parameters["media"]) == 3
+    delivered = [key for key in range(1000, 1100) if bot.storage.get_delivery(6, key)]
+    # Albomning uchala xabari va bloklash tugmali xabar
+    assert len(delivered) == 4
+    assert bot.storage.count_outbox() == 0
+
+
+def test_album_buffer_is_capped(app, fake_request, monkeypatch):
+    monkeypatch.setattr(bot, "MEDIA_GROUP_WINDOW", 5)
+    feed(app, *(photo_update(number, 5) for number in range(1, 13)), settle=0.1)
+    assert len(bot.media_groups[(5, "g1")]["updates"]) == bot.MEDIA_GROUP_MAX_ITEMS
+
+
+def test_album_is_flood_limited_before_buffering(app, fake_request, monkeypatch):
+    monkeypatch.setattr(bot, "MEDIA_GROUP_WINDOW", 5)
+    monkeypatch.setattr(bot, "sender_limiter", bot.SlidingWindowLimiter(1, 60))
+    feed(app, message_update(1, 5, "salom"), photo_update(2, 5), photo_update(3, 5), settle=0.1)
+    assert not bot.media_groups
+    assert texts_to(fake_request, 5) == [bot.get_translation("uz", "use_link_first"), bot.get_translation("uz", "flood_limited")]
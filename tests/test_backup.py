@@ -0,0 +1,96 @@
+import contextvars
+import gzip
+import sqlite3
+import threading
+
+import pytest
+
+from conftest import ADMIN, bot, message_update, process, run
+
+
+@pytest.fixture
+def backups(tenant, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "BACKUP_DIR", str(tmp_path / "backups"))
+    monkeypatch.setattr(bot, "BACKUP_STEP_PAUSE", 0)
+    return tmp_path / "backups" / tenant.name
+
+
+def open_snapshot(path, tmp_path):
+    raw = tmp_path / "restored.db"
+    with gzip.open(path, "rb") as compressed:
+        raw.write_bytes(compressed.read())
+    return sqlite3.connect(raw)
+
+
+def test_backup_is_a_valid_snapshot(backups, tmp_path):
+    for user_id in range(1, 51):
+        bot.storage.add_user(user_id)
+    result = run(bot.run_backup())
+    assert result["error"] is None and result["path"].startswith(str(backups))
+    conn = open_snapshot(result["path"], tmp_path)
+    assert conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 50
+    conn.close()
+    assert "Oxirgi nusxa" in bot.format_backup_status()
+
+
+def test_writes_continue_during_backup(backups, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "BACKUP_PAGES", 1)
+    for user_id in range(1, 2001):
+        bot.storage.add_user(user_id, "uz", "x" * 50)
+    started, written = threading.Event(), []
+    original_sleep = bot.time.sleep
+
+    def step_pause(seconds):
+        started.set()
+        original_sleep(0.001)
+
+    monkeypatch.setattr(bot.time, "sleep", step_pause)
+
+    def writer():
+        started.wait(5)
+        conn = bot.get_db_connection(bot.storage.path)
+        conn.execute("PRAGMA busy_timeout = 100")
+        conn.execute("INSERT INTO users (id) VALUES (9999)")
+        conn.commit()
+        conn.close()
+        written.append(bot.backup_status["running"])
+
+    # Oqim joriy tenantni ko'rishi uchun kontekst nusxasi bilan ishga tushadi
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(writer,))
+    thread.start()
+    result = run(bot.run_backup())
+    thread.join()
+    assert written == [True]
+    conn = open_snapshot(result["path"], tmp_path)
+    # Nusxa boshlangan paytdagi holat
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 2000
+    conn.close()
+
+
+def test_old_snapshots_are_pruned(backups, monkeypatch):
+    monkeypatch.setattr(bot, "BACKUP_KEEP", 2)
+    backups.mkdir(parents=True)
+    for stamp in ("20000101-000000", "20000102-000000"):
+        (backups / f"bot-{stamp}.db.gz").write_bytes(b"")
+    result = run(bot.run_backup())
+    assert sorted(path.name for path in backups.iterdir()) == ["bot-20000102-000000.db.gz", result["path"].rsplit("/", 1)[1]]
+
+
+def test_concurrent_backup_is_rejected(backups):
+    bot.backup_status["running"] = True
+    with pytest.raises(RuntimeError):
+        run(bot.run_backup())
+
+
+def test_backup_requires_sqlite(backups, monkeypatch):
+    monkeypatch.setattr(bot, "STORAGE", "memory")
+    with pytest.raises(RuntimeError):
+        run(bot.run_backup())
+
+
+def test_backup_command_reports_status(app, fake_request, backups):
+    process(app, message_update(1, 42, "/backup"), message_update(2, ADMIN, "/backup status"))
+    replies = [parameters["text"] for _, parameters in fake_request.endpoints("sendMessage")]
+    assert replies == [bot.get_translation("uz", "admin_only"), bot.format_backup_status()]
+    assert not backups.exists()
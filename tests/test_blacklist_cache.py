@@ -0,0 +1,53 @@
+from conftest import bot, message_update, process
+
+
+def count_loads(tenant, monkeypatch):
+    loads = []
+    instance = tenant.state["storage"]
+    original = instance.get_blacklist
+    monkeypatch.setattr(instance, "get_blacklist", lambda blocker_id: loads.append(blocker_id) or original(blocker_id))
+    return loads
+
+
+def test_blacklist_is_loaded_once(tenant, monkeypatch):
+    bot.storage.block_user(6, 5)
+    loads = count_loads(tenant, monkeypatch)
+    assert bot.is_user_blocked(6, 5)
+    assert not bot.is_user_blocked(6, 7)
+    assert bot.get_blacklist_count(6) == 1
+    assert loads == [6]
+
+
+def test_writes_update_the_cached_copy(tenant, monkeypatch):
+    loads = count_loads(tenant, monkeypatch)
+    assert not bot.is_user_blocked(6, 5)
+    bot.block_user(6, 5)
+    assert bot.is_user_blocked(6, 5)
+    assert bot.unblock_user(6, 5)
+    assert not bot.is_user_blocked(6, 5)
+    bot.block_user(6, 7)
+    bot.block_user(6, 8)
+    assert bot.clear_blacklist(6) == 2
+    assert bot.get_blacklist_count(6) == 0
+    assert loads == [6]
+    assert bot.storage.get_blacklist(6) == set()
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = bot.LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert "b" not in cache and "a" in cache and "c" in cache
+    assert len(cache) == 2
+
+
+def test_blocked_sender_is_rejected_on_send(app, fake_request):
+    bot.storage.add_user(6)
+    bot.block_user(6, 5)
+    bot.storage.set_session(5, "send", "6")
+    process(app, message_update(1, 5, "salom"))
+    assert bot.storage.count_messages() == 0
+    (_, parameters), = fake_request.endpoints("sendMessage")
+    assert parameters["text"] == bot.get_translation("uz", "user_banned")
@@ -0,0 +1,51 @@
+from conftest import ADMIN, bot, callback_update, process, run
+
+
+def report(sender_id, receiver_id, media_type="text", text="salom"):
+    return {"message_id": f"{sender_id}_{receiver_id}", "sender_id": sender_id, "receiver_id": receiver_id,
+            "sender_name": f"S{sender_id}", "sender_username": "s", "receiver_name": f"R{receiver_id}",
+            "text": text, "media_type": media_type}
+
+
+def test_digest_groups_reports_by_sender():
+    reports = [report(5, 6), report(5, 7, "photo"), report(8, 6)]
+    chunks, buttons = bot.format_block_digest(reports)
+    text, = chunks
+    assert "3 ta, 2 ta yuboruvchi" in text
+    assert text.index("ID: <code>5</code>") < text.index("ID: <code>8</code>")
+    assert "2 marta bloklandi" in text
+    assert buttons[0][0].callback_data == "report_media_5_7"
+
+
+def test_long_digest_is_split_into_chunks():
+    reports = [report(sender_id, 6, text="x" * 200) for sender_id in range(1000, 1040)]
+    chunks, _ = bot.format_block_digest(reports)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 4096 for chunk in chunks)
+
+
+def test_block_callback_queues_report_instead_of_sending(app, fake_request):
+    bot.storage.add_message(report(5, 6))
+    process(app, callback_update(1, 6, "block_5_6"))
+    assert [item["sender_id"] for item in bot.block_reports] == [5]
+    assert not [parameters for _, parameters in fake_request.endpoints("sendMessage") if parameters["chat_id"] == ADMIN]
+    assert bot.is_user_blocked(6, 5)
+
+
+def test_full_batch_wakes_the_digest_loop(tenant, monkeypatch):
+    monkeypatch.setattr(bot, "BLOCK_DIGEST_SIZE", 2)
+    bot.queue_block_report(report(5, 6))
+    assert not bot.block_reports_ready.is_set()
+    bot.queue_block_report(report(5, 7))
+    assert bot.block_reports_ready.is_set()
+
+
+def test_send_digest_goes_to_admin_and_clears_queue(app, fake_request):
+    bot.queue_block_report(report(5, 6))
+    bot.queue_block_report(report(8, 6, "photo"))
+    run(bot.send_block_digest(app.bot))
+    (_, parameters), = fake_request.endpoints("sendMessage")
+    assert parameters["chat_id"] == ADMIN and "report_media_8_6" in str(parameters["reply_markup"])
+    assert len(bot.block_reports) == 0
+    run(bot.send_block_digest(app.bot))
+    assert len(fake_request.endpoints("sendMessage")) == 1
@@ -0,0 +1,46 @@
+import queue
+
+from conftest import bot, count_calls, run
+
+CHANNEL = {"id": "@kanal", "link": "https://t.me/kanal", "name": "Kanal"}
+
+
+def test_settings_are_read_once(tenant, monkeypatch):
+    assert bot.is_notify_blocks_enabled()
+    reads = count_calls(tenant, monkeypatch, "get_setting")
+    assert bot.toggle_notify_blocks() == "off"
+    assert not bot.is_notify_blocks_enabled()
+    assert reads == []
+    assert bot.storage.get_setting("notify_blocks") == "off"
+
+
+def test_channels_are_read_once(tenant, monkeypatch):
+    bot.storage.set_channels([CHANNEL])
+    assert bot.config.get_channels() == (CHANNEL,)
+    reads = count_calls(tenant, monkeypatch, "get_channels")
+    run(bot.get_channels_keyboard("en"))
+    assert bot.config.get_channels() == (CHANNEL,)
+    assert reads == []
+
+
+def test_channel_change_clears_keyboard_cache(tenant):
+    bot.config.set_channels([CHANNEL])
+    keyboard = run(bot.get_channels_keyboard("uz"))
+    assert run(bot.get_channels_keyboard("uz")) is keyboard
+    other = dict(CHANNEL, id="@boshqa", link="https://t.me/boshqa")
+    bot.config.set_channels([other])
+    assert [row["link"] for row in bot.storage.get_channels()] == [other["link"]]
+    links = [row[0].url for row in run(bot.get_channels_keyboard("uz")).inline_keyboard[:-1]]
+    assert links == [other["link"]]
+
+
+def test_change_from_another_worker_is_reloaded(tenant, monkeypatch):
+    outbox = queue.Queue()
+    monkeypatch.setattr(bot, "state_outbox", outbox)
+    bot.toggle_notify_blocks()
+    assert outbox.get_nowait()[1:] == ("config", "notify_blocks")
+    # Boshqa worker bazani o'zgartirib xabar yuborgandek
+    bot.storage.set_setting("notify_blocks", "on")
+    assert not bot.is_notify_blocks_enabled()
+    bot.apply_state_change("config", "notify_blocks")
+    assert bot.is_notify_blocks_enabled()
@@ -0,0 +1,65 @@
+import csv
+import gzip
+import json
+import os
+
+from conftest import ADMIN, bot, message_update, process
+
+
+def add_messages(storage, count):
+    for number in range(count):
+        storage.add_message({"message_id": f"m{number}", "sender_id": 5, "receiver_id": 6,
+                             "text": f"matn {number}", "media_type": "text"})
+
+
+def test_export_pages_through_every_row(any_storage):
+    add_messages(any_storage, 25)
+    rows = list(any_storage.iter_export("messages", batch_size=10))
+    assert [row["message_id"] for row in rows] == [f"m{number}" for number in range(25)]
+    assert set(rows[0]) == set(bot.EXPORT_TABLES["messages"][1])
+
+
+def test_export_filters_by_date(tenant):
+    add_messages(bot.storage, 3)
+    for number, day in enumerate(("2024-01-01", "2024-01-02", "2024-01-03")):
+        bot.storage.conn.execute("UPDATE messages SET timestamp = ? WHERE message_id = ?", (f"{day} 12:00:00", f"m{number}"))
+    bot.storage.conn.commit()
+    rows = list(bot.storage.iter_export("messages", since="2024-01-02", until="2024-01-03"))
+    assert [row["message_id"] for row in rows] == ["m1"]
+
+
+def test_write_export_streams_gzip_files(tenant):
+    bot.storage.add_user(5, "uz", "Ali", "ali")
+    bot.storage.add_user(6, "en", "Vali", None)
+    path, count = bot.write_export("users", "csv")
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as export:
+            rows = list(csv.DictReader(export))
+    finally:
+        os.remove(path)
+    assert count == 2 and [row["id"] for row in rows] == ["5", "6"]
+
+    path, count = bot.write_export("users", "jsonl")
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as export:
+            rows = [json.loads(line) for line in export]
+    finally:
+        os.remove(path)
+    assert rows[1] == {"id": 6, "language": "en", "referrals": 0, "custom_ref": None, "first_name": "Vali", "username": None}
+
+
+def test_export_command_sends_document(app, fake_request, monkeypatch):
+    add_messages(bot.storage, 3)
+    written = []
+    original = bot.write_export
+    monkeypatch.setattr(bot, "write_export", lambda *args: written.append(original(*args)) or written[-1])
+    process(app, message_update(1, ADMIN, "/export messages jsonl"))
+    (_, parameters), = fake_request.endpoints("sendDocument")
+    assert parameters["caption"] == "messages: 3 qator"
+    assert not os.path.exists(written[0][0])
+
+
+def test_export_command_rejects_unknown_table(app, fake_request):
+    process(app, message_update(1, ADMIN, "/export sessions"))
+    (_, parameters), = fake_request.endpoints("sendMessage")
+    assert parameters["text"].startswith("Foydalanish: /export")
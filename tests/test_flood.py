@@ -0,0 +1,86 @@
+from conftest import bot, message_update, process
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_sliding_window_limits_and_recovers(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot.time, "monotonic", clock)
+    limiter = bot.SlidingWindowLimiter(2, 10)
+    assert limiter.hit("a") and limiter.hit("a")
+    assert not limiter.hit("a")
+    assert limiter.throttled == {"a": 1}
+    clock.now += 10
+    assert limiter.hit("a")
+
+
+def test_notify_once_per_window(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot.time, "monotonic", clock)
+    limiter = bot.SlidingWindowLimiter(1, 10)
+    assert limiter.should_notify("a")
+    assert not limiter.should_notify("a")
+    clock.now += 10
+    assert limiter.should_notify("a")
+
+
+def test_purge_evicts_idle_keys_but_keeps_stats(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot.time, "monotonic", clock)
+    limiter = bot.SlidingWindowLimiter(1, 10)
+    for key in range(100):
+        limiter.hit(key)
+        limiter.hit(key)
+        limiter.should_notify(key)
+    assert len(limiter.throttled) == 100
+    clock.now += 11
+    limiter.hit("fresh")
+    assert list(limiter.hits) == ["fresh"]
+    assert limiter.notified == {}
+    # /flood oynadan uzoqroq tarixni ko'rsatadi
+    assert len(limiter.throttled) == 100
+
+
+def test_throttled_stats_are_capped(monkeypatch):
+    limiter = bot.SlidingWindowLimiter(1, 10, stats_size=3)
+    for key in ("a", "b", "c", "a", "d"):
+        limiter.hit(key)
+        limiter.hit(key)
+    assert limiter.throttled == {"c": 1, "a": 3, "d": 1}
+
+
+def test_pair_limit_rejects_before_database_work(app, fake_request, monkeypatch):
+    monkeypatch.setattr(bot, "pair_limiter", bot.SlidingWindowLimiter(1, 60))
+    bot.storage.add_user(5)
+    bot.storage.add_user(6)
+    bot.storage.set_session(5, "send", "6")
+    process(app, message_update(1, 5, "birinchi"))
+    assert bot.storage.count_messages() == 1
+
+    writes = []
+    monkeypatch.setattr(bot, "update_user_info", lambda *args: writes.append(args))
+    bot.storage.set_session(5, "send", "6")
+    process(app, message_update(2, 5, "ikkinchi"))
+    assert writes == []
+    assert bot.storage.count_messages() == 1
+    assert fake_request.endpoints("sendMessage")[-1][1]["text"] == bot.get_translation('uz', 'flood_limited')
+
+
+def test_reply_pair_limit_rejects_before_database_work(app, fake_request, monkeypatch):
+    monkeypatch.setattr(bot, "pair_limiter", bot.SlidingWindowLimiter(0, 60))
+    bot.storage.add_delivery(6, 77, 5)
+    checks = []
+    monkeypatch.setattr(bot, "update_user_info", lambda *args: checks.append("user_info"))
+    monkeypatch.setattr(bot, "check_channel_membership", lambda *args: checks.append("membership"))
+    reply_to = {"message_id": 77, "date": 0, "chat": {"id": 6, "type": "private"}, "text": "...",
+                "from": {"id": 1, "is_bot": True, "first_name": "Test"}}
+    process(app, message_update(1, 6, "javob", reply_to_message=reply_to))
+    assert checks == []
+    assert bot.storage.get_session(6) is None
+    assert fake_request.endpoints("sendMessage")[-1][1]["text"] == bot.get_translation('uz', 'flood_limited')
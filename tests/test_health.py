@@ -0,0 +1,60 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from conftest import bot, run
+
+
+@pytest.fixture
+def watchdog(monkeypatch):
+    monkeypatch.setattr(bot, "LOOP_LAG_INTERVAL", 0.02)
+    monkeypatch.setattr(bot, "LOOP_STALL_THRESHOLD", 0.15)
+    for key, value in {"heartbeat": time.monotonic(), "lag": 0.0, "max_lag": 0.0, "stalls": 0, "last_stall": None}.items():
+        monkeypatch.setitem(bot.loop_watchdog, key, value)
+    monkeypatch.setattr(bot, "loop_lag", {})
+    return bot.loop_watchdog
+
+
+def blocking_handler():
+    time.sleep(0.4)
+
+
+def test_stall_is_captured_with_stack(watchdog):
+    async def scenario():
+        bot.start_loop_watchdog()
+        monitor = asyncio.create_task(bot.loop_lag_monitor())
+        await asyncio.sleep(0.1)
+        blocking_handler()
+        await asyncio.sleep(0.1)
+        monitor.cancel()
+        bot.stop_loop_watchdog()
+
+    run(scenario())
+    assert watchdog["stalls"] == 1
+    assert "blocking_handler" in watchdog["last_stall"]["stack"]
+    assert watchdog["max_lag"] >= 0.3
+    metrics = bot.render_metrics()
+    assert 'bot_event_loop_lag_seconds_count{loop="event_loop"}' in metrics
+    assert "bot_event_loop_stalls_total 1" in metrics
+
+
+def test_liveness_follows_heartbeat(tenant, watchdog):
+    status, _, body = bot.health_response(ready=False)
+    assert status == 200 and json.loads(body)["status"] == "ok"
+    watchdog["heartbeat"] = time.monotonic() - 1
+    assert bot.health_response(ready=False)[0] == 503
+
+
+def test_readiness_checks_db_and_backlog(tenant, watchdog, monkeypatch):
+    assert bot.health_response(ready=True)[0] == 200
+    # Test tenanti har safar yangi: navbat o'lchagichini to'g'ridan-to'g'ri beramiz
+    bot.tenant_queue_depths["updates"] = lambda: bot.HEALTH_MAX_PENDING
+    status, _, body = bot.health_response(ready=True)
+    assert status == 503 and json.loads(body)["pending_updates"] == bot.HEALTH_MAX_PENDING
+    assert bot.health_response(ready=False)[0] == 200
+    bot.tenant_queue_depths["updates"] = lambda: 0
+    monkeypatch.setattr(tenant.state["storage"], "ping", lambda: 1 / 0)
+    status, _, body = bot.health_response(ready=True)
+    assert status == 503 and json.loads(body)["db"] is False
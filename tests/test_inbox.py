@@ -0,0 +1,58 @@
+from conftest import bot, callback_update, message_update, process
+
+
+def add_messages(storage, count):
+    # Har ikkinchi xabar boshqa qabul qiluvchiga: sahifalar faqat o'zinikini ko'rsatadi
+    for number in range(count * 2):
+        storage.add_message({"message_id": f"m{number}", "sender_id": 5, "receiver_id": 6 + number % 2,
+                             "text": f"matn {number}", "media_type": "text"})
+
+
+def page_texts(page):
+    return [row["text"] for row in page]
+
+
+def test_keyset_pages_walk_both_ways(any_storage):
+    add_messages(any_storage, 7)
+    first = any_storage.list_inbox(6, limit=3)
+    assert page_texts(first) == ["matn 12", "matn 10", "matn 8"]
+    second = any_storage.list_inbox(6, before=first[-1]["row_key"], limit=3)
+    assert page_texts(second) == ["matn 6", "matn 4", "matn 2"]
+    assert page_texts(any_storage.list_inbox(6, before=second[-1]["row_key"], limit=3)) == ["matn 0"]
+    assert page_texts(any_storage.list_inbox(6, after=second[0]["row_key"], limit=3)) == page_texts(first)
+
+
+def test_inbox_uses_receiver_index(tenant):
+    plan = " ".join(row[3] for row in bot.storage.conn.execute(
+        "EXPLAIN QUERY PLAN SELECT message_id FROM messages WHERE receiver_id = ? AND rowid < ? ORDER BY rowid DESC LIMIT ?",
+        (6, 100, 6)))
+    assert "messages_receiver_idx" in plan and "TEMP B-TREE" not in plan
+
+
+def test_page_navigation_buttons(tenant, monkeypatch):
+    monkeypatch.setattr(bot, "INBOX_PAGE_SIZE", 3)
+    add_messages(bot.storage, 7)
+    text, markup = bot.format_inbox_page(6, "uz")
+    assert "matn 12" in text and "matn 6" not in text
+    assert [button.callback_data[:12] for button in markup.inline_keyboard[-1]] == ["inbox_older_"]
+    row_key = int(markup.inline_keyboard[-1][0].callback_data.rsplit("_", 1)[1])
+    text, markup = bot.format_inbox_page(6, "uz", before=row_key)
+    assert [button.callback_data[:12] for button in markup.inline_keyboard[-1]] == ["inbox_newer_", "inbox_older_"]
+    assert bot.format_inbox_page(8, "uz") == (bot.get_translation("uz", "inbox_empty"), None)
+
+
+def test_inbox_callbacks(app, fake_request, monkeypatch):
+    monkeypatch.setattr(bot, "INBOX_PAGE_SIZE", 3)
+    add_messages(bot.storage, 7)
+    bot.storage.add_message({"message_id": "photo", "sender_id": 5, "receiver_id": 6, "media_type": "photo",
+                             "file_id": "FILE", "caption": "rasm"})
+    process(app, message_update(1, 6, "/inbox"))
+    markup = fake_request.endpoints("sendMessage")[-1][1]["reply_markup"]
+    assert markup["inline_keyboard"][0][0]["callback_data"] == "inbox_media_photo"
+    older = markup["inline_keyboard"][-1][0]["callback_data"]
+    process(app, callback_update(2, 6, older), callback_update(3, 6, "inbox_media_photo"),
+            callback_update(4, 7, "inbox_media_photo"))
+    edited = fake_request.endpoints("editMessageText")[-1][1]["text"]
+    assert "matn 8" in edited and "matn 12" not in edited
+    assert [parameters["chat_id"] for _, parameters in fake_request.endpoints("sendPhoto")] == [6]
+    assert fake_request.endpoints("sendMessage")[-1][1]["text"] == bot.get_translation("uz", "message_not_found")
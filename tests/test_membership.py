@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+from telegram import Chat
+
+from conftest import bot, process, run, user
+
+CHANNEL = {"id": "@Kanal", "link": "https://t.me/kanal", "name": "Kanal"}
+
+
+def member_update(update_id, user_id, status, chat_id=-100, username="Kanal"):
+    chat = {"id": chat_id, "type": "channel", "title": "Kanal", "username": username}
+    return {"update_id": update_id, "chat_member": {
+        "chat": chat, "from": user(user_id), "date": 0,
+        "old_chat_member": {"status": "left", "user": user(user_id)},
+        "new_chat_member": {"status": status, "user": user(user_id)}}}
+
+
+def check(app, user_id, refresh=False):
+    return run(bot.check_channel_membership(user_id, SimpleNamespace(bot=app.bot), refresh=refresh))
+
+
+def test_channel_keys_cover_id_and_username():
+    assert bot.channel_keys(Chat(-100, "channel", username="Kanal")) == ["-100", "@kanal"]
+    assert bot.channel_keys(Chat(-100, "channel")) == ["-100"]
+
+
+def test_memberships_are_stored_per_channel(any_storage):
+    any_storage.set_membership(["-100", "@kanal"], 5, "member")
+    any_storage.set_membership(["-100"], 5, "left")
+    assert any_storage.get_memberships(5, ["-100", "@kanal", "-200"]) == {"-100": "left", "@kanal": "member"}
+    assert any_storage.get_memberships(6, ["-100"]) == {}
+
+
+def test_join_and_leave_updates_gate_locally(app, fake_request):
+    bot.config.set_channels([CHANNEL])
+    process(app, member_update(1, 5, "member"))
+    assert check(app, 5)
+    process(app, member_update(2, 5, "left"))
+    assert not check(app, 5)
+    assert fake_request.endpoints("getChatMember") == []
+
+
+def test_unseen_user_falls_back_to_api_once(app, fake_request):
+    bot.config.set_channels([CHANNEL])
+    assert check(app, 6) and check(app, 6)
+    assert [parameters["user_id"] for _, parameters in fake_request.endpoints("getChatMember")] == [6]
+    assert bot.storage.get_memberships(6, ["@kanal"]) == {"@kanal": "member"}
+
+
+def test_refresh_rechecks_members_who_left(app, fake_request):
+    bot.config.set_channels([CHANNEL])
+    bot.storage.set_membership(["@kanal"], 7, "left")
+    assert not check(app, 7)
+    assert fake_request.endpoints("getChatMember") == []
+    assert check(app, 7, refresh=True)
+    assert bot.storage.get_memberships(7, ["@kanal"]) == {"@kanal": "member"}
+
+
+def test_non_member_answer_is_stored(app, fake_request, monkeypatch):
+    bot.config.set_channels([CHANNEL])
+    answers = iter(["left", "member"])
+    original = fake_request.result
+
+    def result(endpoint, parameters):
+        if endpoint == "getChatMember":
+            return {"status": next(answers), "user": user(parameters["user_id"])}
+        return original(endpoint, parameters)
+
+    monkeypatch.setattr(fake_request, "result", result)
+    assert not check(app, 8) and not check(app, 8)
+    assert len(fake_request.endpoints("getChatMember")) == 1
+    assert check(app, 8, refresh=True)
+
+
+def test_updates_from_other_chats_are_ignored(app):
+    bot.config.set_channels([CHANNEL])
+    process(app, member_update(1, 5, "member", chat_id=-300, username="boshqa"))
+    assert bot.storage.get_memberships(5, ["-300", "@boshqa"]) == {}
@@ -0,0 +1,71 @@
+import asyncio
+
+from conftest import bot, run
+
+
+def test_histogram_buckets_are_cumulative_in_render(monkeypatch):
+    monkeypatch.setattr(bot, "handler_latency", {})
+    for seconds in (0.002, 0.002, 0.3, 20):
+        bot.observe_latency(bot.handler_latency, "command:start", seconds)
+    lines = []
+    bot.render_histograms(lines, "h", "handler", bot.handler_latency)
+    assert 'h_bucket{handler="command:start",le="0.005"} 2' in lines
+    assert 'h_bucket{handler="command:start",le="0.5"} 3' in lines
+    assert 'h_bucket{handler="command:start",le="+Inf"} 4' in lines
+    assert 'h_count{handler="command:start"} 4' in lines
+
+
+def test_sql_label_uses_verb_and_table():
+    assert bot.sql_label("SELECT * FROM users WHERE id = ?") == "SELECT users"
+    assert bot.sql_label("INSERT OR IGNORE INTO messages (a) VALUES (?)") == "INSERT messages"
+    assert bot.sql_label("PRAGMA user_version") == "PRAGMA"
+
+
+def test_render_metrics_skips_failing_gauges(monkeypatch):
+    monkeypatch.setattr(bot, "queue_depths", {"ok": lambda: 3, "broken": lambda: 1 / 0})
+    text = bot.render_metrics()
+    assert 'bot_queue_depth{queue="ok"} 3' in text
+    assert "broken" not in text
+
+
+def test_metrics_http_route(monkeypatch):
+    monkeypatch.setattr(bot, "METRICS_PORT", 0)
+
+    async def scrape():
+        server = await asyncio.start_server(bot.handle_http_request, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        missing_reader, missing_writer = await asyncio.open_connection("127.0.0.1", port)
+        missing_writer.write(b"GET /nope HTTP/1.1\r\n\r\n")
+        missing = await missing_reader.read()
+        missing_writer.close()
+        server.close()
+        await server.wait_closed()
+        return response, missing
+
+    response, missing = run(scrape())
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert b"# TYPE bot_api_calls_total counter" in response
+    assert missing.startswith(b"HTTP/1.1 404")
+
+
+def test_metrics_bot_counts_api_calls(tenant, fake_request, monkeypatch):
+    monkeypatch.setattr(bot, "api_calls", {})
+
+    async def call():
+        app = bot.build_application(updater=False, request=fake_request)
+        async with app:
+            await app.bot.send_message(chat_id=5, text="hi")
+
+    run(call())
+    assert bot.api_calls[("sendMessage", "ok")] == 1
+
+
+def test_default_request_pool_is_sized_for_concurrent_senders(tenant):
+    app = bot.build_application(updater=False)
+    limits = app.bot.request._client_kwargs["limits"]
+    assert limits.max_connections == bot.HTTP_POOL_SIZE
+    assert bot.HTTP_POOL_SIZE > bot.OUTBOX_WORKERS
@@ -0,0 +1,67 @@
+import pytest
+
+from conftest import bot
+
+
+def user_version(path):
+    conn = bot.get_db_connection(path)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_fresh_database_runs_every_migration(tmp_path, capsys):
+    path = str(tmp_path / "bot.db")
+    assert bot.init_db(path) == len(bot.MIGRATIONS)
+    assert capsys.readouterr().out.count("Migratsiya") == len(bot.MIGRATIONS)
+    assert user_version(path) == len(bot.MIGRATIONS)
+
+
+def test_up_to_date_database_skips_migrations(tmp_path, capsys):
+    path = str(tmp_path / "bot.db")
+    bot.init_db(path)
+    capsys.readouterr()
+    assert bot.init_db(path) == len(bot.MIGRATIONS)
+    assert "Migratsiya" not in capsys.readouterr().out
+
+
+def test_partial_upgrade_runs_only_missing_steps(tmp_path, monkeypatch, capsys):
+    path = str(tmp_path / "bot.db")
+    monkeypatch.setattr(bot, "MIGRATIONS", bot.MIGRATIONS[:3])
+    assert bot.init_db(path) == 3
+    monkeypatch.undo()
+    capsys.readouterr()
+    assert bot.init_db(path) == len(bot.MIGRATIONS)
+    assert capsys.readouterr().out.count("Migratsiya") == len(bot.MIGRATIONS) - 3
+
+
+def test_failed_migration_leaves_version_unchanged(tmp_path, monkeypatch):
+    path = str(tmp_path / "bot.db")
+    bot.init_db(path)
+
+    def broken(cursor):
+        cursor.execute("CREATE TABLE half_done (id INTEGER)")
+        raise RuntimeError("xato")
+
+    monkeypatch.setattr(bot, "MIGRATIONS", bot.MIGRATIONS + [broken])
+    with pytest.raises(RuntimeError):
+        bot.init_db(path)
+    assert user_version(path) == len(bot.MIGRATIONS) - 1
+    conn = bot.get_db_connection(path)
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'half_done'").fetchone() is None
+    conn.close()
+
+
+def test_legacy_database_without_version_is_upgraded(tmp_path):
+    # Migratsiyalardan oldingi baza: jadvallar bor, user_version = 0
+    path = str(tmp_path / "bot.db")
+    conn = bot.get_db_connection(path)
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, language TEXT DEFAULT 'uz')")
+    conn.execute("INSERT INTO users (id) VALUES (5)")
+    conn.commit()
+    conn.close()
+    assert bot.init_db(path) == len(bot.MIGRATIONS)
+    conn = bot.get_db_connection(path)
+    assert conn.execute("SELECT id, referrals FROM users").fetchone()[:] == (5, 0)
+    conn.close()
@@ -0,0 +1,138 @@
+import json
+import time
+
+import telegram
+
+from conftest import ADMIN, bot, message_update, process, run
+
+
+def enqueue(storage, message_id="m1", chat_id=6, **payload):
+    payload = {"media_type": "text", "text": "salom", "entities": [], "lang": "uz", **payload}
+    return storage.enqueue_outbox({"message_id": message_id, "sender_id": 5, "receiver_id": chat_id, "text": "salom",
+                                   "media_type": payload["media_type"]}, chat_id, json.dumps(payload))
+
+
+def claim(storage):
+    return storage.claim_outbox(time.time() + 1, bot.OUTBOX_LEASE, 10)
+
+
+def outbox_row(storage):
+    return storage.conn.execute("SELECT attempts, next_attempt, last_error FROM outbox").fetchone()
+
+
+class RateLimitedBot:
+    async def send_message(self, **kwargs):
+        raise telegram.error.RetryAfter(300)
+
+
+def test_duplicate_enqueue_is_ignored(any_storage):
+    assert enqueue(any_storage)
+    assert not enqueue(any_storage)
+    assert any_storage.count_outbox() == 1
+
+
+def test_claimed_rows_are_leased(any_storage):
+    enqueue(any_storage)
+    assert len(claim(any_storage)) == 1
+    assert claim(any_storage) == []
+
+
+def test_text_delivery_records_reply_route(app, fake_request):
+    enqueue(bot.storage)
+    row, = claim(bot.storage)
+    run(bot.process_outbox_row(app.bot, row))
+    (_, parameters), = fake_request.endpoints("sendMessage")
+    assert parameters["chat_id"] == 6
+    assert bot.storage.count_outbox() == 0
+    assert bot.storage.get_delivery(6, 1000)["sender_id"] == 5
+
+
+def test_media_timeout_is_retried_not_replaced_by_text(app, fake_request):
+    enqueue(bot.storage, media_type="photo", file_id="PHOTO", caption="rasm")
+    fake_request.fail["sendPhoto"] = [telegram.error.TimedOut()]
+    row, = claim(bot.storage)
+    run(bot.process_outbox_row(app.bot, row))
+    assert fake_request.endpoints("sendMessage") == []
+    assert bot.storage.count_outbox() == 1
+    assert outbox_row(bot.storage)["attempts"] == 1
+
+    bot.storage.conn.execute("UPDATE outbox SET next_attempt = 0")
+    bot.storage.conn.commit()
+    row, = claim(bot.storage)
+    run(bot.process_outbox_row(app.bot, row))
+    assert len(fake_request.endpoints("sendPhoto")) == 2
+    assert bot.storage.count_outbox() == 0
+
+
+def test_forbidden_parks_row_and_marks_recipient_inactive(app, fake_request):
+    bot.storage.add_user(6)
+    enqueue(bot.storage, media_type="photo", file_id="PHOTO", caption="rasm")
+    fake_request.fail["sendPhoto"] = [telegram.error.Forbidden("bot was blocked by the user")]
+    row, = claim(bot.storage)
+    run(bot.process_outbox_row(app.bot, row))
+    assert outbox_row(bot.storage)["next_attempt"] is None
+    assert bot.storage.count_outbox() == 0
+    assert 6 not in [user_id for user_id, _ in bot.iter_recipients()]
+
+
+def test_retry_after_sets_backoff(tenant):
+    enqueue(bot.storage)
+    row, = claim(bot.storage)
+    started = time.time()
+    run(bot.process_outbox_row(RateLimitedBot(), row))
+    state = outbox_row(bot.storage)
+    assert state["attempts"] == 1 and "Flood control" in state["last_error"]
+    assert state["next_attempt"] >= started + 300
+
+
+def test_expired_lease_reclaimed_by_another_worker_is_not_sent(app, fake_request):
+    enqueue(bot.storage)
+    stale, = claim(bot.storage)
+    # Lease tugadi, boshqa worker qatorni qayta band qildi
+    fresh, = bot.storage.claim_outbox(stale["next_attempt"] + 1, bot.OUTBOX_LEASE, 10)
+    run(bot.process_outbox_row(app.bot, stale))
+    assert fake_request.endpoints("sendMessage") == []
+    run(bot.process_outbox_row(app.bot, fresh))
+    assert len(fake_request.endpoints("sendMessage")) == 1
+    assert bot.storage.count_outbox() == 0
+
+
+def test_completion_after_losing_lease_keeps_new_owner_row(any_storage):
+    enqueue(any_storage)
+    stale, = claim(any_storage)
+    fresh, = any_storage.claim_outbox(stale["next_attempt"] + 1, bot.OUTBOX_LEASE, 10)
+    assert not any_storage.renew_outbox_lease(stale["id"], stale["next_attempt"], time.time())
+    any_storage.reschedule_outbox(stale["id"], None, "eski", stale["next_attempt"])
+    any_storage.complete_outbox(stale["id"], [1], stale["next_attempt"])
+    assert any_storage.count_outbox() == 1
+    any_storage.complete_outbox(fresh["id"], [2], fresh["next_attempt"])
+    assert any_storage.count_outbox() == 0
+
+
+def park(storage, message_id):
+    enqueue(storage, message_id)
+    row, = claim(storage)
+    storage.reschedule_outbox(row["id"], None, "Forbidden", row["next_attempt"])
+
+
+def test_dead_rows_can_be_retried_or_purged(any_storage):
+    park(any_storage, "m1")
+    park(any_storage, "m2")
+    enqueue(any_storage, "m3")
+    assert (any_storage.count_outbox(), any_storage.count_dead_outbox()) == (1, 2)
+    assert any_storage.retry_dead_outbox(time.time()) == 2
+    assert (any_storage.count_outbox(), any_storage.count_dead_outbox()) == (3, 0)
+    for row in claim(any_storage):
+        any_storage.reschedule_outbox(row["id"], None, "Forbidden", row["next_attempt"])
+    assert any_storage.purge_dead_outbox() == 3
+    assert (any_storage.count_outbox(), any_storage.count_dead_outbox()) == (0, 0)
+
+
+def test_dead_rows_are_visible_to_admin(app, fake_request):
+    park(bot.storage, "m1")
+    assert 'bot_queue_depth{tenant="test",queue="outbox_dead"} 1' in bot.render_metrics()
+    process(app, message_update(1, ADMIN, "/outbox"), message_update(2, ADMIN, "/outbox retry"))
+    replies = [parameters["text"] for _, parameters in fake_request.endpoints("sendMessage")]
+    assert replies[0].startswith("Outbox: navbatda 0, yetkazilmagan 1")
+    assert replies[1] == "Qayta navbatga qo'yildi: 1"
+    assert bot.storage.count_outbox() == 1
@@ -0,0 +1,84 @@
+import asyncio
+import json
+
+from telegram import Update
+
+from conftest import ADMIN, FakeRequest, bot, message_update, run, user
+
+RECIPIENTS = 150
+
+
+def seed_recipients():
+    for user_id in range(100, 100 + RECIPIENTS):
+        bot.storage.add_user(user_id)
+
+
+async def run_app(application, updates, settle):
+    async with application:
+        await application.start()
+        for delay, data in updates:
+            await asyncio.sleep(delay)
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await asyncio.sleep(settle)
+        await application.stop()
+
+
+def sent_to(request, endpoint, chat_id):
+    return [at for name, parameters, at in request.calls if name == endpoint and parameters.get("chat_id") == chat_id]
+
+
+def test_interactive_reply_overtakes_inflight_forward(tenant):
+    request = FakeRequest(latency=0.01)
+    application = bot.build_application(updater=False, request=request)
+    seed_recipients()
+    bot.storage.add_user(ADMIN)
+    bot.storage.set_session(ADMIN, "forward_message", "{}")
+    run(run_app(application, [(0, message_update(1, ADMIN, "hamma uchun")), (0.2, message_update(2, 77, "/start"))], 0.3))
+
+    forwards = [at for name, _, at in request.calls if name == "forwardMessage"]
+    start_reply = sent_to(request, "sendMessage", 77)
+    assert len(forwards) == RECIPIENTS
+    assert start_reply and start_reply[0] < forwards[-1]
+    # /start javobi broadcast tugashini kutmaydi
+    assert sum(1 for at in forwards if at < start_reply[0]) < RECIPIENTS // 2
+    assert sent_to(request, "sendMessage", ADMIN)  # yakuniy hisobot
+
+
+def test_broadcast_callback_runs_in_background(tenant):
+    request = FakeRequest(latency=0.01)
+    application = bot.build_application(updater=False, request=request)
+    seed_recipients()
+    bot.storage.add_user(ADMIN)
+    bot.storage.set_session(ADMIN, "broadcast_buttons", json.dumps({"media_type": "text", "message": "e'lon", "entities": []}))
+    callback = {"update_id": 1, "callback_query": {
+        "id": "1", "from": user(ADMIN), "chat_instance": "x", "data": "broadcast_no_buttons",
+        "message": {"message_id": 5, "date": 0, "chat": {"id": ADMIN, "type": "private"}, "from": user(1), "text": "?"}}}
+    run(run_app(application, [(0, callback), (0.2, message_update(2, 77, "/start"))], 0.3))
+
+    broadcasts = [at for name, parameters, at in request.calls if name == "sendMessage" and parameters["chat_id"] >= 100]
+    start_reply = sent_to(request, "sendMessage", 77)
+    assert len(broadcasts) == RECIPIENTS
+    assert start_reply[0] < broadcasts[-1]
+    report = [parameters["text"] for name, parameters, _ in request.calls if name == "sendMessage" and parameters["chat_id"] == ADMIN]
+    assert report == [bot.get_translation('uz', 'broadcast_sent', success=RECIPIENTS, failed=0)]
+
+
+def test_bulk_lane_waits_while_interactive_is_queued():
+    governor = bot.ApiGovernor(global_rate=1000, bulk_reserve=0)
+    order = []
+
+    async def send(priority, label):
+        with bot.api_lane(priority):
+            await governor.process_request(lambda: asyncio.sleep(0, order.append(label)), (), {}, "sendMessage", {"chat_id": label}, None)
+
+    async def scenario():
+        governor.waiting[bot.INTERACTIVE_LANE] += 1  # interaktiv so'rov navbatda turibdi
+        bulk = asyncio.create_task(send(bot.BULK_LANE, "bulk"))
+        await asyncio.sleep(0.01)
+        assert order == []
+        governor.waiting[bot.INTERACTIVE_LANE] -= 1
+        await send(bot.INTERACTIVE_LANE, "interactive")
+        await bulk
+
+    run(scenario())
+    assert order == ["interactive", "bulk"]
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from conftest import ADMIN, bot, message_update, process, run
+
+HEAVY_QUERY = "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < 200000) SELECT SUM(x) FROM n"
+
+
+def test_samples_are_aggregated_by_stack():
+    samples = {}
+    code = test_samples_are_aggregated_by_stack.__code__
+    bot.record_sample(samples, "cpu", [code])
+    bot.record_sample(samples, "cpu", [code], weight=2)
+    bot.record_sample(samples, "cpu", [code], leaf="sqlite3")
+    label = "test_profiler.py:test_samples_are_aggregated_by_stack"
+    assert samples == {f"cpu;{label}": 3, f"cpu;{label};sqlite3": 1}
+
+
+def test_top_summary_splits_inclusive_and_own_time():
+    samples = {"cpu;a;b": 3, "cpu;a": 1, "await;c": 2}
+    summary = bot.format_profile_top(samples, 5)
+    assert "CPU (loop oqimi): 4 namuna" in summary and "Kutish (await): 2 namuna" in summary
+    assert "100.0%  25.0%  a" in summary and " 75.0%  75.0%  b" in summary
+    assert "100.0% 100.0%  c" in summary
+
+
+async def fake_api_call(reply):
+    await reply
+
+
+def test_profiler_samples_cpu_and_awaits(tenant, monkeypatch):
+    monkeypatch.setattr(bot, "PROFILE_INTERVAL", 0.005)
+
+    async def scenario():
+        reply = asyncio.get_running_loop().create_future()
+        waiting = asyncio.create_task(fake_api_call(reply))
+        conn = bot.get_db_connection(tenant.db_path)
+
+        async def busy():
+            while not reply.done():
+                conn.execute(HEAVY_QUERY).fetchone()
+                await asyncio.sleep(0)
+
+        worker = asyncio.create_task(busy())
+        samples = await bot.run_profiler(0.3)
+        reply.set_result(None)
+        await asyncio.gather(waiting, worker)
+        conn.close()
+        return samples
+
+    samples = run(scenario())
+    assert any(key.startswith("cpu;") and "test_profiler.py:busy;" in key and key.endswith(";sqlite3") for key in samples)
+    assert any(key.startswith("await;") and key.endswith("test_profiler.py:fake_api_call") for key in samples)
+    assert not bot.profiler_state["running"]
+
+
+def test_only_one_profiler_runs(monkeypatch):
+    monkeypatch.setitem(bot.profiler_state, "running", True)
+    with pytest.raises(RuntimeError):
+        run(bot.run_profiler(0.1))
+
+
+def test_profile_command_checks_admin_and_arguments(app, fake_request):
+    process(app, message_update(1, 42, "/profile"), message_update(2, ADMIN, "/profile abc"),
+            message_update(3, ADMIN, "/profile 0"))
+    replies = [parameters["text"] for _, parameters in fake_request.endpoints("sendMessage")]
+    usage = f"Foydalanish: /profile [soniya, maks. {bot.PROFILE_MAX_SECONDS}]"
+    assert replies == [bot.get_translation("uz", "admin_only"), usage, usage]
+    assert not bot.profiler_state["running"]
@@ -0,0 +1,37 @@
+import sqlite3
+
+from conftest import bot
+
+
+def test_normalize_sql_collapses_whitespace_and_placeholder_lists():
+    two = bot.normalize_sql("SELECT status FROM channel_members WHERE user_id = ? AND channel IN (?, ?)")
+    five = bot.normalize_sql("SELECT status FROM channel_members\n  WHERE user_id = ? AND channel IN (?,?,?,?,?)")
+    assert two == five
+    assert "IN (?, ...)" in two
+    assert bot.normalize_sql("SELECT * FROM users WHERE id = (?)") == "SELECT * FROM users WHERE id = (?)"
+
+
+def test_query_stats_are_bounded(monkeypatch):
+    monkeypatch.setattr(bot, "query_stats", {})
+    monkeypatch.setattr(bot, "query_plans", {})
+    monkeypatch.setattr(bot, "QUERY_STATS_SIZE", 3)
+    monkeypatch.setattr(bot, "slow_query_threshold", 10.0)
+    connection = sqlite3.connect(":memory:")
+    bot.profile_query(connection, "SELECT 1", (), 0.5)
+    for i in range(2, 10):
+        bot.profile_query(connection, f"SELECT {i}", (), 0.001 * i)
+    assert len(bot.query_stats) == 3
+    assert "SELECT 1" in bot.query_stats  # eng qimmat so'rov saqlanadi
+
+
+def test_slow_query_captures_plan(monkeypatch, capsys):
+    monkeypatch.setattr(bot, "query_stats", {})
+    monkeypatch.setattr(bot, "query_plans", {})
+    monkeypatch.setattr(bot, "slow_query_threshold", 0.0)
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, v TEXT)")
+    bot.profile_query(connection, "SELECT v FROM t WHERE id IN (?, ?)", (1, 2), 0.01)
+    key = bot.normalize_sql("SELECT v FROM t WHERE id IN (?, ?)")
+    assert "t" in bot.query_plans[key]
+    assert bot.top_queries()[0][0] == key
+    assert "Sekin so'rov" in capsys.readouterr().out
@@ -0,0 +1,49 @@
+import telegram
+from telegram import Message
+
+from conftest import ADMIN, bot, message_update, run
+
+
+def test_recipients_are_read_in_chunks(any_storage):
+    for user_id in range(1, 8):
+        any_storage.add_user(user_id, "en" if user_id % 2 else "uz")
+    chunks = list(any_storage.iter_recipient_chunks(batch_size=3))
+    assert [list(ids) for ids, _ in chunks] == [[1, 2, 3], [4, 5, 6], [7]]
+    assert chunks[0][1] == ["en", "uz", "en"]
+
+
+def test_inactive_and_banned_users_are_skipped(any_storage):
+    for user_id in range(1, 6):
+        any_storage.add_user(user_id)
+    any_storage.mark_inactive([2, 3])
+    any_storage.ban_user(4)
+    assert [user_id for ids, _ in any_storage.iter_recipient_chunks(batch_size=2) for user_id in ids] == [1, 5]
+    assert any_storage.count_recipients() == 2
+
+
+def test_returning_user_becomes_active_again(any_storage):
+    any_storage.add_user(1)
+    any_storage.mark_inactive([1])
+    assert any_storage.count_recipients() == 0
+    # Botni qayta ochgan foydalanuvchi: last_seen yozilishi bilan yana faol
+    any_storage.touch_users({1: bot.utc_timestamp()})
+    assert any_storage.count_recipients() == 1
+
+
+def test_iter_recipients_yields_id_language_pairs(tenant, monkeypatch):
+    monkeypatch.setattr(bot, "RECIPIENT_BATCH_SIZE", 2)
+    for user_id in range(1, 4):
+        bot.storage.add_user(user_id, "ru")
+    assert list(bot.iter_recipients()) == [(1, "ru"), (2, "ru"), (3, "ru")]
+
+
+def test_broadcast_marks_blocked_recipients_inactive(app, fake_request):
+    for user_id in (5, 6, 7):
+        bot.storage.add_user(user_id)
+    fake_request.fail["sendMessage"] = [telegram.error.Forbidden("bot was blocked by the user")]
+    report_to = Message.de_json(message_update(1, ADMIN, "/broadcast")["message"], app.bot)
+    session_data = {"media_type": "text", "message": "e'lon", "entities": []}
+    run(bot.broadcast_job(app.bot, report_to, ADMIN, "uz", session_data, None))
+    assert [user_id for user_id, _ in bot.iter_recipients()] == [6, 7]
+    report = fake_request.endpoints("sendMessage")[-1][1]
+    assert report["text"] == bot.get_translation("uz", "broadcast_sent", success=2, failed=1)
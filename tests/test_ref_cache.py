@@ -0,0 +1,42 @@
+import pytest
+
+from conftest import bot, count_calls, message_update, process
+
+
+def test_code_resolution_is_cached(tenant, monkeypatch):
+    bot.storage.add_user(5)
+    code = bot.encode_user_id(5)
+    lookups = count_calls(tenant, monkeypatch, "find_user_by_custom_ref")
+    assert bot.get_user_from_ref(code) == 5
+    assert bot.get_user_from_ref(code) == 5
+    assert len(lookups) == 1
+
+
+def test_link_generation_is_cached(tenant, monkeypatch):
+    bot.storage.add_user(5)
+    reads = count_calls(tenant, monkeypatch, "get_user")
+    link = bot.get_ref_link(5)
+    assert link == f"https://t.me/TestBot?start={bot.encode_user_id(5)}"
+    assert bot.get_ref_link(5) == link
+    assert len(reads) == 1
+
+
+def test_unknown_code_is_rejected(tenant):
+    with pytest.raises(ValueError):
+        bot.get_user_from_ref("yoq_kod")
+
+
+def test_custom_link_invalidates_cached_codes(app, fake_request):
+    bot.storage.add_user(5)
+    bot.storage.conn.execute("UPDATE users SET referrals = 5 WHERE id = 5")
+    bot.storage.conn.commit()
+    old_code = bot.encode_user_id(5)
+    assert bot.get_user_from_ref(old_code) == 5
+    assert bot.get_ref_code(5) == old_code
+
+    process(app, message_update(1, 5, "/url Mening_link"))
+    assert bot.get_ref_code(5) == "mening_link"
+    assert bot.get_user_from_ref("mening_link") == 5
+    # Maxsus havola o'rnatilgach eski base64 kod ishlamaydi
+    with pytest.raises(ValueError):
+        bot.get_user_from_ref(old_code)
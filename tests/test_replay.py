@@ -0,0 +1,105 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import replay
+from conftest import FakeRequest, bot, message_update, process, run
+
+
+@pytest.fixture
+def traced_app(tenant, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "TRACE_PATH", str(tmp_path / "trace.jsonl"))
+    path = tmp_path / f"trace.jsonl.{tenant.name}"
+    fake_request = FakeRequest()
+    application = bot.build_application(updater=False, request=fake_request)
+    run(application.initialize())
+    yield application, path
+    run(application.shutdown())
+    # any_storage bilan yozuv o'sha tenantda: faylni test o'zi yopadi
+    if bot.trace_state["file"] is not None:
+        bot.trace_state["file"].close()
+
+
+def record_conversation(application):
+    bot.storage.add_user(6)
+    bot.storage.set_custom_ref(6, "mylink")
+    process(application, message_update(1, 5, "/start mylink"), message_update(2, 5, "salom"))
+    row, = bot.storage.claim_outbox(time.time() + 1, bot.OUTBOX_LEASE, 10)
+    run(bot.process_outbox_row(application.bot, row))
+    delivered_id, = [key for key in range(1000, 1100) if bot.storage.get_delivery(6, key)]
+    reply_to = {"message_id": delivered_id, "date": 0, "chat": {"id": 6, "type": "private"}, "text": "salom",
+                "from": {"id": 1, "is_bot": True, "first_name": "Test", "username": "TestBot"}}
+    process(application, message_update(3, 6, "javob", reply_to_message=reply_to))
+
+
+def test_trace_keeps_custom_ref_owner_and_reply_sender(traced_app):
+    application, path = traced_app
+    record_conversation(application)
+    header, start, message, reply = [json.loads(line) for line in path.read_text().splitlines()]
+    assert header["header"]
+    code = bot.sanitize_ref_code("mylink")
+    assert start["update"]["message"]["text"] == f"/start {code}"
+    assert start["ref"] == {"code": code, "owner": bot.anonymize_id(6)}
+    assert "mylink" not in path.read_text()
+    assert reply["reply_sender"] == bot.anonymize_id(5)
+
+
+def test_seed_creates_custom_ref_owners(traced_app, tmp_path, any_storage):
+    application, path = traced_app
+    bot.storage.add_user(6)
+    bot.storage.set_custom_ref(6, "mylink")
+    process(application, message_update(1, 5, "/start mylink"))
+    replay_tenant = bot.Tenant("replay", "1:TEST", 1, "TestBot", str(tmp_path / "replay.db"))
+    token = bot.current_tenant.set(replay_tenant)
+    try:
+        bot.storage.migrate()
+        assert replay.seed_ref_targets(bot, str(path)) == 1
+        assert bot.get_user_from_ref(bot.sanitize_ref_code("mylink")) == bot.anonymize_id(6)
+    finally:
+        bot.current_tenant.reset(token)
+        bot.trace_state["file"].close()
+
+
+def test_seed_creates_link_owners(any_storage, tmp_path):
+    code = bot.sanitize_ref_code("mylink")
+    entries = [{"header": True},
+               {"t": 0, "update": message_update(1, 5, f"/start {code}"), "ref": {"code": code, "owner": 77}},
+               {"t": 1, "update": message_update(2, 8, f"/start {bot.encode_user_id(78)}")}]
+    path = tmp_path / "trace.jsonl"
+    path.write_text("".join(json.dumps(entry) + "\n" for entry in entries))
+    assert replay.seed_ref_targets(bot, str(path)) == 2
+    assert bot.get_user_from_ref(code) == 77
+    assert bot.get_user_from_ref(bot.encode_user_id(78)) == 78
+
+
+def test_remap_reply_uses_replayed_delivery(any_storage):
+    any_storage.add_delivery(6, 1_000_000_003, 5)
+    any_storage.add_delivery(6, 1_000_000_005, 7)
+    entry = {"reply_sender": 5, "update": message_update(9, 6, "javob", reply_to_message={"message_id": 42})}
+    sent = {6: [1_000_000_003, 1_000_000_004, 1_000_000_005]}
+    assert replay.remap_reply(entry, sent, any_storage)
+    assert entry["update"]["message"]["reply_to_message"]["message_id"] == 1_000_000_003
+    entry["reply_sender"] = 8
+    assert not replay.remap_reply(entry, sent, any_storage)
+
+
+def test_replay_routes_custom_refs_and_replies(traced_app, tmp_path):
+    application, path = traced_app
+    record_conversation(application)
+    bot.trace_state["file"].flush()
+    # Oraliqlar: yetkazish keyingi update dan oldin tugashi uchun
+    lines = path.read_text().splitlines()
+    retimed = [lines[0]] + [json.dumps(dict(json.loads(line), t=number)) for number, line in enumerate(lines[1:])]
+    path.write_text("\n".join(retimed) + "\n")
+    environment = {key: value for key, value in os.environ.items() if key not in ("BOT_TOKEN", "ADMIN_ID", "DB_PATH")}
+    result = subprocess.run([sys.executable, "replay.py", str(path), "--speed", "5", "--api-latency", "0", "--drain", "5",
+                             "--db", str(tmp_path / "replayed.db")],
+                            cwd=os.path.dirname(replay.__file__), env=environment, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert "3 bajarildi, 0 yo'qoldi" in result.stdout
+    assert "Reply lar" not in result.stdout and "Xatolar" not in result.stdout
+    assert "Baza:" in result.stdout
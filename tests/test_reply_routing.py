@@ -0,0 +1,56 @@
+import time
+
+from conftest import bot, message_update, process, run
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Test", "username": "TestBot"}
+
+
+def reply_to(chat_id, message_id, **fields):
+    return {"message_id": message_id, "date": 0, "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER,
+            "text": "...", **fields}
+
+
+def delivered_ids(chat_id):
+    return [key for key in range(1000, 1100) if bot.storage.get_delivery(chat_id, key)]
+
+
+def send_anonymous(application, sender_id, receiver_id, update_id=1):
+    bot.storage.add_user(receiver_id)
+    bot.storage.set_session(sender_id, "send", str(receiver_id))
+    process(application, message_update(update_id, sender_id, "savol"))
+    row, = bot.storage.claim_outbox(time.time() + 1, bot.OUTBOX_LEASE, 10)
+    run(bot.process_outbox_row(application.bot, row))
+    delivered, = delivered_ids(receiver_id)
+    return delivered
+
+
+def test_reply_to_delivered_message_reaches_sender(app, fake_request):
+    delivered = send_anonymous(app, 5, 6)
+    process(app, message_update(2, 6, "javob", reply_to_message=reply_to(6, delivered)))
+    assert any(parameters["chat_id"] == 5 and "javob" in parameters["text"]
+               for _, parameters in fake_request.endpoints("sendMessage"))
+    assert bot.storage.get_session(6) is None
+
+
+def test_reply_chain_works_both_ways(app, fake_request):
+    delivered = send_anonymous(app, 5, 6)
+    process(app, message_update(2, 6, "javob", reply_to_message=reply_to(6, delivered)))
+    answer, = delivered_ids(5)
+    assert bot.storage.get_delivery(5, answer)["sender_id"] == 6
+    process(app, message_update(3, 5, "rahmat", reply_to_message=reply_to(5, answer)))
+    assert any(parameters["chat_id"] == 6 and "rahmat" in parameters["text"]
+               for _, parameters in fake_request.endpoints("sendMessage"))
+
+
+def test_messages_delivered_before_the_index_use_the_block_button(app, fake_request):
+    bot.storage.add_message({"message_id": "5_6_1", "sender_id": 5, "receiver_id": 6, "text": "eski", "media_type": "text"})
+    markup = {"inline_keyboard": [[{"text": "Bloklash", "callback_data": "block_5_6_1"}]]}
+    process(app, message_update(2, 6, "javob", reply_to_message=reply_to(6, 77, reply_markup=markup)))
+    assert any(parameters["chat_id"] == 5 for _, parameters in fake_request.endpoints("sendMessage"))
+
+
+def test_reply_to_unknown_message_is_not_routed(app, fake_request):
+    process(app, message_update(2, 6, "javob", reply_to_message=reply_to(6, 77)))
+    (_, parameters), = fake_request.endpoints("sendMessage")
+    assert parameters["chat_id"] == 6
+    assert parameters["text"] == bot.get_translation("uz", "use_link_first")
@@ -0,0 +1,93 @@
+from conftest import ADMIN, bot, callback_update, message_update, process
+
+
+def add_messages(storage, count, text="salom dunyo"):
+    for number in range(count):
+        storage.add_message({"message_id": f"m{number}", "sender_id": 5, "receiver_id": 6,
+                             "text": f"{text} {number}", "media_type": "text"})
+
+
+def test_fresh_database_reaches_latest_version(tenant):
+    assert bot.storage.migrate() == len(bot.MIGRATIONS)
+    columns = [row[1] for row in bot.storage.conn.execute("PRAGMA table_info(messages)")]
+    assert columns[0] == "id"
+
+
+def test_integer_key_migration_keeps_row_keys(tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = bot.get_db_connection(path)
+    for migration in bot.MIGRATIONS[:-1]:
+        migration(conn.cursor())
+    conn.execute(f"PRAGMA user_version = {len(bot.MIGRATIONS) - 1}")
+    for number in range(5):
+        conn.execute("INSERT INTO messages (message_id, receiver_id, text) VALUES (?, 6, ?)", (f"m{number}", f"salom {number}"))
+    conn.execute("DELETE FROM messages WHERE message_id = 'm1'")
+    conn.commit()
+    before = {row["message_id"]: row["rowid"] for row in conn.execute("SELECT rowid, message_id FROM messages")}
+    conn.close()
+
+    assert bot.init_db(path) == len(bot.MIGRATIONS)
+    conn = bot.get_db_connection(path)
+    after = {row["message_id"]: row["id"] for row in conn.execute("SELECT id, message_id FROM messages")}
+    assert after == before
+    hits = conn.execute("SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'salom'").fetchall()
+    assert sorted(row[0] for row in hits) == sorted(before.values())
+    conn.close()
+
+
+def test_search_survives_vacuum(tenant):
+    storage = bot.storage
+    add_messages(storage, 6)
+    storage.add_message({"message_id": "target", "sender_id": 5, "receiver_id": 6, "text": "noyob kalit", "media_type": "text"})
+    storage.conn.execute("DELETE FROM messages WHERE message_id IN ('m0', 'm1', 'm2')")
+    storage.conn.commit()
+    storage.conn.execute("VACUUM")
+    rows = storage.search_messages("noyob")
+    assert [row["message_id"] for row in rows] == ["target"]
+    # integrity-check indeks messages jadvaliga mos kelmasa xato ko'taradi
+    storage.conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('integrity-check')")
+
+
+def test_search_pages_newest_first(any_storage):
+    add_messages(any_storage, 25)
+    first = any_storage.search_messages("salom", limit=10)
+    second = any_storage.search_messages("salom", before=first[-1]["row_key"], limit=10)
+    third = any_storage.search_messages("salom", before=second[-1]["row_key"], limit=10)
+    assert [row["message_id"] for row in first][:2] == ["m24", "m23"]
+    assert len(third) == 5 and third[-1]["message_id"] == "m0"
+
+
+def test_malformed_query_raises_storage_error(any_storage):
+    add_messages(any_storage, 1)
+    try:
+        any_storage.search_messages('"salom')
+    except bot.QueryError:
+        pass
+    else:
+        raise AssertionError("QueryError kutilgan edi")
+
+
+def test_search_command_highlights_and_pages(app, fake_request, monkeypatch):
+    monkeypatch.setattr(bot, "SEARCH_PAGE_SIZE", 2)
+    add_messages(bot.storage, 3)
+    process(app, message_update(1, ADMIN, "/search salom"))
+    (_, parameters), = fake_request.endpoints("sendMessage")
+    assert "<b>salom</b>" in parameters["text"] and "m2" in parameters["text"]
+    assert "search_next" in str(parameters["reply_markup"])
+
+    process(app, callback_update(2, ADMIN, "search_next"))
+    (_, parameters), = fake_request.endpoints("editMessageText")
+    assert "2-sahifa" in parameters["text"] and "m0" in parameters["text"]
+
+
+def test_malformed_query_in_paging_replies_with_usage(app, fake_request):
+    add_messages(bot.storage, 1)
+    process(app, message_update(1, ADMIN, '/search "salom'))
+    (_, parameters), = fake_request.endpoints("sendMessage")
+    assert bot.SEARCH_USAGE in parameters["text"]
+
+    app.user_data[ADMIN]["search"] = {"query": '"salom', "since": None, "until": None, "cursors": [None], "next": 1}
+    process(app, callback_update(2, ADMIN, "search_next"))
+    (_, parameters), = fake_request.endpoints("editMessageText")
+    assert bot.SEARCH_USAGE in parameters["text"]
+    assert "search" not in app.user_data[ADMIN]
@@ -0,0 +1,52 @@
+import json
+from datetime import datetime, timedelta
+
+from conftest import ADMIN, bot, message_update, process
+
+
+def days_ago(days):
+    return (datetime.utcnow() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def test_parse_segment():
+    assert bot.parse_segment("all") == {}
+    assert bot.parse_segment("Hammasi") == {}
+    assert bot.parse_segment("lang=en days=30 refs=5") == {"language": "en", "active_days": 30, "min_referrals": 5}
+    for invalid in ("", "lang=xx", "days=0", "days=abc", "refs=", "foo=1", "all lang=uz"):
+        assert bot.parse_segment(invalid) is None, invalid
+
+
+def test_segment_filters(any_storage):
+    for user_id, language in ((1, "uz"), (2, "en"), (3, "en"), (4, "ru")):
+        any_storage.add_user(user_id, language)
+    any_storage.touch_users({1: days_ago(1), 2: days_ago(2), 3: days_ago(40)})
+    for referred in range(10, 15):
+        any_storage.add_referral(3, referred)
+
+    def ids(**segment):
+        return [user_id for chunk, _ in any_storage.iter_recipient_chunks(**segment) for user_id in chunk]
+
+    assert ids(language="en") == [2, 3]
+    assert ids(active_days=30) == [1, 2]
+    assert ids(min_referrals=5) == [3]
+    assert ids(language="en", active_days=30) == [2]
+    assert any_storage.count_recipients(language="en") == 2
+    assert any_storage.count_recipients() == 4
+
+
+def test_admin_picks_segment_before_broadcast(app, fake_request):
+    for user_id, language in ((2, "en"), (3, "en"), (4, "ru")):
+        bot.storage.add_user(user_id, language)
+    bot.storage.set_session(ADMIN, "broadcast_segment", "")
+    process(app, message_update(1, ADMIN, "lang=en"))
+    session = bot.storage.get_session(ADMIN)
+    assert session["step"] == "broadcast_message"
+    assert json.loads(session["data"]) == {"segment": {"language": "en"}}
+    texts = [parameters["text"] for _, parameters in fake_request.endpoints("sendMessage")]
+    assert bot.get_translation("uz", "broadcast_segment_selected", count=2) in texts
+
+
+def test_invalid_segment_asks_again(app, fake_request):
+    bot.storage.set_session(ADMIN, "broadcast_segment", "")
+    process(app, message_update(1, ADMIN, "lang=xx"))
+    assert bot.storage.get_session(ADMIN)["step"] == "broadcast_segment"
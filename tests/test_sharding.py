@@ -0,0 +1,49 @@
+import queue
+
+from conftest import bot, callback_update, message_update
+
+
+def test_shard_key_is_the_acting_user():
+    assert bot.update_shard_key(message_update(1, 42, "salom")) == 42
+    assert bot.update_shard_key(callback_update(2, 42, "lang_uz")) == 42
+    member = {"chat": {"id": -100, "type": "channel"}, "from": {"id": 7, "is_bot": False, "first_name": "A"}}
+    assert bot.update_shard_key({"update_id": 3, "chat_member": member}) == 7
+    assert bot.update_shard_key({"update_id": 4, "poll": {"id": "p"}}) == 0
+
+
+def test_user_updates_always_reach_the_same_worker():
+    for user_id in (1, 42, 10**9 + 7):
+        shards = {bot.shard_for(bot.update_shard_key(data), 4)
+                  for data in (message_update(1, user_id, "a"), callback_update(2, user_id, "b"))}
+        assert len(shards) == 1
+    assert {bot.shard_for(user_id, 4) for user_id in range(100)} == {0, 1, 2, 3}
+
+
+def test_state_change_is_applied_locally_and_published(tenant, monkeypatch):
+    outbox = queue.Queue()
+    monkeypatch.setattr(bot, "state_outbox", outbox)
+    monkeypatch.setattr(bot, "worker_shard", 2)
+    bot.blacklist_cache.put(5, {6})
+    bot.notify_state_change("blacklist", 5)
+    assert 5 not in bot.blacklist_cache
+    assert outbox.get_nowait() == (2, "blacklist", 5)
+
+
+def test_state_change_from_another_worker_is_applied_without_echo(tenant, monkeypatch):
+    outbox = queue.Queue()
+    monkeypatch.setattr(bot, "state_outbox", outbox)
+    bot.blacklist_cache.put(5, {6})
+    bot.apply_state_change("blacklist", 5)
+    assert 5 not in bot.blacklist_cache
+    assert outbox.empty()
+
+
+def test_every_published_state_change_has_a_listener(tenant, monkeypatch):
+    outbox = queue.Queue()
+    monkeypatch.setattr(bot, "state_outbox", outbox)
+    bot.ban_user(5)
+    bot.unban_user(5)
+    bot.block_user(6, 5)
+    bot.toggle_notify_blocks()
+    kinds = {outbox.get_nowait()[1] for _ in range(outbox.qsize())}
+    assert kinds and kinds <= set(bot.state_listeners)
@@ -0,0 +1,83 @@
+import pytest
+
+from conftest import bot
+
+
+def message(message_id, sender_id=10, receiver_id=20, text="salom", **fields):
+    row = {"message_id": message_id, "sender_id": sender_id, "receiver_id": receiver_id, "text": text,
+           "media_type": "text", "file_id": None, "caption": None}
+    row.update(fields)
+    return row
+
+
+def test_storage_is_abstract():
+    with pytest.raises(TypeError):
+        bot.Storage()
+
+    class Partial(bot.Storage):
+        def migrate(self):
+            return 0
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_backends_implement_the_whole_interface():
+    assert not bot.SqliteStorage.__abstractmethods__
+    assert not bot.MemoryStorage.__abstractmethods__
+
+
+def test_users_and_settings(any_storage):
+    any_storage.add_user(5, 'en', "Ali", "ali")
+    any_storage.add_user(5, 'ru')  # takroriy qo'shish e'tiborsiz
+    assert any_storage.get_user(5)["language"] == 'en'
+    any_storage.set_user_language(5, 'ru')
+    any_storage.update_user_info(5, "Vali", "vali")
+    user = any_storage.get_user(5)
+    assert (user["language"], user["first_name"], user["username"]) == ('ru', "Vali", "vali")
+    assert any_storage.count_users() == 1
+    assert any_storage.get_setting("missing", "x") == "x"
+    any_storage.set_setting("notify_blocks", "off")
+    assert any_storage.get_setting("notify_blocks") == "off"
+
+
+def test_custom_ref_is_unique(any_storage):
+    any_storage.add_user(5)
+    any_storage.add_user(6)
+    assert any_storage.set_custom_ref(5, "mylink")
+    assert not any_storage.set_custom_ref(6, "mylink")
+    assert any_storage.find_user_by_custom_ref("mylink") == 5
+
+
+def test_duplicate_message_raises_backend_neutral_error(any_storage):
+    any_storage.add_message(message("1_2_3"))
+    with pytest.raises(bot.DuplicateKeyError):
+        any_storage.add_message(message("1_2_3"))
+    assert any_storage.count_messages() == 1
+    assert any_storage.get_message("1_2_3")["text"] == "salom"
+
+
+def test_bans_blacklists_sessions_referrals(any_storage):
+    any_storage.ban_user(7)
+    assert any_storage.is_user_banned(7)
+    assert any_storage.unban_user(7)
+    assert not any_storage.unban_user(7)
+
+    any_storage.block_user(1, 2)
+    any_storage.block_user(1, 3)
+    assert any_storage.is_user_blocked(1, 2)
+    assert any_storage.get_blacklist(1) == {2, 3}
+    assert any_storage.unblock_user(1, 2)
+    assert any_storage.clear_blacklist(1) == 1
+    assert any_storage.count_blacklist(1) == 0
+
+    any_storage.set_session(5, "send", "6")
+    any_storage.set_session_step(5, "reply")
+    assert (any_storage.get_session(5)["step"], any_storage.get_session(5)["data"]) == ("reply", "6")
+    any_storage.delete_session(5)
+    assert any_storage.get_session(5) is None
+
+    any_storage.add_user(5)
+    assert any_storage.add_referral(5, 6)
+    assert not any_storage.add_referral(5, 6)
+    assert any_storage.count_referrals(5) == 1
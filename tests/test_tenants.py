@@ -0,0 +1,117 @@
+import asyncio
+import json
+import socket
+
+from telegram import Update
+
+from conftest import ADMIN, FakeRequest, bot, message_update, run
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def http_get(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: x\r\n\r\n".encode())
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    return head.split(b" ")[1].decode(), body.decode()
+
+
+def make_tenants(tmp_path, *names):
+    return [bot.Tenant(name, f"{number}:TEST", ADMIN, f"{name}_bot", str(tmp_path / f"{name}.db"))
+            for number, name in enumerate(names, 1)]
+
+
+def test_tenant_state_is_isolated(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "STORAGE", "sqlite")
+    first, second = make_tenants(tmp_path, "a", "b")
+    with bot.use_tenant(first):
+        bot.storage.migrate()
+        bot.storage.add_user(5)
+        bot.blacklist_cache.put(5, {6})
+    with bot.use_tenant(second):
+        bot.storage.migrate()
+        assert bot.storage.get_user(5) is None
+        assert 5 not in bot.blacklist_cache
+    for item in (first, second):
+        item.state["storage"].close()
+
+
+def test_shared_services_are_refcounted(monkeypatch):
+    monkeypatch.setattr(bot, "METRICS_PORT", 0)
+
+    async def scenario():
+        await bot.start_shared_services()
+        await bot.start_shared_services()
+        await bot.stop_shared_services()
+        running = bot.loop_watchdog["thread"] is not None and len(bot.shared_services["tasks"]) == 1
+        await bot.stop_shared_services()
+        return running
+
+    assert run(scenario())
+    assert bot.loop_watchdog["thread"] is None and bot.shared_services == {"users": 0, "tasks": []}
+
+
+def test_shared_services_outlive_first_tenant(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "STORAGE", "sqlite")
+    port = free_port()
+    monkeypatch.setattr(bot, "METRICS_PORT", port)
+    tenants = make_tenants(tmp_path, "a", "b")
+
+    async def scenario():
+        # multi_bot_main ulushi: botlar to'xtasa ham xizmatlar ishlab turadi
+        await bot.start_shared_services()
+        apps = {}
+        for item in tenants:
+            with bot.use_tenant(item):
+                bot.storage.migrate()
+                apps[item.name] = bot.build_application(updater=False, request=FakeRequest())
+                await apps[item.name].initialize()
+                await bot.post_init(apps[item.name])
+        both = await http_get(port, "/health/ready")
+        metrics = await http_get(port, "/metrics")
+        with bot.use_tenant(tenants[0]):
+            await bot.post_shutdown(apps["a"])
+            await apps["a"].shutdown()
+        after_first = await http_get(port, "/health/ready")
+        with bot.use_tenant(tenants[1]):
+            await bot.post_shutdown(apps["b"])
+            await apps["b"].shutdown()
+        still_up = bot.http_server is not None
+        await bot.stop_shared_services()
+        return both, metrics, after_first, still_up
+
+    both, metrics, after_first, still_up = run(scenario())
+    assert both[0] == "200" and set(json.loads(both[1])["tenants"]) == {"a", "b"}
+    assert 'bot_queue_depth{tenant="a",queue="api_bulk_waiting"} 0' in metrics[1]
+    assert 'bot_queue_depth{tenant="b",queue="updates"} 0' in metrics[1]
+    assert after_first[0] == "200" and set(json.loads(after_first[1])["tenants"]) == {"b"}
+    assert still_up
+    assert bot.http_server is None and bot.active_tenants == []
+    for item in tenants:
+        item.state["storage"].close()
+
+
+def test_trace_files_are_per_tenant(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "STORAGE", "sqlite")
+    monkeypatch.setattr(bot, "TRACE_PATH", str(tmp_path / "trace.jsonl"))
+    tenants = make_tenants(tmp_path, "a", "b")
+    async def scenario():
+        for item in tenants:
+            with bot.use_tenant(item):
+                bot.storage.migrate()
+                app = bot.build_application(updater=False, request=FakeRequest())
+                async with app:
+                    await app.process_update(Update.de_json(message_update(1, 5, "salom"), app.bot))
+                bot.trace_state["file"].close()
+
+    run(scenario())
+    for item in tenants:
+        header, entry = [json.loads(line) for line in (tmp_path / f"trace.jsonl.{item.name}").read_text().splitlines()]
+        assert header["bot_username"] == "TestBot" and entry["update"]["update_id"] == 1
+        item.state["storage"].close()